@@ -0,0 +1,226 @@
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from semantic_index import embed_texts
+from subjects import SUBJECTS
+
+logger = logging.getLogger(__name__)
+
+# Кеш ответов ассистентов предметов (общий для всех сессий процесса):
+#   ANSWER_CACHE_ENABLED=0              — отключить полностью
+#   ANSWER_CACHE_BYPASS="Химия,..."     — предметы без кеша (или "answer_cache": False в SUBJECTS)
+#   ANSWER_CACHE_SIMILARITY=0.93        — порог косинусного сходства семантического уровня (>1 — только точный)
+#   ANSWER_CACHE_SEMANTIC_MIN_WORDS=8   — более короткие вопросы ищутся только точно
+#   ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_MAX_CHARS
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "1").strip() not in ("0", "false", "False", "")
+ANSWER_CACHE_BYPASS = {s.strip() for s in os.getenv("ANSWER_CACHE_BYPASS", "").split(",") if s.strip()}
+try:
+    ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.93"))
+except ValueError:
+    ANSWER_CACHE_SIMILARITY = 0.93
+try:
+    ANSWER_CACHE_TTL_SECONDS = max(0, int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "604800")))
+except ValueError:
+    ANSWER_CACHE_TTL_SECONDS = 604800
+try:
+    ANSWER_CACHE_MAX_ENTRIES = max(1, int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "2000")))
+except ValueError:
+    ANSWER_CACHE_MAX_ENTRIES = 2000
+# Короткие вопросы ("толығырақ түсіндір", "Абай қай жылы туған") почти совпадают
+# по эмбеддингу с разными по смыслу вопросами, поэтому в семантический уровень не попадают
+try:
+    ANSWER_CACHE_SEMANTIC_MIN_WORDS = max(1, int(os.getenv("ANSWER_CACHE_SEMANTIC_MIN_WORDS", "8")))
+except ValueError:
+    ANSWER_CACHE_SEMANTIC_MIN_WORDS = 8
+# Длинные сообщения (с содержимым файлов, многошаговые задачи) не кешируются
+try:
+    ANSWER_CACHE_MAX_CHARS = max(1, int(os.getenv("ANSWER_CACHE_MAX_CHARS", "500")))
+except ValueError:
+    ANSWER_CACHE_MAX_CHARS = 500
+
+_NOISE_RE = re.compile(r"[\W_]+")
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+# Латинские буквы, похожие на кириллические (частая подмена при наборе казахского текста)
+_LATIN_LOOKALIKES = str.maketrans({
+    "a": "а", "e": "е", "o": "о", "p": "р", "c": "с", "x": "х", "y": "у", "i": "і", "h": "һ", "k": "к", "m": "м", "t": "т",
+})
+
+
+def normalize_question(text: str) -> str:
+    """
+    Нормализованный текст вопроса для ключа кеша: NFC, casefold, латинские
+    двойники кириллических букв в кириллических словах, без пунктуации и
+    лишних пробелов ("Абай қай жылы туған?" == "абай  қай жылы туған").
+    """
+    text = unicodedata.normalize("NFC", text or "").casefold()
+    words = []
+    for word in _NOISE_RE.split(text):
+        if not word:
+            continue
+        if _CYRILLIC_RE.search(word):
+            word = word.translate(_LATIN_LOOKALIKES)
+        words.append(word)
+    return " ".join(words)
+
+
+def is_first_turn(messages) -> bool:
+    """
+    True, если в истории чата ровно один вопрос пользователя (только что
+    добавленный). Кеш применяется только к первому ходу: дальше ответ
+    зависит от контекста треда, которого нет в ключе.
+    """
+    return sum(1 for m in messages or [] if m.get("role") == "user") <= 1
+
+
+class CachedAnswer:
+    __slots__ = ("subject", "key", "answer", "sources", "created_at", "hits")
+
+    def __init__(self, subject: str, key: str, answer: str, sources: list):
+        self.subject = subject
+        self.key = key
+        self.answer = answer
+        self.sources = list(sources or [])
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class CacheLookup:
+    """Результат поиска: entry при попадании, иначе ключ и эмбеддинг для последующего store()."""
+
+    __slots__ = ("subject", "key", "vector", "entry", "tier")
+
+    def __init__(self, subject: str, key: str, vector=None, entry=None, tier=None):
+        self.subject = subject
+        self.key = key
+        self.vector = vector
+        self.entry = entry
+        self.tier = tier
+
+
+class AnswerCache:
+    """
+    Двухуровневый кеш ответов по (предмет, нормализованный вопрос): точное
+    совпадение ключа, затем ближайший по эмбеддингу вопрос того же предмета
+    с порогом similarity. Записи живут ttl секунд, при переполнении
+    вытесняется давно не использованная (LRU).
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL_SECONDS,
+                 similarity: float = ANSWER_CACHE_SIMILARITY):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._entries: OrderedDict = OrderedDict()  # (subject, key) -> CachedAnswer
+        self._vectors: dict = {}  # subject -> (ключи, матрица эмбеддингов)
+        self._lock = threading.Lock()
+        self.stats = Counter()
+
+    def enabled_for(self, subject: str) -> bool:
+        if not ANSWER_CACHE_ENABLED or subject in ANSWER_CACHE_BYPASS:
+            return False
+        return SUBJECTS.get(subject, {}).get("answer_cache", True)
+
+    def _expired(self, entry: CachedAnswer, now: float) -> bool:
+        return bool(self.ttl) and now - entry.created_at > self.ttl
+
+    def _drop(self, subject: str, key: str):
+        self._entries.pop((subject, key), None)
+        keys, matrix = self._vectors.get(subject, ([], None))
+        if key in keys:
+            i = keys.index(key)
+            self._vectors[subject] = (keys[:i] + keys[i + 1:], np.delete(matrix, i, axis=0))
+
+    def _hit(self, lookup: CacheLookup, entry: CachedAnswer, tier: str) -> CacheLookup:
+        self._entries.move_to_end((entry.subject, entry.key))
+        entry.hits += 1
+        lookup.entry = entry
+        lookup.tier = tier
+        self.stats[f"hit_{tier}"] += 1
+        return lookup
+
+    def lookup(self, client, subject: str, question: str):
+        """
+        Ищет ответ; None — кеш для предмета или вопроса не применяется.
+        Вызывается только для первого хода треда (is_first_turn). Эмбеддинг
+        считается только при промахе точного уровня и для вопросов не короче
+        ANSWER_CACHE_SEMANTIC_MIN_WORDS слов.
+        """
+        if not self.enabled_for(subject) or not question or len(question) > ANSWER_CACHE_MAX_CHARS:
+            self.stats["bypass"] += 1
+            return None
+        # Без отсечения окончаний: падеж задаёт смысл ("Абайға кім әсер етті" / "Абай кімге әсер етті")
+        key = normalize_question(question)
+        if not key:
+            return None
+        lookup = CacheLookup(subject, key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get((subject, key))
+            if entry is not None:
+                if not self._expired(entry, now):
+                    return self._log(self._hit(lookup, entry, "exact"))
+                self._drop(subject, key)
+                self.stats["expired"] += 1
+            has_vectors = bool(self._vectors.get(subject, ([], None))[0])
+        if self.similarity > 1 or client is None or len(key.split()) < ANSWER_CACHE_SEMANTIC_MIN_WORDS:
+            self.stats["miss"] += 1
+            return self._log(lookup)
+        try:
+            lookup.vector = embed_texts(client, [key])[0]
+        except Exception as e:
+            logger.debug(f"Answer cache embedding failed: {e}")
+            self.stats["miss"] += 1
+            return self._log(lookup)
+        if has_vectors:
+            with self._lock:
+                keys, matrix = self._vectors.get(subject, ([], None))
+                if keys:
+                    scores = matrix @ lookup.vector
+                    best = int(scores.argmax())
+                    entry = self._entries.get((subject, keys[best]))
+                    if scores[best] >= self.similarity and entry is not None:
+                        if not self._expired(entry, now):
+                            logger.debug("Answer cache semantic hit %.3f: %r ~ %r", scores[best], key, entry.key)
+                            return self._log(self._hit(lookup, entry, "semantic"))
+                        self._drop(subject, entry.key)
+                        self.stats["expired"] += 1
+        self.stats["miss"] += 1
+        return self._log(lookup)
+
+    def store(self, lookup, answer: str, sources=None):
+        """Сохраняет ответ после промаха (lookup из lookup(); None и пустой ответ игнорируются)."""
+        if lookup is None or lookup.entry is not None or not answer:
+            return
+        entry = CachedAnswer(lookup.subject, lookup.key, answer, sources)
+        with self._lock:
+            self._drop(lookup.subject, lookup.key)
+            self._entries[(lookup.subject, lookup.key)] = entry
+            if lookup.vector is not None:
+                keys, matrix = self._vectors.get(lookup.subject, ([], None))
+                row = np.asarray(lookup.vector, dtype=np.float32).reshape(1, -1)
+                self._vectors[lookup.subject] = (keys + [lookup.key], row if matrix is None or not keys else np.vstack([matrix, row]))
+            while len(self._entries) > self.max_entries:
+                (subject, key), _ = next(iter(self._entries.items()))
+                self._drop(subject, key)
+                self.stats["evicted"] += 1
+            self.stats["stored"] += 1
+
+    def _log(self, lookup: CacheLookup) -> CacheLookup:
+        stats = self.stats
+        lookups = stats["hit_exact"] + stats["hit_semantic"] + stats["miss"]
+        logger.info("Answer cache %s for subject '%s' (hit rate %.0f%% of %d: exact %d, semantic %d; %d entries)",
+                    lookup.tier or "miss", lookup.subject,
+                    100.0 * (lookups - stats["miss"]) / max(lookups, 1), lookups,
+                    stats["hit_exact"], stats["hit_semantic"], len(self._entries),
+                    extra={"sample": "answer_cache"})
+        return lookup
+
+
+answer_cache = AnswerCache()
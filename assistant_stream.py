@@ -0,0 +1,137 @@
+import logging
+import re
+import threading
+import time
+
+from openai_scheduler import RUN_ESTIMATED_TOKENS, call_openai
+
+logger = logging.getLogger(__name__)
+
+_CITATION_MARK_RE = re.compile(r"【[^】]*】")
+_SOURCE_MARK_RE = re.compile(r"†source", re.IGNORECASE)
+
+# thread_id -> (номер хода, prompt_tokens последнего run) для отчёта о росте контекста
+_thread_prompt_tokens: dict = {}
+_thread_prompt_tokens_lock = threading.Lock()
+
+# Статусы run, после которых поток событий завершается без ответа
+_FAILED_RUN_EVENTS = {"thread.run.failed", "thread.run.cancelled", "thread.run.expired", "thread.run.incomplete"}
+
+
+def strip_citation_marks(text: str) -> str:
+    """Удаляет встроенные метки цитат вида 【4:6†source】 и остатки †source."""
+    return _SOURCE_MARK_RE.sub("", _CITATION_MARK_RE.sub("", text or ""))
+
+
+def annotation_file_ids(annotations) -> set:
+    """file_id из аннотаций текста: file_citation, file_path или file_id напрямую."""
+    file_ids = set()
+    for ann in annotations or []:
+        ref = getattr(ann, "file_citation", None) or getattr(ann, "file_path", None) or ann
+        fid = getattr(ref, "file_id", None)
+        if isinstance(fid, str):
+            file_ids.add(fid)
+    return file_ids
+
+
+class StreamedRun:
+    """Результат потокового run: текст ответа, file_id источников и итоговый run."""
+
+    def __init__(self):
+        self.text = ""
+        self.file_ids: set = set()
+        self.run = None
+        self.error = None
+        self.first_token_at = None
+        self.without_run = False
+
+    @classmethod
+    def finished(cls, text: str):
+        """Готовый ответ, полученный без run (кеш ответов, локальный поиск): считается завершённым."""
+        result = cls()
+        result.text = text
+        result.without_run = True
+        return result
+
+    @property
+    def status(self) -> str:
+        if self.without_run:
+            return "completed"
+        if self.run is not None:
+            return self.run.status
+        return "failed" if self.error else "unknown"
+
+
+def stream_run(client, thread_id: str, assistant_id: str, on_text=None, metrics=None, on_wait=None, **run_kwargs) -> StreamedRun:
+    """
+    Запускает run ассистента в потоковом режиме. on_text(text) вызывается с
+    накопленным текстом (без меток цитат) после каждого фрагмента; аннотации
+    с файлами собираются по мере поступления. В metrics записываются usage
+    и ожидание в очереди из завершённого run.
+    """
+    result = StreamedRun()
+    started = time.monotonic()
+    stream = call_openai(client.beta.threads.runs, "create", metrics=metrics, on_wait=on_wait,
+                         est_tokens=RUN_ESTIMATED_TOKENS, thread_id=thread_id, assistant_id=assistant_id,
+                         stream=True, **run_kwargs)
+    try:
+        for event in stream:
+            name = getattr(event, "event", "")
+            data = getattr(event, "data", None)
+            if name == "thread.message.delta":
+                for block in getattr(data.delta, "content", None) or []:
+                    text_part = getattr(block, "text", None)
+                    if text_part is None:
+                        continue
+                    result.file_ids |= annotation_file_ids(getattr(text_part, "annotations", None))
+                    value = getattr(text_part, "value", None)
+                    if isinstance(value, str) and value:
+                        if result.first_token_at is None:
+                            result.first_token_at = time.monotonic() - started
+                            logger.debug("Assistant first token after %.2fs", result.first_token_at)
+                        result.text += value
+                        if on_text:
+                            on_text(strip_citation_marks(result.text))
+            elif name == "thread.message.completed":
+                # В итоговом сообщении аннотации полные (в дельтах могут быть частичными)
+                for block in getattr(data, "content", None) or []:
+                    text_part = getattr(block, "text", None)
+                    if text_part is not None:
+                        result.file_ids |= annotation_file_ids(getattr(text_part, "annotations", None))
+            elif name == "thread.run.completed" or name in _FAILED_RUN_EVENTS:
+                result.run = data
+            elif name == "error":
+                result.error = data
+                logger.error("Assistant stream error: %s", data)
+    finally:
+        try:
+            stream.close()
+        except Exception:
+            pass
+    if metrics is not None:
+        if result.run is not None:
+            metrics.add_run(result.run)
+        if result.status != "completed":
+            metrics.outcome = result.status
+    result.text = strip_citation_marks(result.text)
+    return result
+
+
+def report_context_growth(thread_id: str, run, ceiling: int = None):
+    """
+    Логирует входные токены run и их прирост относительно предыдущего хода
+    в том же треде; предупреждает, когда вход подходит к потолку max_prompt_tokens.
+    """
+    usage = getattr(run, "usage", None)
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    if not prompt_tokens:
+        return
+    with _thread_prompt_tokens_lock:
+        turn, previous = _thread_prompt_tokens.get(thread_id, (0, None))
+        turn += 1
+        _thread_prompt_tokens[thread_id] = (turn, prompt_tokens)
+    growth = prompt_tokens - previous if previous is not None else 0
+    logger.info("Thread %s turn %d: %d prompt tokens (%+d vs previous turn, ceiling %s)",
+                thread_id, turn, prompt_tokens, growth, ceiling or "none")
+    if ceiling and prompt_tokens >= 0.9 * ceiling:
+        logger.warning("Thread %s prompt tokens %d are close to the ceiling %d", thread_id, prompt_tokens, ceiling)
@@ -0,0 +1,100 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_metrics import bind_context, track_call
+from openai_scheduler import call_openai
+
+logger = logging.getLogger(__name__)
+
+# Удаление тредов OpenAI и дозапись в них не должны задерживать ответ пользователю
+_maintenance_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thread-maintenance")
+
+# chat_id -> thread_id для чатов, тред которых уже найден или создан в этом процессе
+_chat_threads: dict = {}
+_chat_threads_lock = threading.Lock()
+
+
+def _delete_thread(client, thread_id: str):
+    try:
+        with track_call("threads.delete") as m:
+            call_openai(client.beta.threads, "delete", metrics=m, thread_id=thread_id)
+        logger.debug("Deleted assistant thread %s", thread_id)
+    except Exception as e:
+        logger.debug(f"Thread {thread_id} cleanup failed: {e}")
+
+
+def discard_thread(client, thread_id):
+    """Ставит удаление треда в фоновую очередь (ошибки только логируются)."""
+    if thread_id:
+        _maintenance_executor.submit(bind_context(_delete_thread), client, thread_id)
+
+
+def _append_turn(client, thread_id, question: str, answer: str):
+    try:
+        if callable(thread_id):
+            thread_id = thread_id()
+        with track_call("threads.append_turn") as m:
+            call_openai(client.beta.threads.messages, "create", metrics=m,
+                        thread_id=thread_id, role="user", content=question)
+            call_openai(client.beta.threads.messages, "create", metrics=m,
+                        thread_id=thread_id, role="assistant", content=answer)
+    except Exception as e:
+        logger.debug(f"Could not append cached turn to thread: {e}")
+
+
+def append_turn(client, thread_id, question: str, answer: str):
+    """
+    Добавляет в тред в фоне вопрос и ответ, полученный без run (из кеша
+    ответов), чтобы следующие вопросы чата видели этот ход. thread_id может
+    быть функцией без аргументов — тогда тред определяется в фоновом потоке.
+    """
+    if thread_id:
+        _maintenance_executor.submit(bind_context(_append_turn), client, thread_id, question, answer)
+
+
+def discard_chat_threads(client, rows):
+    """
+    Удаляет треды строк чатов, возвращённых delete().execute(): сам тред
+    удаляется в фоне, запись в кэше процесса — сразу.
+    """
+    for row in rows or []:
+        with _chat_threads_lock:
+            _chat_threads.pop(row.get("id"), None)
+        discard_thread(client, row.get("thread_id"))
+
+
+def chat_thread_id(client, supabase, table: str, chat_id: str, metrics=None, on_wait=None) -> str:
+    """
+    Тред ассистента для строки чата (test_chats, psychology_chats): берётся из
+    колонки thread_id, а при её отсутствии создаётся один раз и сохраняется,
+    чтобы все вопросы чата шли в один тред и сохраняли контекст.
+    """
+    with _chat_threads_lock:
+        cached = _chat_threads.get(chat_id)
+    if cached:
+        return cached
+    thread_id = None
+    try:
+        resp = supabase.table(table).select("thread_id").eq("id", chat_id).execute()
+        if resp.data:
+            thread_id = resp.data[0].get("thread_id")
+    except Exception as e:
+        logger.debug(f"Could not load thread_id for {table} {chat_id}: {e}")
+    if not thread_id:
+        thread_id = call_openai(client.beta.threads, "create", metrics=metrics, on_wait=on_wait).id
+        try:
+            # Записываем только если тред ещё не сохранён (параллельный запуск мог успеть раньше)
+            updated = supabase.table(table).update({"thread_id": thread_id}).eq("id", chat_id).is_("thread_id", "null").execute()
+            if not updated.data:
+                existing = supabase.table(table).select("thread_id").eq("id", chat_id).execute()
+                stored = existing.data[0].get("thread_id") if existing.data else None
+                if stored:
+                    discard_thread(client, thread_id)
+                    thread_id = stored
+        except Exception as e:
+            logger.debug(f"Could not store thread_id for {table} {chat_id}: {e}")
+        logger.debug("Created assistant thread %s for %s %s", thread_id, table, chat_id)
+    with _chat_threads_lock:
+        _chat_threads[chat_id] = thread_id
+    return thread_id
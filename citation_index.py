@@ -0,0 +1,268 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+from semantic_index import CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+# Проверка ссылок сгенерированных вопросов (book_title, page, context) по учебникам:
+#   CITATION_CHECK_ENABLED=0          — отключить
+#   CITATION_MIN_OVERLAP=0.5          — доля шинглов контекста, найденных на странице
+#   CITATION_PAGE_TOLERANCE=2         — допуск по напечатанному номеру страницы (контекст может начаться на соседней)
+CITATION_CHECK_ENABLED = os.getenv("CITATION_CHECK_ENABLED", "1").strip() not in ("0", "false", "False", "")
+try:
+    CITATION_MIN_OVERLAP = float(os.getenv("CITATION_MIN_OVERLAP", "0.5"))
+except ValueError:
+    CITATION_MIN_OVERLAP = 0.5
+try:
+    CITATION_PAGE_TOLERANCE = max(0, int(os.getenv("CITATION_PAGE_TOLERANCE", "2")))
+except ValueError:
+    CITATION_PAGE_TOLERANCE = 2
+# Сходство слов названия (Жаккар), при котором книга считается найденной
+TITLE_MIN_SIMILARITY = 0.6
+# Шинглы из SHINGLE_WORDS слов; шинглы, встречающиеся на многих страницах, не учитываются
+SHINGLE_WORDS = 2
+MAX_SHINGLE_PAGES = 50
+# Контекст короче стольких шинглов не проверяется
+MIN_CONTEXT_SHINGLES = 3
+
+_WORD_RE = re.compile(r"\w+")
+_PAGE_RE = re.compile(r"^\s*(\d+)\s*(?:-\s*(\d+))?\s*бет\s*$")
+
+
+def _words(text: str) -> list[str]:
+    return _WORD_RE.findall((text or "").casefold())
+
+
+def shingle_hashes(text: str, size: int = SHINGLE_WORDS) -> np.ndarray:
+    """Уникальные CRC32 словесных шинглов текста (стабильны между процессами)."""
+    words = _words(text)
+    if len(words) < size:
+        return np.zeros(0, dtype=np.uint32)
+    return np.unique(np.fromiter((zlib.crc32(" ".join(words[i:i + size]).encode("utf-8"))
+                                  for i in range(len(words) - size + 1)), dtype=np.uint32))
+
+
+def _title_tokens(title: str) -> frozenset:
+    return frozenset(_words(title))
+
+
+def parse_page(value) -> tuple[int, int] | None:
+    """"12 бет" -> (12, 12), "12-14 бет" -> (12, 14); None, если формат другой."""
+    match = _PAGE_RE.match(str(value or ""))
+    if not match:
+        return None
+    first = int(match.group(1))
+    last = int(match.group(2) or first)
+    return (first, last) if last >= first else (last, first)
+
+
+def _printed_number(label) -> int:
+    """Напечатанный номер страницы из page_label ("12" -> 12); -1, если номер не арабский или неизвестен."""
+    label = str(label or "").strip()
+    return int(label) if label.isdigit() else -1
+
+
+class CitationIndex:
+    """
+    Известные учебники предмета: названия, напечатанные номера страниц и
+    инвертированный индекс шинглов страниц (отсортированный массив хешей и
+    номера страниц), поэтому проверка вопроса — пара np.searchsorted без
+    обращений к сети. Страницы сравниваются по напечатанным номерам
+    (page_label из ingest.py); у книг без них номер страницы проверить
+    нельзя, и такие ссылки не исправляются.
+    """
+
+    def __init__(self, books: list[dict], hashes: np.ndarray, page_ids: np.ndarray,
+                 page_book: np.ndarray, page_printed: np.ndarray):
+        self.books = books
+        self.hashes = hashes
+        self.page_ids = page_ids
+        self.page_book = page_book
+        self.page_printed = page_printed
+        self._title_tokens = [frozenset().union(*(_title_tokens(t) for t in b["aliases"])) for b in books]
+        self._exact_titles = {" ".join(_words(alias)): i for i, b in enumerate(books) for alias in b["aliases"]}
+
+    @classmethod
+    def build(cls, chunks: list[dict]) -> "CitationIndex":
+        """Индекс по фрагментам ingest.py ({source, title, page, page_label, text})."""
+        books, book_ids, pages, printed = [], {}, {}, {}
+        for chunk in chunks:
+            source = chunk["source"]
+            if source not in book_ids:
+                book_ids[source] = len(books)
+                title = chunk.get("title") or os.path.splitext(source)[0]
+                books.append({"title": title, "aliases": sorted({title, os.path.splitext(source)[0]}),
+                              "first_page": None, "last_page": None})
+            key = (book_ids[source], chunk["page"])
+            pages.setdefault(key, []).append(chunk["text"])
+            printed[key] = _printed_number(chunk.get("page_label"))
+        page_keys = sorted(pages)
+        page_book = np.asarray([b for b, _ in page_keys], dtype=np.int32)
+        page_printed = np.asarray([printed[key] for key in page_keys], dtype=np.int32)
+        for (book_id, _), number in zip(page_keys, page_printed.tolist()):
+            if number >= 0:
+                book = books[book_id]
+                book["first_page"] = number if book["first_page"] is None else min(book["first_page"], number)
+                book["last_page"] = number if book["last_page"] is None else max(book["last_page"], number)
+        all_hashes, all_pages = [], []
+        for page_id, key in enumerate(page_keys):
+            # Соседние фрагменты страницы перекрываются: шинглы считаются по странице целиком
+            h = np.unique(np.concatenate([shingle_hashes(text) for text in pages[key]]))
+            all_hashes.append(h)
+            all_pages.append(np.full(h.size, page_id, dtype=np.int32))
+        hashes = np.concatenate(all_hashes) if all_hashes else np.zeros(0, dtype=np.uint32)
+        page_ids = np.concatenate(all_pages) if all_pages else np.zeros(0, dtype=np.int32)
+        order = np.argsort(hashes, kind="stable")
+        return cls(books, hashes[order], page_ids[order], page_book, page_printed)
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "books.json"), "w", encoding="utf-8") as f:
+            json.dump(self.books, f, ensure_ascii=False)
+        np.savez(os.path.join(directory, "shingles"), hashes=self.hashes, page_ids=self.page_ids,
+                 page_book=self.page_book, page_printed=self.page_printed)
+
+    @classmethod
+    def load(cls, directory: str) -> "CitationIndex":
+        with open(os.path.join(directory, "books.json"), "r", encoding="utf-8") as f:
+            books = json.load(f)
+        data = np.load(os.path.join(directory, "shingles.npz"))
+        if "page_printed" not in data:
+            raise ValueError("index predates printed page numbers, rebuild it")
+        return cls(books, data["hashes"], data["page_ids"], data["page_book"], data["page_printed"])
+
+    def match_title(self, title: str):
+        """Номер книги по названию: точное совпадение слов или Жаккар >= TITLE_MIN_SIMILARITY."""
+        normalized = " ".join(_words(title))
+        if normalized in self._exact_titles:
+            return self._exact_titles[normalized]
+        tokens = frozenset(normalized.split())
+        if not tokens:
+            return None
+        best, best_score = None, 0.0
+        for i, book_tokens in enumerate(self._title_tokens):
+            score = len(tokens & book_tokens) / len(tokens | book_tokens)
+            if score > best_score:
+                best, best_score = i, score
+        return best if best_score >= TITLE_MIN_SIMILARITY else None
+
+    def page_overlap(self, context: str) -> tuple[np.ndarray, int]:
+        """Число шинглов контекста на каждой странице и общее число шинглов контекста."""
+        query = shingle_hashes(context)
+        counts = np.zeros(self.page_book.size, dtype=np.int32)
+        if not query.size or not self.hashes.size:
+            return counts, int(query.size)
+        left = np.searchsorted(self.hashes, query, side="left")
+        right = np.searchsorted(self.hashes, query, side="right")
+        for lo, hi in zip(left, right):
+            if 0 < hi - lo <= MAX_SHINGLE_PAGES:
+                counts[self.page_ids[lo:hi]] += 1
+        return counts, int(query.size)
+
+    def verify(self, q: dict):
+        """
+        Проверяет ссылку вопроса. Возвращает None (ссылка подтверждена или
+        страницу проверить нельзя), "corrected" (контекст найден на странице
+        с известным напечатанным номером — book_title/page исправлены в q)
+        или пару (правило, сообщение) для отбраковки.
+        """
+        book = self.match_title(q.get("book_title", ""))
+        pages = parse_page(q.get("page"))
+        counts, total = self.page_overlap(q.get("context", ""))
+        checkable = total >= MIN_CONTEXT_SHINGLES
+        found = counts >= CITATION_MIN_OVERLAP * total if checkable else np.zeros(counts.size, dtype=bool)
+        in_range = False
+        if book is not None and pages is not None:
+            first, last = pages
+            meta = self.books[book]
+            if meta["first_page"] is None:
+                # Напечатанных номеров нет: проверяется только, что контекст есть в книге
+                if not checkable or (found & (self.page_book == book)).any():
+                    return None
+                in_range = True
+            else:
+                in_range = meta["first_page"] - CITATION_PAGE_TOLERANCE <= first and last <= meta["last_page"] + CITATION_PAGE_TOLERANCE
+                if in_range:
+                    if not checkable:
+                        return None
+                    window = ((self.page_book == book)
+                              & (self.page_printed >= first - CITATION_PAGE_TOLERANCE)
+                              & (self.page_printed <= last + CITATION_PAGE_TOLERANCE))
+                    if (found & window).any():
+                        return None
+        # Исправляется только на страницу с напечатанным номером, иначе вопрос отбраковывается
+        correctable = found & (self.page_printed >= 0)
+        if correctable.any():
+            best = int(np.where(correctable, counts, -1).argmax())
+            q["book_title"] = self.books[int(self.page_book[best])]["title"]
+            q["page"] = f"{int(self.page_printed[best])} бет"
+            return "corrected"
+        if book is None:
+            return "citation_title", f"Оқулық табылмады: {q.get('book_title')}"
+        if pages is None or not in_range:
+            return "citation_page", f"Бет оқулықта жоқ: {q.get('book_title')}, {q.get('page')}"
+        return "citation_context", f"Контекст оқулықта табылмады: {q.get('book_title')}, {q.get('page')}"
+
+
+def _citation_index_dir(subject: str) -> str:
+    subject_id = hashlib.sha1(subject.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "citation_index", subject_id)
+
+
+_indexes: dict = {}
+_indexes_lock = threading.Lock()
+
+
+def get_citation_index(subject: str):
+    """Индекс предмета с диска (один раз на процесс); None — проверка для предмета не выполняется."""
+    if not CITATION_CHECK_ENABLED:
+        return None
+    with _indexes_lock:
+        if subject in _indexes:
+            return _indexes[subject]
+        index = None
+        directory = _citation_index_dir(subject)
+        if os.path.exists(os.path.join(directory, "books.json")):
+            try:
+                index = CitationIndex.load(directory)
+                logger.info(f"Loaded citation index for subject '{subject}': {len(index.books)} books, {index.page_book.size} pages")
+            except Exception as e:
+                logger.error(f"Failed to load citation index for subject '{subject}': {e}")
+        _indexes[subject] = index
+        return index
+
+
+def build_citation_index(subject: str, workers: int = None) -> CitationIndex:
+    """Строит и сохраняет индекс по фрагментам ingest.py (неизменённые книги берутся из кеша)."""
+    from ingest import ingest_subject
+    chunks, _ = ingest_subject(subject, **({"workers": workers} if workers else {}))
+    index = CitationIndex.build(chunks)
+    index.save(_citation_index_dir(subject))
+    with _indexes_lock:
+        _indexes[subject] = index
+    logger.info(f"Built citation index for subject '{subject}': {len(index.books)} books, {index.page_book.size} pages")
+    return index
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from ingest import textbooks_dir
+    from log_setup import configure_logging
+    from subjects import SUBJECTS
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Индекс названий, страниц и шинглов учебников для проверки ссылок вопросов")
+    parser.add_argument("--subject", action="append", help="Предмет (по умолчанию все с каталогом учебников)")
+    parser.add_argument("--workers", type=int)
+    args = parser.parse_args()
+    for name in args.subject or [s for s in SUBJECTS if os.path.isdir(textbooks_dir(s))]:
+        build_citation_index(name, workers=args.workers)
@@ -0,0 +1,122 @@
+import logging
+import math
+import re
+import threading
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_RE = re.compile(r"\w{3,}")
+
+
+def _tokens(text: str) -> list[str]:
+    return _TOKEN_RE.findall((text or "").lower().replace("_", " "))
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: кириллица в среднем ~3 символа на токен."""
+    return max(1, math.ceil(len(text or "") / 3))
+
+
+class GenerationProfile:
+    """
+    Профиль того, что модель генерирует по предмету: веса терминов из текстов
+    сгенерированных вопросов с экспоненциальным затуханием (общий на процесс).
+    """
+
+    def __init__(self, decay: float = 0.9, max_terms: int = 5000):
+        self.decay = decay
+        self.max_terms = max_terms
+        self.weights: dict[str, float] = {}
+        self.observed = 0
+        self._lock = threading.Lock()
+
+    def observe(self, texts: list[str]):
+        counts = Counter()
+        for text in texts:
+            counts.update(set(_tokens(text)))
+        if not counts:
+            return
+        with self._lock:
+            for term in list(self.weights):
+                self.weights[term] *= self.decay
+            for term, n in counts.items():
+                self.weights[term] = self.weights.get(term, 0.0) + n
+            if len(self.weights) > self.max_terms:
+                keep = sorted(self.weights.items(), key=lambda kv: kv[1], reverse=True)[:self.max_terms]
+                self.weights = dict(keep)
+            self.observed += len(texts)
+
+    def score(self, text: str) -> float:
+        """Средний вес терминов текста: чем выше, тем вероятнее модель повторит такой вопрос."""
+        terms = set(_tokens(text))
+        if not terms:
+            return 0.0
+        weights = self.weights
+        return sum(weights.get(t, 0.0) for t in terms) / math.sqrt(len(terms))
+
+
+_profiles: dict[str, GenerationProfile] = {}
+_duplicate_rates: dict[str, float] = {}
+_lock = threading.Lock()
+
+
+def get_profile(subject: str) -> GenerationProfile:
+    with _lock:
+        profile = _profiles.get(subject)
+        if profile is None:
+            profile = GenerationProfile()
+            _profiles[subject] = profile
+        return profile
+
+
+def observe_generated(subject: str, texts: list[str]):
+    """Учитывает тексты сгенерированных кандидатов в профиле предмета."""
+    get_profile(subject).observe([t for t in texts if isinstance(t, str)])
+
+
+def select_exclusions(subject: str, texts: list[str], token_budget: int) -> list[str]:
+    """
+    Отбирает тексты решённых вопросов для промпта: ранжирует по близости к
+    профилю генерации предмета и жадно упаковывает в бюджет токенов.
+    Пока профиль пуст, сохраняется исходный порядок (самые новые первыми).
+    """
+    items = []
+    seen = set()
+    for t in texts or []:
+        if not isinstance(t, str):
+            continue
+        tx = " ".join(t.strip().split())
+        if tx and tx not in seen:
+            seen.add(tx)
+            items.append(tx)
+    profile = get_profile(subject)
+    if profile.observed:
+        ranked = sorted(enumerate(items), key=lambda it: (-profile.score(it[1]), it[0]))
+        items = [tx for _, tx in ranked]
+    selected = []
+    used = 0
+    for tx in items:
+        cost = estimate_tokens(tx) + 1
+        if used + cost > token_budget:
+            continue
+        selected.append(tx)
+        used += cost
+    logger.debug(f"Selected {len(selected)}/{len(items)} exclusion items (~{used} tokens) for subject '{subject}'")
+    return selected
+
+
+def record_duplicate_rate(subject: str, candidates: int, duplicates: int, alpha: float = 0.2) -> float:
+    """
+    Логирует долю повторов среди валидных кандидатов и её скользящее среднее
+    по предмету, чтобы эффект отбора исключений можно было измерить.
+    """
+    if candidates <= 0:
+        return 0.0
+    rate = duplicates / candidates
+    with _lock:
+        prev = _duplicate_rates.get(subject)
+        ema = rate if prev is None else (1 - alpha) * prev + alpha * rate
+        _duplicate_rates[subject] = ema
+    logger.info(f"Duplicate rate for subject '{subject}': {rate:.1%} ({duplicates}/{candidates}), EMA {ema:.1%}")
+    return ema
@@ -0,0 +1,185 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llm_metrics import track_call
+from openai_scheduler import call_openai
+from subjects import SUBJECTS
+
+logger = logging.getLogger(__name__)
+
+# Кеш имён файлов векторных хранилищ (file_id -> имя) для подписей источников
+FILE_CACHE_PATH = os.getenv("FILE_CACHE_PATH", os.path.join(os.getenv("UBT_CACHE_DIR", ".cache"), "file_names.json"))
+try:
+    FILE_CACHE_REFRESH_SECONDS = max(60, int(os.getenv("FILE_CACHE_REFRESH_SECONDS", "21600")))
+except ValueError:
+    FILE_CACHE_REFRESH_SECONDS = 21600
+# Записи, которые не встречались ни в одном обновлении дольше этого срока, удаляются
+try:
+    FILE_CACHE_TTL_SECONDS = max(FILE_CACHE_REFRESH_SECONDS, int(os.getenv("FILE_CACHE_TTL_SECONDS", "604800")))
+except ValueError:
+    FILE_CACHE_TTL_SECONDS = 604800
+
+
+def _vector_stores(client):
+    # В новых версиях SDK vector_stores вынесены из beta
+    return getattr(client, "vector_stores", None) or client.beta.vector_stores
+
+
+def _list_all(resource, metrics=None, **kwargs):
+    """
+    Все элементы постраничного list(): каждая страница запрашивается через
+    планировщик (автопагинация SDK обошла бы его).
+    """
+    items = []
+    while True:
+        page = call_openai(resource, "list", metrics=metrics, **kwargs)
+        items.extend(page.data)
+        if not page.data or not page.has_next_page():
+            return items
+        kwargs["after"] = page.data[-1].id
+
+
+class FileNameCache:
+    """
+    Имена файлов по file_id для цитат ассистентов. Заполняется фоновым
+    обновлением по всем vector_store_id из SUBJECTS и хранится на диске, поэтому
+    подписи источников строятся без сетевых запросов. Неизвестный file_id
+    отображается как есть и дозапрашивается в фоне.
+    """
+
+    def __init__(self, path: str = FILE_CACHE_PATH):
+        self.path = path
+        self._names: dict = {}  # file_id -> {"filename": ..., "seen_at": unix time}
+        self._lock = threading.Lock()
+        self._pending: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-cache")
+        self._refresher = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._names = {k: v for k, v in data.items() if isinstance(v, dict) and v.get("filename")}
+            logger.debug(f"Loaded {len(self._names)} cached file names from {self.path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logger.warning(f"File name cache {self.path} unreadable, starting empty: {e}")
+
+    def _save(self):
+        with self._lock:
+            data = dict(self._names)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not save file name cache: {e}")
+
+    def get(self, file_id: str):
+        with self._lock:
+            entry = self._names.get(file_id)
+        return entry["filename"] if entry else None
+
+    def names(self, file_ids, client=None) -> list:
+        """
+        Имена файлов для file_id (без повторов, в порядке сортировки id).
+        Промахи возвращаются как file_id; при переданном client они
+        запрашиваются в фоне и появятся в следующих ответах.
+        """
+        result = []
+        for fid in sorted(file_ids):
+            name = self.get(fid)
+            if name is None and client is not None:
+                self._fetch_later(client, fid)
+            result.append(name or fid)
+        return list(dict.fromkeys(result))
+
+    def _fetch_later(self, client, file_id: str):
+        with self._lock:
+            if file_id in self._pending:
+                return
+            self._pending.add(file_id)
+        self._executor.submit(self._fetch_one, client, file_id)
+
+    def _fetch_one(self, client, file_id: str):
+        try:
+            with track_call("files.retrieve") as m:
+                fobj = call_openai(client.files, "retrieve", metrics=m, file_id=file_id)
+            filename = getattr(fobj, "filename", None)
+            if filename:
+                with self._lock:
+                    self._names[file_id] = {"filename": filename, "seen_at": time.time()}
+                self._save()
+        except Exception as e:
+            logger.debug(f"File name lookup for {file_id} failed: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(file_id)
+
+    def refresh(self, client):
+        """
+        Перечитывает файлы всех векторных хранилищ предметов: одно
+        постраничное files.list для имён и files.retrieve только для файлов,
+        которых в нём нет. Устаревшие записи удаляются.
+        """
+        now = time.time()
+        store_file_ids = set()
+        with track_call("files.cache_refresh") as m:
+            for subject, cfg in SUBJECTS.items():
+                vector_store_id = cfg.get("vector_store_id")
+                if not vector_store_id:
+                    continue
+                try:
+                    for vs_file in _list_all(_vector_stores(client).files, m, vector_store_id=vector_store_id, limit=100):
+                        store_file_ids.add(vs_file.id)
+                except Exception as e:
+                    logger.warning(f"Could not list files of vector store for subject '{subject}': {e}")
+            listed = {}
+            try:
+                for fobj in _list_all(client.files, m, purpose="assistants"):
+                    if getattr(fobj, "filename", None):
+                        listed[fobj.id] = fobj.filename
+            except Exception as e:
+                logger.warning(f"Could not list assistant files: {e}")
+        fresh = {fid: listed[fid] for fid in store_file_ids if fid in listed}
+        with self._lock:
+            for fid, filename in fresh.items():
+                self._names[fid] = {"filename": filename, "seen_at": now}
+            expired = [fid for fid, entry in self._names.items() if now - entry.get("seen_at", 0) > FILE_CACHE_TTL_SECONDS]
+            for fid in expired:
+                del self._names[fid]
+            missing = [fid for fid in store_file_ids if fid not in self._names]
+        for fid in missing:
+            self._fetch_later(client, fid)
+        self._save()
+        logger.info(f"File name cache refreshed: {len(fresh)} files from {len(store_file_ids)} in vector stores, "
+                    f"{len(expired)} evicted, {len(missing)} fetched individually")
+
+    def start(self, client):
+        """Запускает (один раз на процесс) фоновый поток: сразу прогрев, затем обновление по расписанию."""
+        with self._lock:
+            if self._refresher is not None:
+                return
+            self._refresher = threading.Thread(target=self._refresh_loop, args=(client,),
+                                               name="file-cache-refresh", daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self, client):
+        while True:
+            try:
+                self.refresh(client)
+            except Exception as e:
+                logger.warning(f"File name cache refresh failed: {e}")
+            time.sleep(FILE_CACHE_REFRESH_SECONDS)
+
+
+file_names = FileNameCache()
@@ -0,0 +1,111 @@
+import hashlib
+import logging
+import random
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Простое число Мерсенна 2^31 - 1 для универсального хеширования MinHash:
+# a * h + b < 2^63 для 31-битных a и h, поэтому подпись считается в uint64 numpy
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def _shingle_hash(shingle: str) -> int:
+    return int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "big") % _MERSENNE_PRIME
+
+
+def shingles(normalized_text: str, size: int = 3) -> set[str]:
+    """Символьные k-граммы нормализованного текста вопроса."""
+    text = normalized_text or ""
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+class NearDuplicateIndex:
+    """
+    Индекс MinHash + LSH для поиска почти одинаковых вопросов.
+
+    Текст (уже нормализованный через fingerprint_text в test.py) разбивается на
+    символьные шинглы, по ним строится подпись из num_perm минимумов.
+    Кандидаты ищутся по полосам (LSH), затем сходство Жаккара оценивается по
+    подписи и сравнивается с порогом threshold.
+    """
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 3, min_chars: int = 20, seed: int = 1):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.min_chars = min_chars
+        self.seed = seed
+        rng = random.Random(seed)
+        perms = [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+        self._a = np.array([a for a, _ in perms], dtype=np.uint64)[:, None]
+        self._b = np.array([b for _, b in perms], dtype=np.uint64)[:, None]
+        self._buckets: list[dict] = [{} for _ in range(bands)]
+        self._signatures: dict = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def signature(self, normalized_text: str):
+        """Подпись MinHash или None, если текст слишком короткий для сравнения."""
+        if len(normalized_text or "") < self.min_chars:
+            return None
+        hashes = np.fromiter((_shingle_hash(s) for s in shingles(normalized_text, self.shingle_size)), dtype=np.uint64)
+        # Все перестановки сразу: матрица num_perm × число шинглов, минимум по строкам
+        return tuple(((self._a * hashes + self._b) % _MERSENNE_PRIME).min(axis=1).tolist())
+
+    def _band_keys(self, sig):
+        for band in range(self.bands):
+            yield band, sig[band * self.rows:(band + 1) * self.rows]
+
+    def add(self, normalized_text: str, key=None, sig=None) -> bool:
+        key = key if key is not None else normalized_text
+        if key in self._signatures:
+            return False
+        sig = sig if sig is not None else self.signature(normalized_text)
+        if sig is None:
+            return False
+        self._signatures[key] = sig
+        for band, band_key in self._band_keys(sig):
+            self._buckets[band].setdefault(band_key, []).append(key)
+        return True
+
+    def find(self, normalized_text: str, sig=None):
+        """
+        Возвращает (key, similarity) ближайшего вопроса со сходством не ниже
+        порога или None.
+        """
+        sig = sig if sig is not None else self.signature(normalized_text)
+        if sig is None or not self._signatures:
+            return None
+        candidates = set()
+        for band, band_key in self._band_keys(sig):
+            candidates.update(self._buckets[band].get(band_key, ()))
+        best = None
+        for key in candidates:
+            other = self._signatures[key]
+            similarity = sum(1 for x, y in zip(sig, other) if x == y) / self.num_perm
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def update(self, other: "NearDuplicateIndex"):
+        """Добавляет подписи другого индекса с теми же параметрами."""
+        if (other.num_perm, other.bands, other.shingle_size, other.seed) != (self.num_perm, self.bands, self.shingle_size, self.seed):
+            raise ValueError("Incompatible NearDuplicateIndex parameters")
+        for key, sig in other._signatures.items():
+            self.add("", key=key, sig=sig)
+
+    def copy(self) -> "NearDuplicateIndex":
+        clone = NearDuplicateIndex(self.threshold, self.num_perm, self.bands,
+                                   self.shingle_size, self.min_chars, self.seed)
+        clone.update(self)
+        return clone
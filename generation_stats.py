@@ -0,0 +1,66 @@
+import logging
+import math
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class AcceptanceTracker:
+    """
+    Доля принятых вопросов (после проверки полей и отсева повторов) от всех
+    разобранных, отдельно по предмету и по паре (предмет, пользователь),
+    с экспоненциальным затуханием старых наблюдений.
+    """
+
+    def __init__(self, decay: float = 0.7, prior: float = 0.8, user_weight_k: float = 20.0,
+                 min_rate: float = 0.1):
+        self.decay = decay
+        self.prior = prior
+        self.user_weight_k = user_weight_k
+        self.min_rate = min_rate
+        self._stats: dict = {}  # key -> [взвешенные принятые, взвешенные разобранные]
+        self._lock = threading.Lock()
+
+    def _update(self, key, accepted: int, parsed: int):
+        acc, total = self._stats.get(key, (0.0, 0.0))
+        self._stats[key] = (acc * self.decay + accepted, total * self.decay + parsed)
+
+    def record(self, subject: str, user_id, accepted: int, parsed: int):
+        if parsed <= 0:
+            return
+        with self._lock:
+            self._update(subject, accepted, parsed)
+            if user_id:
+                self._update((subject, user_id), accepted, parsed)
+        logger.debug(f"Acceptance for subject '{subject}': {accepted}/{parsed}, expected yield now {self.expected_yield(subject, user_id):.2f}")
+
+    def _rate(self, key):
+        acc, total = self._stats.get(key, (0.0, 0.0))
+        return (acc / total, total) if total > 0 else (None, 0.0)
+
+    def expected_yield(self, subject: str, user_id=None) -> float:
+        """
+        Ожидаемая доля годных вопросов: оценка пользователя, сглаженная к
+        оценке предмета пропорционально объёму наблюдений пользователя.
+        """
+        with self._lock:
+            subject_rate, _ = self._rate(subject)
+            user_rate, user_total = self._rate((subject, user_id)) if user_id else (None, 0.0)
+        base = subject_rate if subject_rate is not None else self.prior
+        if user_rate is None:
+            rate = base
+        else:
+            weight = user_total / (user_total + self.user_weight_k)
+            rate = weight * user_rate + (1 - weight) * base
+        return max(self.min_rate, min(1.0, rate))
+
+
+def plan_batch_size(missing: int, expected_yield: float, min_size: int, max_size: int) -> int:
+    """Сколько вопросов запросить, чтобы после отсева получить missing годных."""
+    if missing <= 0:
+        return 0
+    size = math.ceil(missing / max(expected_yield, 1e-3))
+    return max(min_size, min(max_size, size))
+
+
+acceptance = AcceptanceTracker()
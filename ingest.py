@@ -0,0 +1,306 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from semantic_index import CACHE_DIR
+from subjects import SUBJECTS
+
+logger = logging.getLogger(__name__)
+
+# Учебники предмета лежат в <LOCAL_TEXTBOOKS_DIR>/<предмет>/ (или "textbooks_dir" в SUBJECTS)
+LOCAL_TEXTBOOKS_DIR = os.getenv("LOCAL_TEXTBOOKS_DIR", "textbooks")
+try:
+    INGEST_WORKERS = max(1, int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 2))))
+except ValueError:
+    INGEST_WORKERS = os.cpu_count() or 2
+# Фрагменты в словах: длина окна и перекрытие соседних окон внутри страницы
+CHUNK_WORDS = 250
+CHUNK_OVERLAP_WORDS = 50
+# Большие PDF делятся на задачи по столько страниц, чтобы одна книга занимала все процессы
+PAGES_PER_TASK = 40
+
+# Версия формата фрагментов: файлы прошлых версий разбираются заново
+# (2 — печатные номера страниц PDF в page_label)
+INGEST_FORMAT = 2
+
+# Расширение файла -> тип задачи извлечения
+_KINDS = {".pdf": "pdf", ".epub": "epub", ".html": "html", ".htm": "html"}
+
+
+def textbooks_dir(subject: str) -> str:
+    return SUBJECTS.get(subject, {}).get("textbooks_dir") or os.path.join(LOCAL_TEXTBOOKS_DIR, subject)
+
+
+def _subject_ingest_dir(subject: str) -> str:
+    subject_id = hashlib.sha1(subject.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "ingest", subject_id)
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_words(text: str, size: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP_WORDS) -> list[str]:
+    """Окна по size слов с перекрытием overlap; короткий текст — одно окно."""
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, size - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + size]))
+        if start + size >= len(words):
+            break
+    return chunks
+
+
+def _html_text(html) -> str:
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(html, "html.parser").get_text(" ")
+
+
+def _pdf_info(path: str) -> tuple[str | None, int, list | None]:
+    """
+    Название, число страниц и печатные номера страниц (/PageLabels) или None,
+    если их в файле нет: тогда PyPDF2 выдаёт номер страницы в файле, который
+    расходится с напечатанным на величину титульных страниц.
+    """
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    title = None
+    try:
+        title = (reader.metadata or {}).get("/Title")
+    except Exception:
+        pass
+    labels = None
+    try:
+        if "/PageLabels" in reader.trailer["/Root"]:
+            labels = list(reader.page_labels)
+    except Exception as e:
+        logger.debug(f"Could not read page labels of {path}: {e}")
+    return (str(title).strip() or None) if title else None, len(reader.pages), labels
+
+
+def _pdf_pages(path: str, first: int, last: int) -> list[tuple[int, str]]:
+    """Текст страниц first..last (с 1, включительно); выполняется в процессе пула."""
+    from PyPDF2 import PdfReader
+    reader = PdfReader(path)
+    pages = []
+    for number in range(first, min(last, len(reader.pages)) + 1):
+        try:
+            pages.append((number, reader.pages[number - 1].extract_text() or ""))
+        except Exception as e:
+            logger.warning(f"Failed to extract page {number} of {path}: {e}")
+            pages.append((number, ""))
+    return pages
+
+
+def _epub_pages(path: str) -> tuple[str | None, list[tuple[int, str]]]:
+    # В EPUB нет страниц: «страницей» считается документ (глава) в порядке чтения
+    import ebooklib
+    from ebooklib import epub
+    book = epub.read_epub(path)
+    titles = book.get_metadata("DC", "title")
+    title = titles[0][0] if titles else None
+    pages = [(i, _html_text(item.get_content()))
+             for i, item in enumerate(book.get_items_of_type(ebooklib.ITEM_DOCUMENT), start=1)]
+    return title, pages
+
+
+def _html_pages(path: str) -> tuple[str | None, list[tuple[int, str]]]:
+    from bs4 import BeautifulSoup
+    with open(path, "rb") as f:
+        soup = BeautifulSoup(f.read(), "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else None
+    return title or None, [(1, soup.get_text(" "))]
+
+
+def _extract_task(kind: str, path: str, first: int = 0, last: int = 0):
+    """Задача процесса пула: (title или None, [(страница, текст), ...])."""
+    if kind == "pdf":
+        return None, _pdf_pages(path, first, last)
+    if kind == "epub":
+        return _epub_pages(path)
+    return _html_pages(path)
+
+
+def _book_chunks(source: str, title: str, pages: list[tuple[int, str]], labels: list | None = None) -> list[dict]:
+    """Фрагменты книги; page — номер страницы в файле, page_label — напечатанный номер (если известен)."""
+    chunks = []
+    for page, text in sorted(pages):
+        label = labels[page - 1] if labels and page <= len(labels) else None
+        for chunk in chunk_words(text):
+            chunks.append({"source": source, "title": title, "page": page, "page_label": label, "text": chunk})
+    return chunks
+
+
+def printed_page(chunk: dict) -> str:
+    """Номер страницы для ссылки: напечатанный, если известен, иначе номер в файле."""
+    return str(chunk.get("page_label") or chunk["page"])
+
+
+def _remove_chunks(out_dir: str, sha: str):
+    try:
+        os.remove(os.path.join(out_dir, "chunks", f"{sha}.json"))
+    except FileNotFoundError:
+        pass
+
+
+class IngestStats:
+    def __init__(self):
+        self.books = 0
+        self.skipped = 0
+        self.pages = 0
+        self.chunks = 0
+        self.seconds = 0.0
+        # Книги, разобранные с ошибкой (взяты прошлые фрагменты или извлечённые страницы)
+        self.failed: list[str] = []
+
+    @property
+    def pages_per_second(self) -> float:
+        return self.pages / self.seconds if self.seconds > 0 else 0.0
+
+    def __str__(self) -> str:
+        failed = f", {len(self.failed)} failed ({', '.join(self.failed)})" if self.failed else ""
+        return (f"{self.books} books parsed, {self.skipped} unchanged{failed}, {self.pages} pages, {self.chunks} chunks "
+                f"in {self.seconds:.1f}s ({self.pages_per_second:.1f} pages/s)")
+
+
+def ingest_subject(subject: str, workers: int = INGEST_WORKERS, force: bool = False) -> tuple[list[dict], IngestStats]:
+    """
+    Разбирает учебники предмета в фрагменты {source, title, page, text}.
+    Файлы с тем же SHA-256, что в манифесте прошлого запуска, не читаются:
+    их фрагменты берутся из кеша, поэтому правка одной книги разбирает только её.
+    Страницы извлекаются в пуле процессов (большие PDF — частями).
+    """
+    directory = textbooks_dir(subject)
+    out_dir = _subject_ingest_dir(subject)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError, ValueError):
+        manifest = {}
+    stats = IngestStats()
+    started = time.monotonic()
+
+    books = {}  # имя файла -> sha256
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.path.splitext(name)[1].lower() in _KINDS:
+            books[name] = file_sha256(path)
+    changed = [name for name, sha in books.items()
+               if force or manifest.get(name, {}).get("sha256") != sha
+               or manifest.get(name, {}).get("format") != INGEST_FORMAT
+               or not os.path.exists(os.path.join(out_dir, "chunks", f"{sha}.json"))]
+    stats.skipped = len(books) - len(changed)
+    live = set(books.values())
+
+    parsed = {}
+    if changed:
+        # Метаданные PDF (название, число страниц) читаются здесь, чтобы поделить книги на задачи
+        tasks, titles, labels, failed = [], {}, {}, set()
+        for name in changed:
+            path = os.path.join(directory, name)
+            kind = _KINDS[os.path.splitext(name)[1].lower()]
+            if kind == "pdf":
+                try:
+                    titles[name], page_count, labels[name] = _pdf_info(path)
+                except Exception as e:
+                    logger.error(f"Failed to open textbook {name}: {e}")
+                    failed.add(name)
+                    continue
+                for first in range(1, page_count + 1, PAGES_PER_TASK):
+                    tasks.append((name, ("pdf", path, first, first + PAGES_PER_TASK - 1)))
+            else:
+                tasks.append((name, (kind, path)))
+        pages = {name: [] for name, _ in tasks}
+        with ProcessPoolExecutor(max_workers=min(workers, max(1, len(tasks)))) as pool:
+            futures = [(name, pool.submit(_extract_task, *args)) for name, args in tasks]
+            for name, future in futures:
+                try:
+                    title, book_pages = future.result()
+                except Exception as e:
+                    logger.error(f"Failed to extract textbook {name}: {e}")
+                    failed.add(name)
+                    continue
+                if title:
+                    titles[name] = title
+                pages[name].extend(book_pages)
+        os.makedirs(os.path.join(out_dir, "chunks"), exist_ok=True)
+        for name, book_pages in pages.items():
+            if name in failed:
+                continue
+            title = titles.get(name) or os.path.splitext(name)[0]
+            chunks = _book_chunks(name, title, book_pages, labels.get(name))
+            sha = books[name]
+            with open(os.path.join(out_dir, "chunks", f"{sha}.json"), "w", encoding="utf-8") as f:
+                json.dump(chunks, f, ensure_ascii=False)
+            previous_sha = manifest.get(name, {}).get("sha256")
+            if previous_sha and previous_sha != sha and previous_sha not in live:
+                _remove_chunks(out_dir, previous_sha)
+            manifest[name] = {"sha256": sha, "format": INGEST_FORMAT, "title": title,
+                              "pages": len(book_pages), "chunks": len(chunks)}
+            parsed[name] = chunks
+            stats.books += 1
+            stats.pages += len(book_pages)
+            logger.debug(f"Ingested {name}: {len(book_pages)} pages, {len(chunks)} chunks")
+        # Книга с ошибкой не выпадает из поиска: берутся фрагменты прошлого запуска, а если
+        # их нет — извлечённые страницы. Манифест не обновляется, и книга разбирается снова
+        for name in sorted(failed):
+            previous_path = os.path.join(out_dir, "chunks", f"{manifest.get(name, {}).get('sha256')}.json")
+            if name in manifest and os.path.exists(previous_path):
+                with open(previous_path, "r", encoding="utf-8") as f:
+                    parsed[name] = json.load(f)
+                logger.warning(f"Textbook {name} kept from the previous run ({len(parsed[name])} chunks)")
+            elif pages.get(name):
+                title = titles.get(name) or os.path.splitext(name)[0]
+                parsed[name] = _book_chunks(name, title, pages[name], labels.get(name))
+                logger.warning(f"Textbook {name} kept partially: {len(pages[name])} extracted pages")
+        stats.failed = sorted(failed)
+
+    all_chunks = []
+    for name, sha in books.items():
+        if name in parsed:
+            all_chunks.extend(parsed[name])
+        elif name not in changed:
+            with open(os.path.join(out_dir, "chunks", f"{sha}.json"), "r", encoding="utf-8") as f:
+                all_chunks.extend(json.load(f))
+    # Удалённые книги уходят из манифеста вместе с файлами фрагментов
+    for name in [n for n in manifest if n not in books]:
+        sha = manifest.pop(name).get("sha256")
+        if sha not in live:
+            _remove_chunks(out_dir, sha)
+    os.makedirs(out_dir, exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+    stats.chunks = len(all_chunks)
+    stats.seconds = time.monotonic() - started
+    logger.info(f"Ingested subject '{subject}': {stats}")
+    return all_chunks, stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from log_setup import configure_logging
+
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Разбор учебников (PDF/EPUB/HTML) во фрагменты со страницами")
+    parser.add_argument("--subject", action="append", help="Предмет (по умолчанию все с каталогом учебников)")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--force", action="store_true", help="Разобрать заново даже неизменённые файлы")
+    args = parser.parse_args()
+    for name in args.subject or [s for s in SUBJECTS if os.path.isdir(textbooks_dir(s))]:
+        _, subject_stats = ingest_subject(name, workers=args.workers, force=args.force)
+        print(f"{name}: {subject_stats}")
@@ -0,0 +1,72 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class JsonObjectStream:
+    """
+    Инкрементальный разбор JSON-ответа модели: по мере поступления текста
+    возвращает объекты, которые являются элементами массива
+    (например, вопросы из "[{...}, {...}]" или {"questions": [{...}]}).
+
+    Текст вне JSON (```json и т.п.) игнорируется, незавершённый последний
+    объект отбрасывается, а некорректный объект пропускается без потери
+    остальных.
+    """
+
+    def __init__(self):
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escape = False
+        self._capturing = False
+        self._capture_depth = 0
+        self._buf: list[str] = []
+        self.emitted = 0
+        self.malformed = 0
+
+    def feed(self, chunk: str) -> list[dict]:
+        objects: list[dict] = []
+        for ch in chunk or "":
+            if self._capturing:
+                self._buf.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                continue
+            if ch == '"':
+                # Строки вне JSON-контейнеров (обычный текст) не отслеживаем
+                if self._stack:
+                    self._in_string = True
+            elif ch == "[" or ch == "{":
+                if ch == "{" and not self._capturing and self._stack and self._stack[-1] == "[":
+                    self._capturing = True
+                    self._capture_depth = len(self._stack)
+                    self._buf = ["{"]
+                self._stack.append(ch)
+            elif ch == "]" or ch == "}":
+                if self._stack:
+                    self._stack.pop()
+                if self._capturing and ch == "}" and len(self._stack) == self._capture_depth:
+                    self._capturing = False
+                    text = "".join(self._buf)
+                    self._buf = []
+                    try:
+                        obj = json.loads(text)
+                    except json.JSONDecodeError as e:
+                        self.malformed += 1
+                        logger.debug(f"Skipping malformed JSON object: {e}")
+                        continue
+                    if isinstance(obj, dict):
+                        self.emitted += 1
+                        objects.append(obj)
+        return objects
+
+    @property
+    def pending(self) -> bool:
+        """True, если последний объект ещё не закрыт (ответ оборван)."""
+        return self._capturing
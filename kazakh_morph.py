@@ -0,0 +1,201 @@
+import logging
+import os
+import re
+import time
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Нормализация казахских словоформ отсечением окончаний ("абайдың", "абайға" -> "абай").
+# Только для поиска (термины BM25, отпечатки почти повторов): падеж несёт смысл
+# ("Абайға кім әсер етті" и "Абай кімге әсер етті" дают одни основы), поэтому
+# для ключей, по которым выдаются готовые ответы, основы не используются.
+#   KAZAKH_STEMMING_ENABLED=0      — слова не изменяются
+#   KAZAKH_STEM_CACHE_SIZE=65536   — размер LRU-кеша основ
+KAZAKH_STEMMING_ENABLED = os.getenv("KAZAKH_STEMMING_ENABLED", "1").strip() not in ("0", "false", "False", "")
+try:
+    KAZAKH_STEM_CACHE_SIZE = max(0, int(os.getenv("KAZAKH_STEM_CACHE_SIZE", "65536")))
+except ValueError:
+    KAZAKH_STEM_CACHE_SIZE = 65536
+# Версия правил: входит в сохранённые индексы, чтобы после правки правил они перестраивались
+STEMMER_VERSION = 1
+# Основа короче не оставляется
+MIN_STEM_CHARS = 2
+
+VOWELS = frozenset("аәеиоөұүуыіэюяё")
+VOICELESS = frozenset("кқпстфхцчшщ")
+# Звонкие согласные и сонорные (всё, что не гласная и не глухая)
+VOICED = frozenset("бвгғджзйлмнңрһ")
+_AFTER_POSSESSIVE = frozenset("ыі")
+
+# Окончания по слоям, от конца слова: падеж, притяжательность, множественное число.
+# Для каждого алломорфа — множество букв, после которых он возможен
+# (гармония согласных), поэтому "мектепке" режется, а "астана" — нет.
+_CASE_SUFFIXES = [
+    # родительный
+    ("ның", VOWELS | frozenset("мнң")), ("нің", VOWELS | frozenset("мнң")),
+    ("дың", VOICED), ("дің", VOICED), ("тың", VOICELESS), ("тің", VOICELESS),
+    # винительный
+    ("ны", VOWELS), ("ні", VOWELS), ("ды", VOICED), ("ді", VOICED), ("ты", VOICELESS), ("ті", VOICELESS),
+    # дательный ("на"/"не" — после притяжательного "ы"/"і": "атына")
+    ("ға", VOWELS | VOICED), ("ге", VOWELS | VOICED), ("қа", VOICELESS), ("ке", VOICELESS),
+    ("на", _AFTER_POSSESSIVE), ("не", _AFTER_POSSESSIVE),
+    # местный
+    ("да", VOWELS | VOICED), ("де", VOWELS | VOICED), ("та", VOICELESS), ("те", VOICELESS),
+    ("нда", _AFTER_POSSESSIVE), ("нде", _AFTER_POSSESSIVE),
+    # исходный
+    ("дан", VOWELS | VOICED), ("ден", VOWELS | VOICED), ("тан", VOICELESS), ("тен", VOICELESS),
+    ("нан", _AFTER_POSSESSIVE | frozenset("мнң")), ("нен", _AFTER_POSSESSIVE | frozenset("мнң")),
+    # творительный
+    ("мен", VOWELS | VOICED), ("бен", VOICED), ("пен", VOICELESS), ("менен", VOWELS | VOICED),
+]
+# Притяжательные окончания 3-го лица и 1-го/2-го лица множественного числа;
+# "ым"/"ім"/"м" не отсекаются: слишком много основ так кончается ("ғылым", "әлем")
+_POSSESSIVE_SUFFIXES = [
+    ("сы", VOWELS), ("сі", VOWELS), ("ы", VOICED | VOICELESS), ("і", VOICED | VOICELESS),
+    ("ымыз", VOICED | VOICELESS), ("іміз", VOICED | VOICELESS), ("мыз", VOWELS), ("міз", VOWELS),
+    ("ыңыз", VOICED | VOICELESS), ("іңіз", VOICED | VOICELESS), ("ңыз", VOWELS), ("ңіз", VOWELS),
+    ("ың", VOICED | VOICELESS), ("ің", VOICED | VOICELESS),
+]
+_PLURAL_SUFFIXES = [
+    ("лар", VOWELS | frozenset("руй")), ("лер", VOWELS | frozenset("руй")),
+    ("дар", VOICED), ("дер", VOICED), ("тар", VOICELESS), ("тер", VOICELESS),
+]
+# Основа, изменённая перед гласной, возвращается к словарной форме: "кітабы" -> "кітап"
+_FINAL_DEVOICING = str.maketrans({"б": "п", "г": "к", "ғ": "қ"})
+# Слова, конец которых совпадает с окончанием, но входит в корень
+EXCEPTIONS = frozenset({
+    "қазақстан", "өзбекстан", "қырғызстан", "түрікменстан", "тәжікстан", "ауғанстан", "пәкістан",
+    "түркістан", "дағыстан", "үндістан", "қымыз", "мен", "сен", "біз", "сіз", "ана", "қала",
+})
+_PROTECTED_ENDINGS = ("стан",)
+
+_WORD_RE = re.compile(r"\w+")
+_CYRILLIC_RE = re.compile(r"[Ѐ-ӿ]")
+
+
+def _compile_layer(suffixes) -> list[tuple[int, dict]]:
+    """Таблица слоя: длины окончаний по убыванию -> {окончание: допустимые предыдущие буквы}."""
+    by_length: dict = {}
+    for suffix, allowed in suffixes:
+        by_length.setdefault(len(suffix), {})[suffix] = allowed
+    return sorted(by_length.items(), reverse=True)
+
+
+_LAYERS = [_compile_layer(layer) for layer in (_CASE_SUFFIXES, _POSSESSIVE_SUFFIXES, _PLURAL_SUFFIXES)]
+
+
+def _strip_layer(word: str, table) -> str:
+    # Самое длинное окончание слоя, после отсечения которого остаётся допустимая основа
+    for length, suffixes in table:
+        if len(word) - length < MIN_STEM_CHARS:
+            continue
+        allowed = suffixes.get(word[-length:])
+        if allowed is not None and word[-length - 1] in allowed and any(c in VOWELS for c in word[:-length]):
+            return word[:-length]
+    return word
+
+
+def _stem(word: str) -> str:
+    if word in EXCEPTIONS or word.endswith(_PROTECTED_ENDINGS) or not _CYRILLIC_RE.search(word):
+        return word
+    stem = word
+    for table in _LAYERS:
+        stem = _strip_layer(stem, table)
+    # Притяжательное "ы"/"і" неотличимо от конечной гласной основы ("оқушы" / "оқушысы"),
+    # поэтому она отсекается всегда, и все формы сводятся к одной основе
+    if stem[-1] in _AFTER_POSSESSIVE and len(stem) > MIN_STEM_CHARS and stem[-2] not in VOWELS:
+        stem = stem[:-1]
+    if stem != word:
+        stem = stem[:-1] + stem[-1].translate(_FINAL_DEVOICING)
+    return stem
+
+
+_cached_stem = lru_cache(maxsize=KAZAKH_STEM_CACHE_SIZE)(_stem)
+
+
+def stem(word: str) -> str:
+    """
+    Основа казахского слова (ожидается в нижнем регистре) по таблицам
+    окончаний падежа, притяжательности и множественного числа. Не
+    кириллические слова и исключения возвращаются без изменений.
+    """
+    if not KAZAKH_STEMMING_ENABLED or not word:
+        return word
+    return _cached_stem(word)
+
+
+def stem_text(normalized_text: str) -> str:
+    """Основы всех слов уже нормализованного текста (слова через пробел)."""
+    return " ".join(stem(word) for word in (normalized_text or "").split())
+
+
+def cache_info():
+    return _cached_stem.cache_info()
+
+
+# Золотой набор: словоформа -> ожидаемая основа
+GOLD = {
+    "абай": "абай", "абайдың": "абай", "абайға": "абай", "абайды": "абай", "абаймен": "абай", "абайдан": "абай",
+    "мектеп": "мектеп", "мектепке": "мектеп", "мектепте": "мектеп", "мектептен": "мектеп", "мектебі": "мектеп",
+    "мектептер": "мектеп", "мектептерде": "мектеп", "мектебіміз": "мектеп",
+    "кітап": "кітап", "кітабы": "кітап", "кітаптар": "кітап", "кітаптың": "кітап", "кітабыңыз": "кітап",
+    "жыл": "жыл", "жылы": "жыл", "жылдары": "жыл", "жылдан": "жыл", "жылға": "жыл",
+    "бала": "бала", "балаға": "бала", "балалар": "бала", "балаларға": "бала", "баланың": "бала",
+    "сабақ": "сабақ", "сабағы": "сабақ", "сабақтан": "сабақ", "сабақтары": "сабақ",
+    "оқушы": "оқуш", "оқушылар": "оқуш", "оқушыларға": "оқуш", "оқушысы": "оқуш", "оқушыны": "оқуш",
+    "ел": "ел", "елі": "ел", "еліміз": "ел", "елде": "ел", "елдің": "ел",
+    "тарих": "тарих", "тарихы": "тарих", "тарихта": "тарих", "тарихтың": "тарих",
+    "ат": "ат", "аты": "ат", "атына": "ат", "атының": "ат", "атында": "ат",
+    "тіл": "тіл", "тілі": "тіл", "тілдер": "тіл", "тілінде": "тіл",
+    "қазақстан": "қазақстан", "түркістан": "түркістан", "астана": "астана", "қала": "қала",
+    "ғылым": "ғылым", "әлем": "әлем", "мен": "мен", "су": "су", "hello": "hello", "1945": "1945",
+}
+
+
+def check_gold() -> list[tuple[str, str, str]]:
+    """Расхождения с GOLD: (словоформа, ожидалось, получено)."""
+    return [(word, expected, _stem(word)) for word, expected in GOLD.items() if _stem(word) != expected]
+
+
+def benchmark(words: list[str], repeat: int = 3) -> dict:
+    """Слов в секунду без кеша (правила) и с прогретым LRU-кешем."""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for word in words:
+            _stem(word)
+    uncached = len(words) * repeat / (time.perf_counter() - started)
+    _cached_stem.cache_clear()
+    for word in words:
+        _cached_stem(word)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for word in words:
+            _cached_stem(word)
+    cached = len(words) * repeat / (time.perf_counter() - started)
+    return {"words": len(words), "distinct": len(set(words)), "uncached_wps": uncached, "cached_wps": cached}
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="Проверка золотого набора и скорость нормализации казахских слов")
+    parser.add_argument("--subject", help="Слова из разобранных учебников предмета (ingest.py) вместо золотого набора")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = check_gold()
+    for word, expected, got in failures:
+        print(f"gold mismatch: {word} -> {got} (expected {expected})")
+    print(f"gold: {len(GOLD) - len(failures)}/{len(GOLD)} correct")
+    if args.subject:
+        from ingest import ingest_subject
+        chunks, _ = ingest_subject(args.subject)
+        corpus = [w for chunk in chunks for w in _WORD_RE.findall(chunk["text"].casefold())]
+    else:
+        corpus = list(GOLD) * 2000
+    result = benchmark(corpus, repeat=args.repeat)
+    print(f"{result['words']} words ({result['distinct']} distinct): "
+          f"{result['uncached_wps']:,.0f} words/s rules, {result['cached_wps']:,.0f} words/s LRU-cached")
+    sys.exit(1 if failures else 0)
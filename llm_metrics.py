@@ -0,0 +1,303 @@
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from openai_scheduler import RUN_ESTIMATED_TOKENS, call_openai
+
+logger = logging.getLogger(__name__)
+
+# Локальное хранилище метрик (вне git, рядом с остальными кешами)
+METRICS_DB_PATH = os.getenv("LLM_METRICS_DB", os.path.join(os.getenv("UBT_CACHE_DIR", ".cache"), "llm_metrics.sqlite3"))
+METRICS_ENABLED = os.getenv("LLM_METRICS_ENABLED", "1").strip() not in ("0", "false", "False", "")
+
+# Цены в долларах за 1M токенов: (вход, кешированный вход, выход).
+# Переопределяются через LLM_PRICES_JSON='{"gpt-5": [1.25, 0.125, 10]}'.
+MODEL_PRICES = {
+    "gpt-5": (1.25, 0.125, 10.0),
+    "gpt-4o": (2.5, 1.25, 10.0),
+    "gpt-4o-mini": (0.15, 0.075, 0.6),
+    "text-embedding-3-small": (0.02, 0.02, 0.0),
+}
+try:
+    MODEL_PRICES.update({k: tuple(v) for k, v in json.loads(os.getenv("LLM_PRICES_JSON", "{}")).items()})
+except (ValueError, TypeError, AttributeError):
+    logger.warning("Invalid LLM_PRICES_JSON, using default prices")
+
+_context: contextvars.ContextVar = contextvars.ContextVar("llm_metrics_context", default={})
+
+
+@contextmanager
+def metrics_context(**tags):
+    """
+    Теги (user_id, subject, session_id), которые добавляются ко всем вызовам
+    внутри блока. Для фоновых потоков контекст задаётся в самом потоке.
+    """
+    token = _context.set({**_context.get(), **{k: v for k, v in tags.items() if v is not None}})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def _streamlit_tags() -> dict:
+    """session_id и user_id текущей сессии Streamlit (только в потоке скрипта)."""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx(suppress_warning=True)
+        if ctx is None:
+            return {}
+        import streamlit as st
+        return {"session_id": ctx.session_id, "user_id": st.session_state.get("user_id")}
+    except Exception:
+        return {}
+
+
+def current_tags() -> dict:
+    """Теги текущего контекста, дополненные сведениями о сессии Streamlit."""
+    return {**{k: v for k, v in _streamlit_tags().items() if v is not None}, **_context.get()}
+
+
+def bind_context(fn):
+    """
+    Оборачивает функцию для запуска в пуле потоков так, чтобы её вызовы
+    OpenAI получили теги потока, в котором она была передана в пул.
+    """
+    tags = current_tags()
+
+    def wrapper(*args, **kwargs):
+        with metrics_context(**tags):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+def estimate_cost(model: str, prompt_tokens: int, cached_tokens: int, completion_tokens: int) -> float:
+    prices = MODEL_PRICES.get(model or "")
+    if prices is None:
+        # Версии моделей с датой (gpt-4o-2024-08-06) считаем по базовой модели
+        prices = next((p for name, p in MODEL_PRICES.items() if (model or "").startswith(name + "-")), None)
+    if prices is None:
+        return 0.0
+    input_price, cached_price, output_price = prices
+    uncached = max(0, prompt_tokens - cached_tokens)
+    return (uncached * input_price + cached_tokens * cached_price + completion_tokens * output_price) / 1_000_000
+
+
+class CallMetrics:
+    """Метрики одного логического вызова OpenAI (вместе с его повторами)."""
+
+    def __init__(self, call_site: str, model=None, subject=None, user_id=None, session_id=None):
+        self.call_site = call_site
+        self.model = model
+        self.subject = subject
+        self.user_id = user_id
+        self.session_id = session_id
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.queue_wait = 0.0
+        self.retries = 0
+        self.outcome = "ok"
+        self.wall_time = 0.0
+
+    def add_usage(self, usage):
+        """Учитывает usage ответа: chat completions, run ассистента или эмбеддинги."""
+        if usage is None:
+            return
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.cached_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def add_run(self, run):
+        """Usage и время ожидания в очереди (queued) для run ассистента."""
+        self.add_usage(getattr(run, "usage", None))
+        created_at = getattr(run, "created_at", None)
+        started_at = getattr(run, "started_at", None)
+        if created_at and started_at:
+            self.queue_wait += max(0, started_at - created_at)
+        if self.model is None:
+            self.model = getattr(run, "model", None)
+
+    def add_queue_wait(self, seconds: float):
+        self.queue_wait += max(0.0, seconds)
+
+    def retry(self):
+        self.retries += 1
+
+    @property
+    def cost(self) -> float:
+        return estimate_cost(self.model, self.prompt_tokens, self.cached_tokens, self.completion_tokens)
+
+
+class MetricsStore:
+    """
+    SQLite-хранилище записей о вызовах. Таблицу можно читать напрямую
+    (sqlite3 .cache/llm_metrics.sqlite3) или через summarize().
+    """
+
+    def __init__(self, path: str = METRICS_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_calls (
+                    ts REAL NOT NULL,
+                    day TEXT NOT NULL,
+                    session_id TEXT,
+                    user_id TEXT,
+                    call_site TEXT NOT NULL,
+                    model TEXT,
+                    subject TEXT,
+                    prompt_tokens INTEGER NOT NULL,
+                    cached_tokens INTEGER NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    wall_ms REAL NOT NULL,
+                    queue_wait_ms REAL NOT NULL,
+                    retries INTEGER NOT NULL,
+                    outcome TEXT NOT NULL,
+                    cost_usd REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_calls_day_idx ON llm_calls (day, call_site)")
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_calls_session_idx ON llm_calls (session_id)")
+            self._conn = conn
+        return self._conn
+
+    def record(self, m: CallMetrics):
+        now = time.time()
+        row = (
+            now, datetime.fromtimestamp(now, timezone.utc).strftime("%Y-%m-%d"),
+            m.session_id, str(m.user_id) if m.user_id else None, m.call_site, m.model, m.subject,
+            m.prompt_tokens, m.cached_tokens, m.completion_tokens,
+            m.wall_time * 1000, m.queue_wait * 1000, m.retries, m.outcome, m.cost,
+        )
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute("INSERT INTO llm_calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Failed to record LLM call metrics: {e}")
+
+    def summarize(self, by: str = "day", since_day: str = None, session_id: str = None) -> list[dict]:
+        """
+        Агрегаты по (day | session_id, call_site): число вызовов, ошибки,
+        повторы, токены, стоимость, среднее и максимальное время.
+        """
+        group = {"day": "day", "session": "session_id"}[by]
+        where, params = [], []
+        if since_day:
+            where.append("day >= ?")
+            params.append(since_day)
+        if session_id:
+            where.append("session_id = ?")
+            params.append(session_id)
+        sql = f"""
+            SELECT {group} AS grp, call_site, COUNT(*) AS calls,
+                   SUM(outcome != 'ok') AS failures, SUM(retries) AS retries,
+                   SUM(prompt_tokens) AS prompt_tokens, SUM(cached_tokens) AS cached_tokens,
+                   SUM(completion_tokens) AS completion_tokens, SUM(cost_usd) AS cost_usd,
+                   AVG(wall_ms) AS avg_wall_ms, MAX(wall_ms) AS max_wall_ms, AVG(queue_wait_ms) AS avg_queue_wait_ms
+            FROM llm_calls
+            {"WHERE " + " AND ".join(where) if where else ""}
+            GROUP BY grp, call_site
+            ORDER BY grp DESC, cost_usd DESC
+        """
+        with self._lock:
+            cursor = self._connect().execute(sql, params)
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+store = MetricsStore()
+
+
+@contextmanager
+def track_call(call_site: str, model=None, subject=None, user_id=None):
+    """
+    Оборачивает вызов OpenAI: внутри блока вызывающий код передаёт usage
+    (m.add_usage / m.add_run) и отмечает повторы (m.retry()); время, исход и
+    теги из metrics_context записываются при выходе. Исключение, вышедшее из
+    блока, записывается как исход с именем его класса.
+    """
+    tags = current_tags()
+    m = CallMetrics(
+        call_site,
+        model=model,
+        subject=subject if subject is not None else tags.get("subject"),
+        user_id=user_id if user_id is not None else tags.get("user_id"),
+        session_id=tags.get("session_id"),
+    )
+    started = time.perf_counter()
+    try:
+        yield m
+    except GeneratorExit:
+        # Потребитель потокового генератора закрыл его досрочно
+        if m.outcome == "ok":
+            m.outcome = "closed"
+        raise
+    except BaseException as e:
+        if m.outcome == "ok":
+            m.outcome = type(e).__name__
+        raise
+    finally:
+        m.wall_time = time.perf_counter() - started
+        if METRICS_ENABLED:
+            store.record(m)
+        logger.debug(f"LLM call {call_site}: {m.outcome}, {m.wall_time:.2f}s, "
+                     f"tokens {m.prompt_tokens}/{m.completion_tokens} (cached {m.cached_tokens}), retries {m.retries}")
+
+
+def _wait_run(m: CallMetrics, client, thread_id, assistant_id, poll_interval, on_wait, run_kwargs):
+    run = call_openai(client.beta.threads.runs, "create", metrics=m, on_wait=on_wait,
+                      est_tokens=RUN_ESTIMATED_TOKENS, thread_id=thread_id, assistant_id=assistant_id, **run_kwargs)
+    while run.status in ["queued", "in_progress"]:
+        time.sleep(poll_interval)
+        run = call_openai(client.beta.threads.runs, "retrieve", metrics=m, thread_id=thread_id, run_id=run.id)
+    m.add_run(run)
+    if run.status != "completed":
+        m.outcome = run.status
+    return run
+
+
+def tracked_run(client, call_site: str, thread_id: str, assistant_id: str, poll_interval: float = 2,
+                subject=None, metrics: CallMetrics = None, on_wait=None, **run_kwargs):
+    """
+    Создаёт run ассистента, ждёт его завершения опросом и записывает usage,
+    время ожидания в очереди и итоговый статус. Возвращает последний run.
+    Запросы идут через планировщик лимитов (on_wait — позиция в очереди для UI).
+    Если передан metrics (вызов с повторами уже обёрнут в track_call),
+    данные добавляются в него, а отдельная запись не создаётся.
+    """
+    if metrics is not None:
+        return _wait_run(metrics, client, thread_id, assistant_id, poll_interval, on_wait, run_kwargs)
+    with track_call(call_site, subject=subject) as m:
+        return _wait_run(m, client, thread_id, assistant_id, poll_interval, on_wait, run_kwargs)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Сводка по вызовам OpenAI из локального хранилища метрик")
+    parser.add_argument("--by", choices=["day", "session"], default="day")
+    parser.add_argument("--since", help="Начиная с дня YYYY-MM-DD")
+    parser.add_argument("--session", help="Только указанная сессия")
+    args = parser.parse_args()
+    for row in store.summarize(by=args.by, since_day=args.since, session_id=args.session):
+        print(f"{row['grp']}\t{row['call_site']:<28} calls={row['calls']:<5} fail={row['failures']:<3} "
+              f"retries={row['retries']:<3} in={row['prompt_tokens']} cached={row['cached_tokens']} "
+              f"out={row['completion_tokens']} cost=${row['cost_usd']:.4f} "
+              f"avg={row['avg_wall_ms']:.0f}ms max={row['max_wall_ms']:.0f}ms queue={row['avg_queue_wait_ms']:.0f}ms")
@@ -0,0 +1,463 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from ingest import ingest_subject, printed_page, textbooks_dir
+from kazakh_morph import STEMMER_VERSION, stem
+from llm_metrics import track_call
+from openai_scheduler import call_openai, estimate_request_tokens
+from semantic_index import CACHE_DIR, EMBEDDING_DIMENSIONS, embed_texts
+from subjects import SUBJECTS
+from vector_store import QuantizedIVFStore
+
+logger = logging.getLogger(__name__)
+
+# Локальный поиск по учебникам вместо удалённого file_search:
+#   LOCAL_RETRIEVAL_SUBJECTS="Химия,..."  — предметы с локальным поиском (или "retrieval": "local" в SUBJECTS)
+#   учебники разбираются ingest.py (LOCAL_TEXTBOOKS_DIR/<предмет>/)
+#   LOCAL_RETRIEVAL_TOP_K, LOCAL_RETRIEVAL_MODEL
+LOCAL_RETRIEVAL_SUBJECTS = {s.strip() for s in os.getenv("LOCAL_RETRIEVAL_SUBJECTS", "").split(",") if s.strip()}
+LOCAL_RETRIEVAL_MODEL = os.getenv("LOCAL_RETRIEVAL_MODEL", "gpt-5")
+try:
+    LOCAL_RETRIEVAL_TOP_K = max(1, int(os.getenv("LOCAL_RETRIEVAL_TOP_K", "6")))
+except ValueError:
+    LOCAL_RETRIEVAL_TOP_K = 6
+# Кандидатов от каждого метода перед слиянием рангов
+CANDIDATES_PER_METHOD = 50
+# Параметры BM25 и сглаживание reciprocal rank fusion
+BM25_K1 = 1.5
+BM25_B = 0.75
+RRF_K = 60
+EMBED_BATCH_SIZE = 256
+
+_TOKEN_RE = re.compile(r"\w+")
+_CITE_RE = re.compile(r"\[(\d+)\]")
+
+LOCAL_ANSWER_SYSTEM_PROMPT = """
+Сен қазақ мектебінің оқушыларына ҰБТ-ға дайындалуға көмектесетін ассистентсің.
+Тек төмендегі нөмірленген үзінділердегі ақпаратты қолдан, сыртқы мәліметтерді қоспа.
+Әр тұжырымнан кейін дереккөз үзіндісінің нөмірін төртбұрышты жақшада көрсет, мысалы [2].
+Егер үзінділерде жауап жоқ болса, мұны ашық айт.
+"""
+
+
+def tokenize(text: str) -> list[str]:
+    """Основы слов текста для BM25: casefold, без пунктуации и однобуквенных токенов."""
+    return [stem(t) for t in _TOKEN_RE.findall((text or "").casefold()) if len(t) > 1]
+
+
+def uses_local_retrieval(subject: str) -> bool:
+    if subject in LOCAL_RETRIEVAL_SUBJECTS:
+        return True
+    return SUBJECTS.get(subject, {}).get("retrieval") == "local"
+
+
+def _subject_index_dir(subject: str) -> str:
+    subject_id = hashlib.sha1(subject.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, "local_index", subject_id)
+
+
+class BM25Index:
+    """
+    BM25 в виде CSR по терминам: для каждого термина — массивы документов и
+    готовых весов (idf с нормировкой длины), поэтому запрос — это один
+    np.bincount по срезам терминов запроса.
+    """
+
+    def __init__(self, vocab: dict, offsets: np.ndarray, doc_ids: np.ndarray, weights: np.ndarray, n_docs: int):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.weights = weights
+        self.n_docs = n_docs
+
+    @classmethod
+    def build(cls, docs: list[list[str]], k1: float = BM25_K1, b: float = BM25_B) -> "BM25Index":
+        vocab: dict = {}
+        term_ids, doc_ids, tfs = [], [], []
+        lengths = np.zeros(len(docs), dtype=np.float32)
+        for d, tokens in enumerate(docs):
+            lengths[d] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(term, len(vocab)))
+                doc_ids.append(d)
+                tfs.append(tf)
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        doc_ids = np.asarray(doc_ids, dtype=np.int32)
+        tfs = np.asarray(tfs, dtype=np.float32)
+        n_docs = len(docs)
+        df = np.bincount(term_ids, minlength=len(vocab)).astype(np.float32)
+        idf = np.log1p((n_docs - df + 0.5) / (df + 0.5))
+        avgdl = float(lengths.mean()) if n_docs else 1.0
+        norm = k1 * (1 - b + b * lengths[doc_ids] / max(avgdl, 1e-6))
+        weights = idf[term_ids] * tfs * (k1 + 1) / (tfs + norm)
+        order = np.argsort(term_ids, kind="stable")
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(df.astype(np.int64), out=offsets[1:])
+        return cls(vocab, offsets, doc_ids[order], weights[order].astype(np.float32), n_docs)
+
+    def scores(self, tokens: list[str]) -> np.ndarray:
+        ids = [self.vocab[t] for t in tokens if t in self.vocab]
+        if not ids:
+            return np.zeros(self.n_docs, dtype=np.float32)
+        slices = [np.arange(self.offsets[t], self.offsets[t + 1]) for t in ids]
+        idx = np.concatenate(slices)
+        return np.bincount(self.doc_ids[idx], weights=self.weights[idx], minlength=self.n_docs).astype(np.float32)
+
+    def save(self, path: str):
+        np.savez(path, offsets=self.offsets, doc_ids=self.doc_ids, weights=self.weights, n_docs=self.n_docs,
+                 stemmer_version=STEMMER_VERSION)
+        with open(f"{path}.vocab.json", "w", encoding="utf-8") as f:
+            json.dump(list(self.vocab), f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        data = np.load(f"{path}.npz")
+        if (int(data["stemmer_version"]) if "stemmer_version" in data else 0) != STEMMER_VERSION:
+            raise ValueError("BM25 terms were built by another stemmer version")
+        with open(f"{path}.vocab.json", "r", encoding="utf-8") as f:
+            vocab = {term: i for i, term in enumerate(json.load(f))}
+        return cls(vocab, data["offsets"], data["doc_ids"], data["weights"], int(data["n_docs"]))
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Индексы k лучших по убыванию (argpartition вместо полной сортировки)."""
+    k = min(k, scores.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    part = np.argpartition(-scores, k - 1)[:k]
+    return part[np.argsort(-scores[part], kind="stable")]
+
+
+class SubjectIndex:
+    """
+    Фрагменты учебников предмета с BM25 и эмбеддингами (строки L2-нормированы).
+    Эмбеддинги сохранённого индекса лежат в QuantizedIVFStore (int8, memmap);
+    float32-матрица vectors есть только у только что построенного индекса.
+    """
+
+    def __init__(self, subject: str, passages: list[dict], bm25: BM25Index, vectors: np.ndarray | None,
+                 store: QuantizedIVFStore = None):
+        self.subject = subject
+        self.passages = passages
+        self.bm25 = bm25
+        self.vectors = vectors
+        self.store = store
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    @classmethod
+    def build(cls, client, subject: str, passages: list[dict], with_vectors: bool = True,
+              previous: "SubjectIndex" = None) -> "SubjectIndex":
+        """
+        Строит индекс; эмбеддинги фрагментов, текст которых уже был в
+        previous, переиспользуются, запрашиваются только новые.
+        """
+        bm25 = BM25Index.build([tokenize(p["text"]) for p in passages])
+        vectors = None
+        if with_vectors and passages:
+            known = {}
+            if previous is not None and previous.store is not None:
+                known = {_text_key(p["text"]): i for i, p in enumerate(previous.passages)}
+            vectors = np.zeros((len(passages), EMBEDDING_DIMENSIONS), dtype=np.float32)
+            missing, reused, reused_rows = [], [], []
+            for i, p in enumerate(passages):
+                row = known.get(_text_key(p["text"]))
+                if row is None:
+                    missing.append(i)
+                else:
+                    reused.append(i)
+                    reused_rows.append(row)
+            if reused:
+                # Из int8-кодов восстанавливаются приближённые векторы; их точности хватает для IVF
+                reused_vectors = previous.store.reconstruct(reused_rows)
+                norms = np.linalg.norm(reused_vectors, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                vectors[reused] = reused_vectors / norms
+            for start in range(0, len(missing), EMBED_BATCH_SIZE):
+                batch = missing[start:start + EMBED_BATCH_SIZE]
+                vectors[batch] = embed_texts(client, [passages[i]["text"] for i in batch])
+            logger.info(f"Embedded {len(missing)} new passages for subject '{subject}', "
+                        f"reused {len(passages) - len(missing)}")
+        return cls(subject, passages, bm25, vectors)
+
+    def save(self, directory: str = None):
+        directory = directory or _subject_index_dir(self.subject)
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, "passages.json"), "w", encoding="utf-8") as f:
+            json.dump(self.passages, f, ensure_ascii=False)
+        self.bm25.save(os.path.join(directory, "bm25"))
+        vectors_dir = os.path.join(directory, f"vectors.{EMBEDDING_DIMENSIONS}")
+        if self.vectors is not None:
+            # Новые файлы пишутся рядом и подменяют старые: процессы, у которых
+            # открыт memmap прежней версии, продолжают читать её до перезагрузки
+            tmp_dir = f"{vectors_dir}.tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            QuantizedIVFStore.build(tmp_dir, self.vectors)
+            shutil.rmtree(vectors_dir, ignore_errors=True)
+            os.replace(tmp_dir, vectors_dir)
+            self.store = QuantizedIVFStore(vectors_dir)
+            self.vectors = None
+        elif os.path.exists(vectors_dir):
+            shutil.rmtree(vectors_dir)
+
+    @classmethod
+    def load(cls, subject: str, directory: str = None) -> "SubjectIndex":
+        directory = directory or _subject_index_dir(subject)
+        with open(os.path.join(directory, "passages.json"), "r", encoding="utf-8") as f:
+            passages = json.load(f)
+        try:
+            bm25 = BM25Index.load(os.path.join(directory, "bm25"))
+        except ValueError as e:
+            # Термины BM25 зависят от правил kazakh_morph: индекс перестраивается по фрагментам без сети
+            logger.info(f"Rebuilding BM25 terms of local index for subject '{subject}': {e}")
+            bm25 = BM25Index.build([tokenize(p["text"]) for p in passages])
+            bm25.save(os.path.join(directory, "bm25"))
+        store = None
+        vectors_dir = os.path.join(directory, f"vectors.{EMBEDDING_DIMENSIONS}")
+        if os.path.exists(os.path.join(vectors_dir, "meta.json")):
+            store = QuantizedIVFStore(vectors_dir)
+            if len(store) != len(passages):
+                logger.warning(f"Vector count mismatch in local index for subject '{subject}', using BM25 only")
+                store = None
+        return cls(subject, passages, bm25, None, store=store)
+
+    def search(self, client, query: str, k: int = LOCAL_RETRIEVAL_TOP_K) -> list[tuple[dict, float]]:
+        """
+        Гибридный поиск: кандидаты BM25 и косинусного сходства сливаются
+        через reciprocal rank fusion. Без эмбеддингов (или при ошибке
+        запроса эмбеддинга) используется только BM25.
+        """
+        if not self.passages:
+            return []
+        fused = Counter()
+        bm25_scores = self.bm25.scores(tokenize(query))
+        for rank, i in enumerate(_top(bm25_scores, CANDIDATES_PER_METHOD)):
+            if bm25_scores[i] > 0:
+                fused[int(i)] += 1.0 / (RRF_K + rank + 1)
+        if (self.store is not None or self.vectors is not None) and client is not None:
+            try:
+                query_vector = embed_texts(client, [query])[0]
+                if self.store is not None:
+                    dense_top, _ = self.store.search(query_vector, CANDIDATES_PER_METHOD)
+                else:
+                    dense_top = _top(self.vectors @ query_vector, CANDIDATES_PER_METHOD)
+                for rank, i in enumerate(dense_top):
+                    fused[int(i)] += 1.0 / (RRF_K + rank + 1)
+            except Exception as e:
+                logger.debug(f"Dense retrieval skipped: {e}")
+        return [(self.passages[i], score) for i, score in fused.most_common(k)]
+
+
+_indexes: dict = {}
+_indexes_lock = threading.Lock()
+
+
+def get_subject_index(subject: str):
+    """Индекс предмета с диска (один раз на процесс); None, если он ещё не построен."""
+    with _indexes_lock:
+        if subject in _indexes:
+            return _indexes[subject]
+        try:
+            index = SubjectIndex.load(subject)
+            logger.info(f"Loaded local index for subject '{subject}': {len(index)} passages")
+        except FileNotFoundError:
+            index = None
+            logger.warning(f"No local index for subject '{subject}', run: python local_retrieval.py build --subject ...")
+        except Exception as e:
+            index = None
+            logger.error(f"Failed to load local index for subject '{subject}': {e}")
+        _indexes[subject] = index
+        return index
+
+
+def build_subject_index(client, subject: str, with_vectors: bool = True, workers: int = None) -> SubjectIndex:
+    """
+    Разбирает учебники предмета (ingest.py, неизменённые книги берутся из
+    кеша) и строит и сохраняет индекс.
+    """
+    kwargs = {"workers": workers} if workers else {}
+    passages, stats = ingest_subject(subject, **kwargs)
+    previous = None
+    try:
+        previous = SubjectIndex.load(subject)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.debug(f"Previous local index for subject '{subject}' unusable: {e}")
+    index = SubjectIndex.build(client, subject, passages, with_vectors=with_vectors, previous=previous)
+    index.save()
+    with _indexes_lock:
+        _indexes[subject] = index
+    logger.info(f"Built local index for subject '{subject}': {len(passages)} passages ({stats})")
+    return index
+
+
+def _book_title(passage: dict) -> str:
+    return passage.get("title") or passage["source"]
+
+
+def _format_context(hits: list[tuple[dict, float]]) -> str:
+    return "\n\n".join(f"[{n}] ({_book_title(p)}, {printed_page(p)}-бет)\n{p['text']}" for n, (p, _) in enumerate(hits, start=1))
+
+
+def cited_sources(answer: str, hits: list[tuple[dict, float]]) -> list[str]:
+    """Подписи "[n] книга, N-бет" для номеров фрагментов, на которые ссылается ответ."""
+    sources = []
+    for n in dict.fromkeys(int(m) for m in _CITE_RE.findall(answer or "")):
+        if 1 <= n <= len(hits):
+            passage = hits[n - 1][0]
+            sources.append(f"[{n}] {_book_title(passage)}, {printed_page(passage)}-бет")
+    return sources
+
+
+def answer_locally(client, subject: str, question: str, on_text=None, metrics=None, on_wait=None,
+                   extra_instructions: str = "", hits=None):
+    """
+    Отвечает на вопрос по локальному индексу предмета: лучшие фрагменты
+    передаются обычному chat completion, ответ стримится в on_text(text).
+    Возвращает (ответ, подписи источников) или None, если индекса нет.
+    hits — уже найденные фрагменты (поиск тогда не повторяется).
+    """
+    if hits is None:
+        index = get_subject_index(subject)
+        if index is None:
+            return None
+        started = time.monotonic()
+        hits = index.search(client, question)
+        logger.debug("Local retrieval for subject '%s': %d hits in %.0f ms", subject, len(hits), (time.monotonic() - started) * 1000)
+    system_prompt = LOCAL_ANSWER_SYSTEM_PROMPT + (extra_instructions or "")
+    user_content = f"Үзінділер:\n\n{_format_context(hits)}\n\nСұрақ: {question}"
+    stream = call_openai(
+        client.chat.completions,
+        metrics=metrics,
+        on_wait=on_wait,
+        est_tokens=estimate_request_tokens(system_prompt, user_content),
+        model=LOCAL_RETRIEVAL_MODEL,
+        messages=[
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ],
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    answer = ""
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) and metrics is not None:
+                metrics.add_usage(chunk.usage)
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                answer += delta
+                if on_text:
+                    on_text(answer)
+    finally:
+        try:
+            stream.close()
+        except Exception:
+            pass
+    return answer.strip(), cited_sources(answer, hits)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else math.nan
+
+
+def _bench_local(client, subject: str, question: str) -> dict:
+    started = time.monotonic()
+    first = []
+    hits = get_subject_index(subject).search(client, question)
+    retrieval = time.monotonic() - started
+    with track_call("bench.local_answer", model=LOCAL_RETRIEVAL_MODEL, subject=subject) as m:
+        answer_locally(client, subject, question, metrics=m, hits=hits,
+                       on_text=lambda _: first or first.append(time.monotonic() - started))
+    return {"retrieval": retrieval, "first_token": first[0] if first else math.nan,
+            "total": time.monotonic() - started, "hits": len(hits)}
+
+
+def _bench_assistant(client, subject: str, question: str) -> dict:
+    from assistant_stream import stream_run
+    started = time.monotonic()
+    first = []
+    with track_call("bench.assistant_run", subject=subject) as m:
+        thread_id = call_openai(client.beta.threads, "create", metrics=m).id
+        try:
+            call_openai(client.beta.threads.messages, "create", metrics=m,
+                        thread_id=thread_id, role="user", content=question)
+            stream_run(client, thread_id, SUBJECTS[subject]["assistant_id"], metrics=m,
+                       on_text=lambda _: first or first.append(time.monotonic() - started),
+                       tools=[{"type": "file_search"}])
+        finally:
+            call_openai(client.beta.threads, "delete", metrics=m, thread_id=thread_id)
+    return {"first_token": first[0] if first else math.nan, "total": time.monotonic() - started}
+
+
+def benchmark(client, subject: str, questions: list[str], with_assistant: bool = True):
+    """Сравнивает задержки локального поиска с ответом и пути через ассистента с file_search."""
+    rows = {"local": [], "assistant": []}
+    for question in questions:
+        rows["local"].append(_bench_local(client, subject, question))
+        if with_assistant:
+            rows["assistant"].append(_bench_assistant(client, subject, question))
+    for path, results in rows.items():
+        if not results:
+            continue
+        for metric in ("retrieval", "first_token", "total"):
+            values = [r[metric] * 1000 for r in results if metric in r and not math.isnan(r[metric])]
+            if values:
+                print(f"{path:<10} {metric:<12} p50={_percentile(values, 50):8.0f}ms p95={_percentile(values, 95):8.0f}ms n={len(values)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    from log_setup import configure_logging
+
+    load_dotenv()
+    configure_logging()
+    parser = argparse.ArgumentParser(description="Локальный гибридный поиск (BM25 + эмбеддинги) по учебникам")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build = sub.add_parser("build", help="Построить индекс предмета из файлов учебников")
+    build.add_argument("--subject", action="append", help="Предмет (по умолчанию все с каталогом учебников)")
+    build.add_argument("--no-vectors", action="store_true", help="Только BM25, без эмбеддингов")
+    build.add_argument("--workers", type=int, help="Процессов для разбора учебников")
+    search = sub.add_parser("search", help="Показать найденные фрагменты")
+    search.add_argument("--subject", required=True)
+    search.add_argument("query")
+    bench = sub.add_parser("bench", help="Сравнить с путём через ассистента (file_search)")
+    bench.add_argument("--subject", required=True)
+    bench.add_argument("--questions", required=True, help="Файл с вопросами, по одному на строку")
+    bench.add_argument("--local-only", action="store_true")
+    args = parser.parse_args()
+
+    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    if args.command == "build":
+        for name in args.subject or [s for s in SUBJECTS if os.path.isdir(textbooks_dir(s))]:
+            build_subject_index(openai_client, name, with_vectors=not args.no_vectors, workers=args.workers)
+    elif args.command == "search":
+        subject_index = get_subject_index(args.subject)
+        for passage, score in (subject_index.search(openai_client, args.query) if subject_index else []):
+            print(f"{score:.4f}  {_book_title(passage)}, {printed_page(passage)}-бет: {passage['text'][:160]}")
+    else:
+        with open(args.questions, "r", encoding="utf-8") as f:
+            bench_questions = [line.strip() for line in f if line.strip()]
+        benchmark(openai_client, args.subject, bench_questions, with_assistant=not args.local_only)
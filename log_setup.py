@@ -0,0 +1,140 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+# Уровни задаются окружением:
+#   LOG_LEVEL=INFO                          — корневой уровень
+#   LOG_LEVELS="test=DEBUG,httpx=WARNING"   — уровни отдельных модулей
+#   LOG_FORMAT=json                         — JSON-строки вместо текста
+#   LOG_SAMPLE_EVERY=20                     — из событий с extra={"sample": ...} пишется каждое N-е
+#   LOG_PAYLOADS=truncate|hash|full, LOG_PAYLOAD_CHARS=200 — как выводить большие тексты
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").strip().upper()
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").strip().lower()
+LOG_PAYLOADS = os.getenv("LOG_PAYLOADS", "truncate").strip().lower()
+try:
+    LOG_SAMPLE_EVERY = max(1, int(os.getenv("LOG_SAMPLE_EVERY", "20")))
+except ValueError:
+    LOG_SAMPLE_EVERY = 20
+try:
+    LOG_PAYLOAD_CHARS = max(0, int(os.getenv("LOG_PAYLOAD_CHARS", "200")))
+except ValueError:
+    LOG_PAYLOAD_CHARS = 200
+
+# Болтливые библиотеки по умолчанию не ниже WARNING (переопределяются через LOG_LEVELS)
+_QUIET_LOGGERS = ("httpx", "httpcore", "hpack", "openai", "urllib3", "watchdog", "PIL")
+
+# Стандартные атрибуты LogRecord: всё остальное считается полями из extra
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class payload:
+    """
+    Ленивое представление большого текста (промпт, JSON) для аргумента лога:
+    форматируется только если запись действительно выводится, и по
+    умолчанию обрезается до LOG_PAYLOAD_CHARS или заменяется хешем.
+    """
+
+    __slots__ = ("value", "mode")
+
+    def __init__(self, value, mode: str = None):
+        self.value = value
+        self.mode = mode or LOG_PAYLOADS
+
+    def __str__(self) -> str:
+        text = self.value if isinstance(self.value, str) else json.dumps(self.value, ensure_ascii=False, default=str)
+        if self.mode == "full" or (self.mode != "hash" and len(text) <= LOG_PAYLOAD_CHARS):
+            return text
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+        if self.mode == "hash":
+            return f"<{len(text)} chars sha1:{digest}>"
+        return f"{text[:LOG_PAYLOAD_CHARS]}... <{len(text)} chars sha1:{digest}>"
+
+    __repr__ = __str__
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает каждое N-е событие для записей с extra={"sample": "<ключ>"}
+    (счётчик отдельный для каждого ключа); остальные записи не трогает.
+    """
+
+    def __init__(self, every: int = LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self._counts: dict = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None or self.every <= 1 or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            n = self._counts.get(key, 0)
+            self._counts[key] = n + 1
+        if n % self.every:
+            return False
+        record.sampled = f"1/{self.every}"
+        return True
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Одна JSON-строка на запись; поля из extra добавляются как есть."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = value if isinstance(value, (str, int, float, bool, type(None))) else str(value)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def _parse_levels(spec: str) -> dict:
+    levels = {}
+    for item in (spec or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging():
+    """
+    Настраивает корневой логгер один раз на процесс (вместо basicConfig(DEBUG)
+    в каждом модуле): уровень, уровни модулей, формат и фильтр выборки.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        handler = logging.StreamHandler()
+        if LOG_FORMAT == "json":
+            handler.setFormatter(JsonLinesFormatter())
+        else:
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+        handler.addFilter(SamplingFilter())
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(LOG_LEVEL if isinstance(logging.getLevelName(LOG_LEVEL), int) else logging.INFO)
+        for name in _QUIET_LOGGERS:
+            logging.getLogger(name).setLevel(logging.WARNING)
+        for name, level in _parse_levels(LOG_LEVELS).items():
+            try:
+                logging.getLogger(name).setLevel(level)
+            except ValueError:
+                root.warning("Invalid log level %r for logger %r", level, name)
+        _configured = True
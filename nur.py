@@ -4,13 +4,18 @@ from typing import cast
 from datetime import datetime
 from openai import OpenAI, RateLimitError
 import uuid
-import time
 import os
 from dotenv import load_dotenv
 import logging
+from log_setup import configure_logging, payload
+from llm_metrics import track_call
+from assistant_stream import stream_run
+from chat_threads import chat_thread_id, discard_chat_threads
+from file_catalog import file_names
+from openai_scheduler import call_openai, estimate_request_tokens, queue_notice
 
 # Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Загружаем .env
@@ -88,7 +93,7 @@ def load_psychology_chat_titles(user_id):
     try:
         response = supabase.table("psychology_chats").select("id, title, created_at").eq("user_id", user_id).execute()
         chats = sorted(response.data, key=lambda x: x["created_at"], reverse=True)
-        logger.debug(f"Loaded psychology chats for user {user_id}: {chats}")
+        logger.debug("Loaded %d psychology chats for user %s", len(chats), user_id)
         return chats
     except Exception as e:
         logger.error(f"Ошибка загрузки чатов: {str(e)}")
@@ -99,7 +104,7 @@ def load_psychology_chat(chat_id):
     try:
         response = supabase.table("psychology_chats").select("messages").eq("id", chat_id).execute()
         if response.data:
-            logger.debug(f"Loaded psychology chat {chat_id}: {response.data[0]}")
+            logger.debug("Loaded psychology chat %s: %s", chat_id, payload(response.data[0]))
             return response.data[0]["messages"]
         return []
     except Exception as e:
@@ -133,7 +138,8 @@ def save_psychology_chat(chat_id, user_id, messages, title):
 def delete_psychology_chat(chat_id):
     try:
         response = supabase.table("psychology_chats").delete().eq("id", chat_id).execute()
-        logger.debug(f"Deleted psychology chat {chat_id}: {response.data}")
+        discard_chat_threads(client, response.data)
+        logger.debug("Deleted psychology chat %s", chat_id)
         return response.data is not None
     except Exception as e:
         logger.error(f"Ошибка удаления чата {chat_id}: {str(e)}")
@@ -147,7 +153,8 @@ def cleanup_empty_psychology_chats(user_id):
             msgs = row.get("messages") or []
             if not msgs:
                 try:
-                    supabase.table("psychology_chats").delete().eq("id", row.get("id")).execute()
+                    deleted = supabase.table("psychology_chats").delete().eq("id", row.get("id")).execute()
+                    discard_chat_threads(client, deleted.data)
                 except Exception:
                     continue
     except Exception as e:
@@ -188,13 +195,18 @@ def create_new_psychology_chat(user_id):
 
 def generate_chat_title(prompt):
     try:
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {"role": "system", "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: 'Психология - [Тақырып]'"},
-                {"role": "user", "content": f"Сұрақ: {prompt}"}
-            ]
-        )
+        with track_call("psychology.generate_chat_title", model="gpt-5") as call:
+            response = call_openai(
+                client.chat.completions,
+                metrics=call,
+                est_tokens=estimate_request_tokens(prompt),
+                model="gpt-5",
+                messages=[
+                    {"role": "system", "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: 'Психология - [Тақырып]'"},
+                    {"role": "user", "content": f"Сұрақ: {prompt}"}
+                ]
+            )
+            call.add_usage(response.usage)
         content = response.choices[0].message.content
         if content is None:
             logger.warning("OpenAI тақырып контенті бос (None)")
@@ -354,115 +366,132 @@ def psychology_page():
             st.markdown(user_input)
 
         with st.spinner("Сізге жылы кеңес дайындалуда... ✨"):
-            max_retries = 5
-            retry_delay = 10
-            for attempt in range(max_retries):
-                try:
-                    # Prefer Assistant API if configured, otherwise fall back to Chat Completions
-                    psychology_assistant_id = PSYCHOLOGY_ASSISTANT_ID
-
-                    if psychology_assistant_id:
-                        # Create a new thread for this conversation
-                        thread = client.beta.threads.create()
-
-                        # Add user message to thread
-                        client.beta.threads.messages.create(
-                            thread_id=thread.id,
+            wait_placeholder = st.empty()
+            on_wait = queue_notice(wait_placeholder)
+            try:
+                # Prefer Assistant API if configured, otherwise fall back to Chat Completions
+                psychology_assistant_id = PSYCHOLOGY_ASSISTANT_ID
+
+                if psychology_assistant_id:
+                    # One thread per chat, created on the first question and reused
+                    with st.chat_message("assistant"):
+                        answer_placeholder = st.empty()
+                    with track_call("psychology.assistant_run") as m:
+                        thread_id = chat_thread_id(
+                            client, supabase, "psychology_chats", st.session_state.psychology_chat_id,
+                            metrics=m, on_wait=on_wait
+                        )
+                        call_openai(
+                            client.beta.threads.messages, "create", metrics=m, on_wait=on_wait,
+                            thread_id=thread_id,
                             role="user",
                             content=user_input
                         )
-
-                        # Run the psychology assistant with file search
-                        run = client.beta.threads.runs.create(
-                            thread_id=thread.id,
-                            assistant_id=psychology_assistant_id,
-                            tools=[{"type": "file_search"}]
+                        # Stream the psychology assistant's answer with file search
+                        streamed = stream_run(
+                            client, thread_id, psychology_assistant_id,
+                            on_text=lambda text: answer_placeholder.markdown(text + "▌"),
+                            metrics=m, on_wait=on_wait, tools=[{"type": "file_search"}],
                         )
 
-                        # Wait for completion
-                        while run.status in ["queued", "in_progress"]:
-                            run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-                            time.sleep(2)
-
-                        if run.status == "completed":
-                            # Get the response
-                            messages = client.beta.threads.messages.list(thread_id=thread.id, limit=1)
-                            response_content = messages.data[0].content
-
-                            # Extract text and sources
-                            answer_text = ""
-                            sources = set()
-
-                            for block in response_content:
-                                try:
-                                    if hasattr(block, 'text') and getattr(block, 'text', None):
-                                        text_part = getattr(block, 'text', None)
-                                        if text_part and hasattr(text_part, 'value'):
-                                            value = getattr(text_part, 'value', None)
-                                            if isinstance(value, str):
-                                                answer_text += value
-                                    elif hasattr(block, 'file_citation') and getattr(block, 'file_citation', None):
-                                        # Extract source information from file citations
-                                        file_citation = getattr(block, 'file_citation', None)
-                                        if file_citation:
-                                            file_id = getattr(file_citation, 'file_id', 'Unknown')
-                                            sources.add(file_id)
-                                except Exception:
-                                    continue
-
-                            # Add file sources at the end (if available)
-                            if sources:
-                                answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(sources)}"
-
-                            st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
-                            with st.chat_message("assistant"):
-                                st.markdown(answer_text)
-
-                            # Clean up thread
-                            try:
-                                client.beta.threads.delete(thread.id)
-                            except Exception:
-                                pass
-                        else:
-                            error_msg = f"💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
-                            if hasattr(run, 'last_error') and run.last_error:
-                                error_msg += f" ({run.last_error.message})"
-                            st.error(error_msg)
-                            st.session_state.psychology_messages.append({"role": "assistant", "content": error_msg})
-                            with st.chat_message("assistant"):
-                                st.markdown(error_msg)
-                            try:
-                                client.beta.threads.delete(thread.id)
-                            except Exception:
-                                pass
+                    if streamed.status == "completed":
+                        answer_text = streamed.text
+
+                        # Add file sources at the end (if available)
+                        if streamed.file_ids:
+                            answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(file_names.names(streamed.file_ids, client))}"
+
+                        st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
+                        answer_placeholder.markdown(answer_text)
                     else:
-                        # Fallback to standard Chat Completions with a psychology-specific system prompt
-                        previous_text = "\n".join(
-                            [f"{m['role']}: {m['content']}" for m in (st.session_state.psychology_messages or []) if m.get('role') in ("user", "assistant")][-10:]
+                        error_msg = f"💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
+                        last_error = getattr(streamed.run, "last_error", None)
+                        if last_error:
+                            error_msg += f" ({last_error.message})"
+                        st.error(error_msg)
+                        st.session_state.psychology_messages.append({"role": "assistant", "content": error_msg})
+                        answer_placeholder.markdown(error_msg)
+                else:
+                    # Fallback to standard Chat Completions with a psychology-specific system prompt
+                    previous_text = "\n".join(
+                        [f"{m['role']}: {m['content']}" for m in (st.session_state.psychology_messages or []) if m.get('role') in ("user", "assistant")][-10:]
+                    )
+                    system_prompt = PSYCHOLOGY_PROMPT.format(previous_messages=previous_text)
+
+                    with track_call("psychology.chat_completion", model="gpt-5") as call:
+                        completion = call_openai(
+                            client.chat.completions,
+                            metrics=call,
+                            on_wait=on_wait,
+                            est_tokens=estimate_request_tokens(system_prompt, user_input),
+                            model="gpt-5",
+                            messages=[
+                                {"role": "system", "content": system_prompt},
+                                {"role": "user", "content": user_input},
+                            ],
                         )
-                        system_prompt = PSYCHOLOGY_PROMPT.format(previous_messages=previous_text)
-
-                        completion = client.chat.completions.create(
+                        call.add_usage(completion.usage)
+                    answer_text = completion.choices[0].message.content or "💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
+                    answer_text = answer_text.strip()
+
+                    st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
+                    with st.chat_message("assistant"):
+                        st.markdown(answer_text)
+
+                if len(st.session_state.psychology_messages) == 2:
+                    new_title = generate_chat_title(user_input)
+                    success, result = rename_psychology_chat(st.session_state.psychology_chat_id, new_title)
+                    if success:
+                        st.session_state.psychology_chat_title = result
+                        st.session_state["psychology_title_renamed"] = True
+                        logger.debug(f"Psychology chat renamed to {result}")
+
+                save_psychology_chat(
+                    chat_id=st.session_state.psychology_chat_id,
+                    user_id=st.session_state.user_id,
+                    messages=st.session_state.psychology_messages,
+                    title=st.session_state.psychology_chat_title
+                )
+                # If title was just renamed, rerun to refresh sidebar immediately
+                if st.session_state.get("psychology_title_renamed"):
+                    st.session_state.pop("psychology_title_renamed", None)
+                    st.rerun()
+            except RateLimitError:
+                logger.error("OpenAI rate limit exceeded")
+                st.error("💔 Кешіріңіз, OpenAI лимиті асып кетті. 2-3 минут күтіп, қайта көріңіз ✨")
+                st.session_state.psychology_messages.append({
+                    "role": "assistant",
+                    "content": "💔 Кешіріңіз, қазір жауап бере алмаймын. Лимитке жеттіңіз. Кішкене күтіп, қайта көріңіз ✨"
+                })
+                with st.chat_message("assistant"):
+                    st.markdown(st.session_state.psychology_messages[-1]["content"])
+            except Exception as e:
+                # If Assistant flow failed (e.g., invalid assistant id), try a one-time fallback to Chat Completions
+                try:
+                    previous_text = "\n".join(
+                        [f"{m['role']}: {m['content']}" for m in (st.session_state.psychology_messages or []) if m.get('role') in ("user", "assistant")][-10:]
+                    )
+                    system_prompt = PSYCHOLOGY_PROMPT.format(previous_messages=previous_text)
+
+                    with track_call("psychology.chat_completion_fallback", model="gpt-5") as call:
+                        completion = call_openai(
+                            client.chat.completions,
+                            metrics=call,
+                            on_wait=on_wait,
+                            est_tokens=estimate_request_tokens(system_prompt, user_input),
                             model="gpt-5",
                             messages=[
                                 {"role": "system", "content": system_prompt},
                                 {"role": "user", "content": user_input},
                             ],
                         )
-                        answer_text = completion.choices[0].message.content or "💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
-                        answer_text = answer_text.strip()
-
-                        st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
-                        with st.chat_message("assistant"):
-                            st.markdown(answer_text)
+                        call.add_usage(completion.usage)
+                    answer_text = completion.choices[0].message.content or "💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
+                    answer_text = answer_text.strip()
 
-                    if len(st.session_state.psychology_messages) == 2:
-                        new_title = generate_chat_title(user_input)
-                        success, result = rename_psychology_chat(st.session_state.psychology_chat_id, new_title)
-                        if success:
-                            st.session_state.psychology_chat_title = result
-                            st.session_state["psychology_title_renamed"] = True
-                            logger.debug(f"Psychology chat renamed to {result}")
+                    st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
+                    with st.chat_message("assistant"):
+                        st.markdown(answer_text)
 
                     save_psychology_chat(
                         chat_id=st.session_state.psychology_chat_id,
@@ -470,56 +499,8 @@ def psychology_page():
                         messages=st.session_state.psychology_messages,
                         title=st.session_state.psychology_chat_title
                     )
-                    # If title was just renamed, rerun to refresh sidebar immediately
-                    if st.session_state.get("psychology_title_renamed"):
-                        st.session_state.pop("psychology_title_renamed", None)
-                        st.rerun()
-                    break
-                except RateLimitError:
-                    if attempt < max_retries - 1:
-                        time.sleep(retry_delay)
-                        retry_delay *= 2
-                    else:
-                        logger.error("OpenAI rate limit exceeded")
-                        st.error("💔 Кешіріңіз, OpenAI лимиті асып кетті. 2-3 минут күтіп, қайта көріңіз ✨")
-                        st.session_state.psychology_messages.append({
-                            "role": "assistant",
-                            "content": "💔 Кешіріңіз, қазір жауап бере алмаймын. Лимитке жеттіңіз. Кішкене күтіп, қайта көріңіз ✨"
-                        })
-                        with st.chat_message("assistant"):
-                            st.markdown(st.session_state.psychology_messages[-1]["content"])
-                        break
-                except Exception as e:
-                    # If Assistant flow failed (e.g., invalid assistant id), try a one-time fallback to Chat Completions
-                    try:
-                        previous_text = "\n".join(
-                            [f"{m['role']}: {m['content']}" for m in (st.session_state.psychology_messages or []) if m.get('role') in ("user", "assistant")][-10:]
-                        )
-                        system_prompt = PSYCHOLOGY_PROMPT.format(previous_messages=previous_text)
-
-                        completion = client.chat.completions.create(
-                            model="gpt-5",
-                            messages=[
-                                {"role": "system", "content": system_prompt},
-                                {"role": "user", "content": user_input},
-                            ],
-                        )
-                        answer_text = completion.choices[0].message.content or "💔 Кешіріңіз, қазір жауап бере алмаймын. Кішкене күтіп, қайта көріңіз ✨"
-                        answer_text = answer_text.strip()
-
-                        st.session_state.psychology_messages.append({"role": "assistant", "content": answer_text})
-                        with st.chat_message("assistant"):
-                            st.markdown(answer_text)
-
-                        save_psychology_chat(
-                            chat_id=st.session_state.psychology_chat_id,
-                            user_id=st.session_state.user_id,
-                            messages=st.session_state.psychology_messages,
-                            title=st.session_state.psychology_chat_title
-                        )
-                        break
-                    except Exception as e2:
-                        logger.error(f"Ошибка обработки запроса: {str(e)}; fallback failed: {str(e2)}")
-                        st.error(f"💔 Кешіріңіз, қате шықты. Кішкене күтіп, қайта көріңіз ✨")
-                        break
-                time.sleep(5)
+                except Exception as e2:
+                    logger.error(f"Ошибка обработки запроса: {str(e)}; fallback failed: {str(e2)}")
+                    st.error(f"💔 Кешіріңіз, қате шықты. Кішкене күтіп, қайта көріңіз ✨")
+            finally:
+                wait_placeholder.empty()
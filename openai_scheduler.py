@@ -0,0 +1,288 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+
+from openai import RateLimitError
+
+logger = logging.getLogger(__name__)
+
+# Начальные лимиты организации (в минуту) до получения заголовков x-ratelimit-*
+try:
+    DEFAULT_RPM = max(1, int(os.getenv("OPENAI_RPM", "500")))
+except ValueError:
+    DEFAULT_RPM = 500
+try:
+    DEFAULT_TPM = max(1, int(os.getenv("OPENAI_TPM", "500000")))
+except ValueError:
+    DEFAULT_TPM = 500000
+try:
+    MAX_RETRIES = max(0, int(os.getenv("OPENAI_SCHEDULER_RETRIES", "4")))
+except ValueError:
+    MAX_RETRIES = 4
+# Базовая задержка повтора после 429, если сервер не прислал retry-after
+RETRY_BASE_SECONDS = 2.0
+RETRY_MAX_SECONDS = 60.0
+# Оценка токенов run ассистента (инструкции, file_search и ответ)
+RUN_ESTIMATED_TOKENS = 8000
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset(value) -> float | None:
+    """Длительность из x-ratelimit-reset-* ("6m0s", "1.5s", "20ms") в секундах."""
+    if not value:
+        return None
+    parts = _DURATION_RE.findall(str(value))
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(n) * _DURATION_UNITS[unit] for n, unit in parts)
+
+
+def _retry_after(headers) -> float | None:
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def estimate_request_tokens(*texts, completion: int = 1000) -> int:
+    """Грубая оценка токенов запроса для корзины: ~3 символа на токен плюс запас на ответ."""
+    return sum(len(t or "") for t in texts) // 3 + completion
+
+
+class TokenBucket:
+    """Корзина с равномерным пополнением: capacity единиц за минуту."""
+
+    def __init__(self, capacity: float):
+        self.capacity = float(capacity)
+        self.level = float(capacity)
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= min(amount, self.capacity)
+
+    def sync(self, limit, remaining, now: float):
+        """Подстраивает корзину под лимит и остаток, которые сообщил сервер."""
+        self._refill(now)
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self.level = min(self.level, float(remaining))
+
+
+class _Ticket:
+    __slots__ = ("user", "tokens")
+
+    def __init__(self, user, tokens):
+        self.user = user
+        self.tokens = tokens
+
+
+class _Lane:
+    """Корзины, пауза и очереди пользователей одной модели (лимиты OpenAI — на модель)."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.paused_until = 0.0
+        self.queues: dict = {}
+        self.rotation: deque = deque()
+
+
+class RateLimitScheduler:
+    """
+    Общий на процесс планировщик запросов к OpenAI. Для каждой модели свои
+    корзины запросов и токенов (OpenAI считает лимиты по моделям): запрос
+    ждёт, пока в корзинах его модели есть место; ожидающие пользователи
+    обслуживаются по кругу (по одному запросу за ход), внутри пользователя —
+    по порядку. После 429 запросы той же модели приостанавливаются до
+    retry-after (с разбросом), а не повторяются каждой сессией независимо.
+    Запросы без модели (треды, файлы, runs ассистентов) идут в полосу "default".
+    """
+
+    def __init__(self, rpm: int = DEFAULT_RPM, tpm: int = DEFAULT_TPM):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._lanes: dict = {}
+        self._cond = threading.Condition()
+
+    def _lane(self, model) -> _Lane:
+        key = model or "default"
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(self.rpm, self.tpm)
+        return lane
+
+    @staticmethod
+    def _wait_time(lane: _Lane, ticket: _Ticket, now: float) -> float:
+        return max(lane.paused_until - now,
+                   lane.requests.wait_time(1, now),
+                   lane.tokens.wait_time(ticket.tokens, now))
+
+    @staticmethod
+    def _position(lane: _Lane, ticket: _Ticket) -> tuple[int, float]:
+        """Сколько запросов будет обслужено раньше этого и оценка ожидания в секундах."""
+        own = lane.queues.get(ticket.user, ())
+        k = next((i for i, t in enumerate(own) if t is ticket), 0)
+        ahead = k + sum(min(len(q), k + 1) for user, q in lane.queues.items() if user != ticket.user)
+        eta = max(lane.paused_until - time.monotonic(), 0.0) + ahead / lane.requests.rate
+        return ahead, eta
+
+    def _remove(self, lane: _Lane, ticket: _Ticket):
+        queue = lane.queues.get(ticket.user)
+        if queue and ticket in queue:
+            queue.remove(ticket)
+        if not queue:
+            lane.queues.pop(ticket.user, None)
+            if ticket.user in lane.rotation:
+                lane.rotation.remove(ticket.user)
+        self._cond.notify_all()
+
+    def acquire(self, user, tokens: int = 0, on_wait=None, model=None) -> float:
+        """
+        Блокирует до своей очереди и наличия лимита модели; возвращает время ожидания.
+        on_wait(position, eta_seconds) вызывается не чаще раза в секунду вне блокировки.
+        """
+        ticket = _Ticket(user or "anonymous", max(0, int(tokens)))
+        started = time.monotonic()
+        last_notice = started
+        with self._cond:
+            lane = self._lane(model)
+            lane.queues.setdefault(ticket.user, deque()).append(ticket)
+            if ticket.user not in lane.rotation:
+                lane.rotation.append(ticket.user)
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    my_turn = lane.rotation and lane.rotation[0] == ticket.user and lane.queues[ticket.user][0] is ticket
+                    wait = self._wait_time(lane, ticket, now) if my_turn else 1.0
+                    if my_turn and wait <= 0:
+                        lane.requests.take(1, now)
+                        lane.tokens.take(ticket.tokens, now)
+                        lane.queues[ticket.user].popleft()
+                        lane.rotation.popleft()
+                        if lane.queues[ticket.user]:
+                            lane.rotation.append(ticket.user)
+                        else:
+                            del lane.queues[ticket.user]
+                        self._cond.notify_all()
+                        return now - started
+                    position, eta = self._position(lane, ticket)
+                    self._cond.wait(timeout=min(max(wait, 0.01), 1.0))
+                if on_wait and time.monotonic() - last_notice >= 1.0:
+                    last_notice = time.monotonic()
+                    on_wait(position, eta)
+        except BaseException:
+            with self._cond:
+                self._remove(lane, ticket)
+            raise
+
+    def update_from_headers(self, headers, model=None):
+        """Синхронизирует корзины модели по заголовкам x-ratelimit-* её ответа."""
+        if not headers:
+            return
+        now = time.monotonic()
+        with self._cond:
+            lane = self._lane(model)
+            for bucket, kind in ((lane.requests, "requests"), (lane.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    bucket.sync(int(limit) if limit else None, int(remaining) if remaining is not None else None, now)
+                except ValueError:
+                    continue
+                if remaining is not None and remaining.strip() == "0":
+                    reset = parse_reset(headers.get(f"x-ratelimit-reset-{kind}"))
+                    if reset:
+                        lane.paused_until = max(lane.paused_until, now + reset)
+            self._cond.notify_all()
+
+    def penalize(self, headers, attempt: int, model=None) -> float:
+        """
+        После 429 приостанавливает выдачу по модели на retry-after (или
+        экспоненциальную задержку) плюс случайный разброс, чтобы сессии не
+        повторяли разом.
+        """
+        delay = _retry_after(headers)
+        if delay is None:
+            delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** attempt))
+        delay += random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * (2 ** attempt)) / 2)
+        now = time.monotonic()
+        with self._cond:
+            lane = self._lane(model)
+            lane.paused_until = max(lane.paused_until, now + delay)
+            lane.requests.level = min(lane.requests.level, 0.0)
+            self._cond.notify_all()
+        logger.warning("OpenAI rate limit hit for %s, pausing its scheduled requests for %.1fs (attempt %d)",
+                       model or "default", delay, attempt + 1)
+        return delay
+
+
+scheduler = RateLimitScheduler()
+
+
+def queue_notice(placeholder):
+    """Колбэк on_wait, который показывает позицию в очереди в элементе Streamlit (st.empty())."""
+    def on_wait(position: int, eta: float):
+        placeholder.info(f"⏳ Сұраныстар кезегі: алдыңызда {position} сұраныс, шамамен {max(1, round(eta))} сек.")
+    return on_wait
+
+
+def call_openai(resource, method: str = "create", *, user_id=None, est_tokens: int = 0, metrics=None,
+                on_wait=None, max_retries: int = MAX_RETRIES, **kwargs):
+    """
+    Выполняет resource.<method>(**kwargs) через планировщик: ждёт очереди,
+    читает заголовки лимитов из сырого ответа и повторяет после 429.
+    metrics (CallMetrics) получает время в очереди и число повторов; его
+    user_id используется для справедливой очереди, если user_id не задан.
+    Лимиты учитываются по модели из kwargs["model"]. После исчерпания
+    повторов пробрасывает RateLimitError.
+    """
+    user = user_id or getattr(metrics, "user_id", None) or "anonymous"
+    model = kwargs.get("model")
+    for attempt in range(max_retries + 1):
+        waited = scheduler.acquire(user, est_tokens, on_wait=on_wait, model=model)
+        if metrics is not None:
+            metrics.add_queue_wait(waited)
+        try:
+            raw = getattr(resource.with_raw_response, method)(**kwargs)
+        except RateLimitError as e:
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            scheduler.update_from_headers(headers, model)
+            if attempt >= max_retries:
+                raise
+            scheduler.penalize(headers, attempt, model)
+            if metrics is not None:
+                metrics.retry()
+            continue
+        scheduler.update_from_headers(raw.headers, model)
+        return raw.parse()
@@ -0,0 +1,160 @@
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+
+from llm_metrics import track_call
+from openai_scheduler import call_openai, estimate_request_tokens
+
+logger = logging.getLogger(__name__)
+
+# Локальный каталог для кешей и индексов (вне git)
+CACHE_DIR = os.getenv("UBT_CACHE_DIR", ".cache")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
+try:
+    EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "256"))
+except ValueError:
+    EMBEDDING_DIMENSIONS = 256
+
+
+def embed_texts(client, texts: list[str]) -> np.ndarray:
+    """
+    Эмбеддинги текстов одним запросом; строки нормированы (L2), поэтому
+    косинусное сходство — это скалярное произведение.
+    """
+    if not texts:
+        return np.zeros((0, EMBEDDING_DIMENSIONS), dtype=np.float32)
+    with track_call("embeddings", model=EMBEDDING_MODEL) as m:
+        resp = call_openai(client.embeddings, "create", metrics=m,
+                           est_tokens=estimate_request_tokens(*texts, completion=0),
+                           model=EMBEDDING_MODEL, input=list(texts), dimensions=EMBEDDING_DIMENSIONS)
+        m.add_usage(resp.usage)
+    vectors = np.asarray([item.embedding for item in sorted(resp.data, key=lambda d: d.index)], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+class SolvedQuestionIndex:
+    """
+    Матрица эмбеддингов решённых вопросов одного пользователя по одному предмету.
+
+    Хранится на диске как сырой float32-файл (строки дописываются в конец) и
+    файл ключей по одному на строку, поэтому добавление инкрементальное, а
+    загрузка — одно чтение файла без разбора. Неудачная запись откатывается,
+    а прерванная обрезается при загрузке до общего числа строк.
+    """
+
+    def __init__(self, base_path: str, dim: int = EMBEDDING_DIMENSIONS):
+        self.base_path = base_path
+        self.dim = dim
+        self._lock = threading.Lock()
+        self.keys: list[str] = []
+        self._key_set: set[str] = set()
+        self.matrix = np.zeros((0, dim), dtype=np.float32)
+        self._load()
+
+    @property
+    def _vectors_path(self) -> str:
+        return f"{self.base_path}.{self.dim}.f32"
+
+    @property
+    def _keys_path(self) -> str:
+        return f"{self.base_path}.{self.dim}.keys"
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def __contains__(self, key) -> bool:
+        return key in self._key_set
+
+    def _load(self):
+        if not (os.path.exists(self._vectors_path) and os.path.exists(self._keys_path)):
+            return
+        try:
+            with open(self._keys_path, "r", encoding="utf-8") as f:
+                lines = f.read().split("\n")
+            # Последний элемент — недописанная строка (или пустая после финального \n)
+            keys = lines[:-1]
+            matrix = np.fromfile(self._vectors_path, dtype=np.float32)
+            rows = min(len(keys), matrix.size // self.dim)
+            if rows != len(keys) or matrix.size != rows * self.dim or lines[-1]:
+                # Запись была прервана между файлами: обрезаем оба до общего числа строк,
+                # иначе следующие дописанные векторы сдвинутся относительно ключей
+                self._truncate_files(rows, keys[:rows])
+            self.matrix = matrix[:rows * self.dim].reshape(rows, self.dim)
+            self.keys = keys[:rows]
+            self._key_set = set(self.keys)
+        except Exception as e:
+            logger.error(f"Failed to load solved question index {self.base_path}: {e}")
+
+    def _truncate_files(self, rows: int, keys: list[str]):
+        os.truncate(self._vectors_path, rows * self.dim * 4)
+        tmp_path = f"{self._keys_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("".join(f"{k}\n" for k in keys))
+        os.replace(tmp_path, self._keys_path)
+        logger.warning(f"Solved question index {self.base_path} truncated to {rows} aligned rows")
+
+    def append(self, keys: list[str], vectors: np.ndarray) -> int:
+        """Дописывает новые строки (уже известные ключи пропускаются)."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        with self._lock:
+            fresh = [i for i, k in enumerate(keys) if k not in self._key_set]
+            if not fresh:
+                return 0
+            new_keys = [keys[i] for i in fresh]
+            new_vectors = np.ascontiguousarray(vectors[fresh])
+            try:
+                os.makedirs(os.path.dirname(self.base_path), exist_ok=True)
+                sizes = {path: os.path.getsize(path) if os.path.exists(path) else 0
+                         for path in (self._vectors_path, self._keys_path)}
+                try:
+                    with open(self._vectors_path, "ab") as f:
+                        f.write(new_vectors.tobytes())
+                    with open(self._keys_path, "a", encoding="utf-8") as f:
+                        f.write("".join(f"{k}\n" for k in new_keys))
+                except Exception:
+                    # Откатываем оба файла, чтобы строки векторов и ключей не разошлись
+                    for path, size in sizes.items():
+                        if os.path.exists(path):
+                            os.truncate(path, size)
+                    raise
+            except Exception as e:
+                logger.error(f"Failed to persist solved question index {self.base_path}: {e}")
+            self.matrix = np.vstack([self.matrix, new_vectors])
+            self.keys.extend(new_keys)
+            self._key_set.update(new_keys)
+            return len(new_keys)
+
+    def top1(self, vectors: np.ndarray) -> tuple[np.ndarray, list]:
+        """
+        Для каждой строки vectors возвращает максимальное косинусное сходство
+        с решёнными вопросами и ключ ближайшего (None, если индекс пуст).
+        """
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dim)
+        matrix = self.matrix
+        if matrix.shape[0] == 0 or vectors.shape[0] == 0:
+            return np.zeros(vectors.shape[0], dtype=np.float32), [None] * vectors.shape[0]
+        scores = vectors @ matrix.T
+        best = scores.argmax(axis=1)
+        return scores[np.arange(len(best)), best], [self.keys[i] for i in best]
+
+
+_indexes: dict = {}
+_indexes_lock = threading.Lock()
+
+
+def get_solved_index(user_id: str, subject: str) -> SolvedQuestionIndex:
+    """Индекс пользователя по предмету; загружается с диска один раз на процесс."""
+    key = (user_id, subject)
+    with _indexes_lock:
+        index = _indexes.get(key)
+        if index is None:
+            subject_id = hashlib.sha1(subject.encode("utf-8")).hexdigest()[:16]
+            base_path = os.path.join(CACHE_DIR, "solved_vectors", str(user_id), subject_id)
+            index = SolvedQuestionIndex(base_path)
+            _indexes[key] = index
+        return index
@@ -5,19 +5,26 @@ from test import test_page
 from nur import psychology_page, create_new_psychology_chat
 from subjects import SUBJECTS
 from feedback import feedback_page
+from llm_metrics import track_call
+from assistant_stream import report_context_growth, stream_run
+from chat_threads import append_turn, discard_chat_threads
+from answer_cache import answer_cache, is_first_turn
+from local_retrieval import LOCAL_RETRIEVAL_MODEL, answer_locally, uses_local_retrieval
+from file_catalog import file_names
+from openai_scheduler import call_openai, estimate_request_tokens, queue_notice
 import uuid
 from datetime import datetime
-import time
 import os
 from dotenv import load_dotenv
 from typing import cast
 import logging
+from log_setup import configure_logging, payload
 import re
 import base64
 import hashlib
 
 # Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Загружаем .env
@@ -41,6 +48,8 @@ OPENAI_API_KEY: str = cast(str, openai_api_key_env)
 
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 client = OpenAI(api_key=OPENAI_API_KEY)
+# Прогрев и фоновое обновление кеша имён файлов для подписей источников
+file_names.start(client)
 
 # Анонимді кіру үшін параметрлер (қоршаған орта арқылы бапталуы мүмкін)
 ANON_EMAIL: str = cast(str, anon_email_env)
@@ -201,7 +210,7 @@ def load_main_chat_titles(user_id):
     try:
         response = supabase.table("main_chats").select("id, title, created_at").eq("user_id", user_id).execute()
         chats = sorted(response.data, key=lambda x: x["created_at"], reverse=True)
-        logger.debug(f"Loaded main chats for user {user_id}: {chats}")
+        logger.debug("Loaded %d main chats for user %s", len(chats), user_id)
         return chats
     except Exception as e:
         logger.error(f"Ошибка загрузки чатов: {str(e)}")
@@ -213,7 +222,7 @@ def load_main_chat(chat_id):
     try:
         response = supabase.table("main_chats").select("messages, thread_id").eq("id", chat_id).execute()
         if response.data:
-            logger.debug(f"Loaded chat {chat_id}: {response.data[0]}")
+            logger.debug("Loaded chat %s: %s", chat_id, payload(response.data[0]))
             return response.data[0]["messages"], response.data[0]["thread_id"]
         return [], None
     except Exception as e:
@@ -250,7 +259,8 @@ def save_main_chat(chat_id, user_id, messages, title, thread_id):
 def delete_main_chat(chat_id):
     try:
         response = supabase.table("main_chats").delete().eq("id", chat_id).execute()
-        logger.debug(f"Deleted chat {chat_id}: {response.data}")
+        discard_chat_threads(client, response.data)
+        logger.debug("Deleted chat %s", chat_id)
         return response.data is not None
     except Exception as e:
         logger.error(f"Ошибка удаления чата {chat_id}: {str(e)}")
@@ -278,7 +288,8 @@ def create_new_main_chat(user_id):
     try:
         chat_id = str(uuid.uuid4())
         title = "Жаңа чат"
-        thread_id = client.beta.threads.create().id
+        with track_call("main.create_thread", user_id=user_id) as m:
+            thread_id = call_openai(client.beta.threads, "create", metrics=m).id
         supabase.table("main_chats").insert({
             "id": chat_id,
             "user_id": user_id,
@@ -306,7 +317,8 @@ def cleanup_empty_main_chats(user_id):
                 msgs = []
             if not msgs:
                 try:
-                    supabase.table("main_chats").delete().eq("id", row.get("id")).execute()
+                    deleted = supabase.table("main_chats").delete().eq("id", row.get("id")).execute()
+                    discard_chat_threads(client, deleted.data)
                 except Exception:
                     continue
     except Exception as e:
@@ -315,14 +327,19 @@ def cleanup_empty_main_chats(user_id):
 
 def generate_chat_title(prompt, subject):
     try:
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {"role": "system",
-                 "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: '[Пән] - [Тақырып]'"},
-                {"role": "user", "content": f"Пән: {subject}\nСұрақ: {prompt}"}
-            ]
-        )
+        with track_call("main.generate_chat_title", model="gpt-5", subject=subject) as m:
+            response = call_openai(
+                client.chat.completions,
+                metrics=m,
+                est_tokens=estimate_request_tokens(prompt),
+                model="gpt-5",
+                messages=[
+                    {"role": "system",
+                     "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: '[Пән] - [Тақырып]'"},
+                    {"role": "user", "content": f"Пән: {subject}\nСұрақ: {prompt}"}
+                ]
+            )
+            m.add_usage(response.usage)
         content = response.choices[0].message.content
         if content is not None:
             title = content.strip()
@@ -350,133 +367,151 @@ EXTENDED_SYSTEM_PROMPT = """
 """
 
 
+# Контекст длинных тредов main_chats: инструкции передаются в каждый run через
+# additional_instructions (а не дописываются к каждому сообщению), в run попадают
+# только последние MAIN_CONTEXT_LAST_MESSAGES сообщений треда, а вход run
+# ограничен MAIN_MAX_PROMPT_TOKENS (включая результаты file_search).
+try:
+    MAIN_CONTEXT_LAST_MESSAGES = max(1, int(os.getenv("MAIN_CONTEXT_LAST_MESSAGES", "12")))
+except ValueError:
+    MAIN_CONTEXT_LAST_MESSAGES = 12
+try:
+    MAIN_MAX_PROMPT_TOKENS = max(256, int(os.getenv("MAIN_MAX_PROMPT_TOKENS", "32000")))
+except ValueError:
+    MAIN_MAX_PROMPT_TOKENS = 32000
+
+
+def send_prompt(thread_id, prompt, subject, placeholder=None, first_turn=False):
+    """
+    Отправляет сообщение в тред и получает ответ ассистента потоково: если
+    передан placeholder (st.empty()), текст отображается в нём по мере генерации.
+    Кеш ответов используется только для первого хода треда (first_turn).
+    Возвращает итоговый ответ со списком источников или None.
+    """
+    wait_placeholder = st.empty()
+    on_wait = queue_notice(wait_placeholder)
+
+    def on_text(text):
+        wait_placeholder.empty()
+        if placeholder is not None:
+            placeholder.markdown(text + "▌")
+
+    # Repeated opening questions are answered from the answer cache without a run;
+    # later turns depend on the thread context and always go to the model
+    cache_lookup = answer_cache.lookup(client, subject, prompt) if first_turn else None
+    if cache_lookup is not None and cache_lookup.entry is not None:
+        wait_placeholder.empty()
+        response = cache_lookup.entry.answer
+        if cache_lookup.entry.sources:
+            response += f"\n\n**📚 Дереккөздер:** {', '.join(cache_lookup.entry.sources)}"
+        append_turn(client, thread_id, prompt, response)
+        return response
+
+    # Subjects switched to local retrieval answer from the textbook index
+    if uses_local_retrieval(subject):
+        with track_call("main.local_answer", model=LOCAL_RETRIEVAL_MODEL, subject=subject) as m:
+            try:
+                local = answer_locally(client, subject, prompt, on_text=on_text, metrics=m, on_wait=on_wait,
+                                       extra_instructions=EXTENDED_SYSTEM_PROMPT)
+            except RateLimitError:
+                logger.error("OpenAI rate limit exceeded")
+                m.outcome = "rate_limited"
+                st.error("Қате: OpenAI лимиті асып кетті. 2-3 минут күтіңіз немесе OpenAI есептік жазбаңызды тексеріңіз: https://platform.openai.com/account/usage")
+                return None
+            except Exception as e:
+                logger.error(f"Ошибка локального ответа: {str(e)}")
+                m.outcome = "error"
+                local = None
+            finally:
+                wait_placeholder.empty()
+        if local is not None and local[0]:
+            response, sources = local
+            answer_cache.store(cache_lookup, response, sources)
+            if sources:
+                response += f"\n\n**📚 Дереккөздер:** {', '.join(sources)}"
+            append_turn(client, thread_id, prompt, response)
+            return response
+        # Без локального индекса — обычный путь через ассистента
 
-def send_prompt(thread_id, prompt, subject):
-    max_retries = 5
-    retry_delay = 10
-    for attempt in range(max_retries):
+    with track_call("main.send_prompt", subject=subject) as m:
         try:
-            # Send user message
-            client.beta.threads.messages.create(
+            # Send user message (запросы идут через общий планировщик лимитов)
+            call_openai(
+                client.beta.threads.messages, "create", metrics=m, on_wait=on_wait,
                 thread_id=thread_id,
                 role="user",
-                content=prompt + EXTENDED_SYSTEM_PROMPT
+                content=prompt
             )
-            # Create run with additional instructions
-            run = client.beta.threads.runs.create(
-                thread_id=thread_id,
-                assistant_id=SUBJECTS[subject]["assistant_id"],
-                tools=[{"type": "file_search"}],
+            # Stream the run: text deltas are rendered as they arrive
+            streamed = stream_run(
+                client, thread_id, SUBJECTS[subject]["assistant_id"], on_text=on_text,
+                metrics=m, on_wait=on_wait, tools=[{"type": "file_search"}],
+                additional_instructions=EXTENDED_SYSTEM_PROMPT,
+                truncation_strategy={"type": "last_messages", "last_messages": MAIN_CONTEXT_LAST_MESSAGES},
+                max_prompt_tokens=MAIN_MAX_PROMPT_TOKENS,
             )
-            while run.status in ["queued", "in_progress"]:
-                run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
-                time.sleep(2)
-            if run.status != "completed":
-                error_msg = f"Ассистенттің орындау қатесі: {run.status}"
-                if run.last_error:
-                    error_msg += f" ({run.last_error.code}: {run.last_error.message})"
+            if streamed.run is not None:
+                report_context_growth(thread_id, streamed.run, MAIN_MAX_PROMPT_TOKENS)
+            if streamed.status != "completed":
+                error_msg = f"Ассистенттің орындау қатесі: {streamed.status}"
+                last_error = getattr(streamed.run, "last_error", None)
+                if last_error:
+                    error_msg += f" ({last_error.code}: {last_error.message})"
                 logger.error(error_msg)
                 st.error(error_msg)
                 return None
-            messages = client.beta.threads.messages.list(thread_id=thread_id, limit=1)
-            content_blocks = messages.data[0].content
-            response = ""
-            file_ids = set()
-            
-            for block in content_blocks:
-                try:
-                    text_part = getattr(block, 'text', None)
-                    if text_part is not None:
-                        value = getattr(text_part, 'value', None)
-                        if isinstance(value, str):
-                            response += value
-                        # Collect file IDs from text annotations if present
-                        annotations = getattr(text_part, 'annotations', None)
-                        if annotations:
-                            for ann in annotations:
-                                file_citation = getattr(ann, 'file_citation', None)
-                                if file_citation:
-                                    fid = getattr(file_citation, 'file_id', None)
-                                    if isinstance(fid, str):
-                                        file_ids.add(fid)
-                                else:
-                                    # file_path annotations can also reference files
-                                    file_path = getattr(ann, 'file_path', None)
-                                    if file_path:
-                                        fid = getattr(file_path, 'file_id', None)
-                                        if isinstance(fid, str):
-                                            file_ids.add(fid)
-                                    else:
-                                        # Fallback if annotation exposes file_id directly
-                                        fid = getattr(ann, 'file_id', None)
-                                        if isinstance(fid, str):
-                                            file_ids.add(fid)
-                    # Some SDKs expose file citations at block level (rare)
-                    file_citation_block = getattr(block, 'file_citation', None)
-                    if file_citation_block:
-                        fid = getattr(file_citation_block, 'file_id', None)
-                        if isinstance(fid, str):
-                            file_ids.add(fid)
-                except Exception:
-                    continue
-            
-            # Strip inline citation markers like 【4:6†source】 and †source leftovers
-            try:
-                response = re.sub(r"【[^】]*】", "", response)
-                response = re.sub(r"†source", "", response, flags=re.IGNORECASE)
-            except Exception:
-                pass
-            
+            response = streamed.text
+
             if not response:
                 logger.warning("No text content found in assistant response.")
+                m.outcome = "empty"
                 st.error("Ассистент жауап бере алмады немесе жауапта мәтін жоқ.")
                 return None
-            
-            # Resolve file IDs to filenames
-            filenames = []
-            for fid in sorted(file_ids):
-                try:
-                    fobj = client.files.retrieve(fid)
-                    fname = getattr(fobj, 'filename', None) or fid
-                    filenames.append(fname)
-                except Exception:
-                    filenames.append(fid)
-            
+
+            # File IDs to filenames from the local cache (no network calls)
+            filenames = file_names.names(streamed.file_ids, client)
+            answer_cache.store(cache_lookup, response, filenames)
+
             if filenames:
-                response += f"\n\n**📚 Дереккөздер:** {', '.join(dict.fromkeys(filenames))}"
-            
-            logger.debug(f"Received response: {response[:100]}...")
+                response += f"\n\n**📚 Дереккөздер:** {', '.join(filenames)}"
+
+            logger.debug("Received response: %s", payload(response))
             return response
         except RateLimitError:
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
-                logger.error("OpenAI rate limit exceeded")
-                st.error("Қате: OpenAI лимиті асып кетті. 2-3 минут күтіңіз немесе OpenAI есептік жазбаңызды тексеріңіз: https://platform.openai.com/account/usage")
-                return None
+            logger.error("OpenAI rate limit exceeded")
+            m.outcome = "rate_limited"
+            st.error("Қате: OpenAI лимиті асып кетті. 2-3 минут күтіңіз немесе OpenAI есептік жазбаңызды тексеріңіз: https://platform.openai.com/account/usage")
+            return None
         except Exception as e:
             logger.error(f"Ошибка отправки запроса: {str(e)}")
+            m.outcome = "error"
             st.error(f"Қате: {str(e)}")
             return None
-        time.sleep(5)
+        finally:
+            wait_placeholder.empty()
 
 
 def extract_kazakh_text_from_image(image_bytes: bytes, mime_type: str = "image/png") -> str:
     try:
         data_url = f"data:{mime_type};base64,{base64.b64encode(image_bytes).decode('utf-8')}"
-        resp = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Суреттен қазақша мәтінді дәл шығарып бер. Тек мәтіннің өзін қайтар."},
-                        {"type": "image_url", "image_url": {"url": data_url}}
-                    ]
-                }
-            ]
-        )
+        with track_call("main.extract_kazakh_text_from_image", model="gpt-5") as m:
+            resp = call_openai(
+                client.chat.completions,
+                metrics=m,
+                # Изображение оценивается как обычный запрос: размер data URL не отражает токены
+                est_tokens=estimate_request_tokens(),
+                model="gpt-5",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": "Суреттен қазақша мәтінді дәл шығарып бер. Тек мәтіннің өзін қайтар."},
+                            {"type": "image_url", "image_url": {"url": data_url}}
+                        ]
+                    }
+                ]
+            )
+            m.add_usage(resp.usage)
         content = resp.choices[0].message.content
         return content.strip() if isinstance(content, str) else (content or "").strip()
     except Exception:
@@ -756,12 +791,15 @@ def process_user_message(user_input, subject):
             st.markdown(f"📎 *File attached ({len(attached_content)} characters)*")
 
     with st.spinner("Жауап дайындалуда..."):
-        # Send the full message (including file content) to the model
-        response = send_prompt(st.session_state.main_thread_id, full_message, subject)
+        # Send the full message (including file content) to the model;
+        # the answer streams into the assistant message as it is generated
+        with st.chat_message("assistant"):
+            answer_placeholder = st.empty()
+        response = send_prompt(st.session_state.main_thread_id, full_message, subject, placeholder=answer_placeholder,
+                               first_turn=is_first_turn(st.session_state.main_messages))
         if response:
             st.session_state.main_messages.append({"role": "assistant", "content": response})
-            with st.chat_message("assistant"):
-                st.markdown(response)
+            answer_placeholder.markdown(response)
 
             # Автоматическое переименование после первого сообщения
             if len(st.session_state.main_messages) == 2:
@@ -783,6 +821,8 @@ def process_user_message(user_input, subject):
             if st.session_state.get("main_title_renamed"):
                 st.session_state.pop("main_title_renamed", None)
                 st.rerun()
+        else:
+            answer_placeholder.empty()
 
 
 # Навигация
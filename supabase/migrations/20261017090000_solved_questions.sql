@@ -0,0 +1,24 @@
+-- Тексты правильно решённых вопросов для списка исключений при генерации тестов.
+-- Заполняется в save_results; раньше тексты извлекались из полных test_json в saved_tests.
+create table if not exists public.solved_questions (
+    user_id uuid not null references auth.users (id) on delete cascade,
+    subject text not null,
+    question_key text not null,
+    text text not null,
+    solved_at timestamptz not null default now(),
+    primary key (user_id, subject, question_key)
+);
+
+create index if not exists solved_questions_user_subject_solved_at_idx
+    on public.solved_questions (user_id, subject, solved_at desc);
+
+alter table public.solved_questions enable row level security;
+
+create policy "solved_questions_select_own" on public.solved_questions
+    for select using (auth.uid() = user_id);
+
+create policy "solved_questions_insert_own" on public.solved_questions
+    for insert with check (auth.uid() = user_id);
+
+create policy "solved_questions_update_own" on public.solved_questions
+    for update using (auth.uid() = user_id) with check (auth.uid() = user_id);
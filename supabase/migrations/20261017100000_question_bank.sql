@@ -0,0 +1,49 @@
+-- Общий банк проверенных вопросов, ключ — create_unique_question_key (sha256).
+-- generate_test сначала берёт из него нерешённые пользователем вопросы,
+-- а модель вызывает только на недостачу.
+create table if not exists public.question_bank (
+    question_key text primary key,
+    subject text not null,
+    book_title text,
+    page text,
+    question jsonb not null,
+    created_at timestamptz not null default now()
+);
+
+create index if not exists question_bank_subject_idx
+    on public.question_bank (subject);
+
+alter table public.question_bank enable row level security;
+
+create policy "question_bank_select_authenticated" on public.question_bank
+    for select to authenticated using (true);
+
+create policy "question_bank_insert_authenticated" on public.question_bank
+    for insert to authenticated with check (true);
+
+-- Случайная выборка вопросов предмета, которых нет среди решённых пользователем
+-- (user_correct_answers) и среди p_exclude (ключи из текущей сессии).
+create or replace function public.sample_question_bank(
+    p_user_id uuid,
+    p_subject text,
+    p_exclude text[] default '{}',
+    p_limit integer default 40
+)
+returns table (question_key text, question jsonb)
+language sql
+stable
+as $$
+    select b.question_key, b.question
+    from public.question_bank b
+    where b.subject = p_subject
+      and not (b.question_key = any (coalesce(p_exclude, '{}')))
+      and not exists (
+          select 1
+          from public.user_correct_answers u
+          where u.user_id = p_user_id
+            and u.subject = p_subject
+            and u.question_key = b.question_key
+      )
+    order by random()
+    limit greatest(p_limit, 0);
+$$;
@@ -0,0 +1,4 @@
+-- Тред ассистента OpenAI для чатов тестов и психолога (как main_chats.thread_id).
+-- Создаётся при первом вопросе в чате и переиспользуется для следующих.
+alter table public.test_chats add column if not exists thread_id text;
+alter table public.psychology_chats add column if not exists thread_id text;
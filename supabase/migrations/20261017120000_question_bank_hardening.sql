@@ -0,0 +1,136 @@
+-- Банк вопросов общий для всех учеников, поэтому прямая вставка с клиента
+-- запрещена: вопросы добавляются только через add_bank_questions (security
+-- definer), которая проверяет строки так же, как validate_generated_question.
+drop policy if exists "question_bank_insert_authenticated" on public.question_bank;
+
+alter table public.question_bank
+    add column if not exists created_by uuid references auth.users (id) on delete set null,
+    -- Случайный ключ строки: выборка читает индекс с случайной точки вместо сортировки предмета
+    add column if not exists random_key double precision not null default random();
+
+create index if not exists question_bank_subject_random_key_idx
+    on public.question_bank (subject, random_key);
+
+drop index if exists public.question_bank_subject_idx;
+
+create or replace function public.add_bank_questions(p_subject text, p_rows jsonb)
+returns integer
+language plpgsql
+security definer
+set search_path = public
+as $$
+declare
+    v_user uuid := auth.uid();
+    v_row jsonb;
+    v_question jsonb;
+    v_inserted integer := 0;
+    v_count integer;
+begin
+    if v_user is null then
+        raise exception 'not authenticated';
+    end if;
+    if jsonb_typeof(p_rows) <> 'array' or jsonb_array_length(p_rows) > 50 then
+        raise exception 'p_rows must be an array of at most 50 rows';
+    end if;
+    for v_row in select * from jsonb_array_elements(p_rows)
+    loop
+        v_question := v_row -> 'question';
+        -- Строки, не прошедшие проверку, пропускаются (как отбракованные вопросы партии).
+        -- Проверки идут отдельными шагами: порядок вычисления or в SQL не гарантирован,
+        -- а jsonb_array_length на не-массиве завершается ошибкой
+        continue when coalesce(v_row ->> 'question_key', '') !~ '^[0-9a-f]{64}$'
+            or jsonb_typeof(v_question) is distinct from 'object';
+        continue when jsonb_typeof(v_question -> 'options') is distinct from 'array';
+        continue when jsonb_array_length(v_question -> 'options') <> 4
+            or exists (
+                select 1 from jsonb_array_elements(v_question -> 'options') o
+                where jsonb_typeof(o) <> 'string' or length(o #>> '{}') not between 1 and 500
+            );
+        continue when length(coalesce(v_question ->> 'text', '')) not between 10 and 2000
+            or coalesce(v_question ->> 'correct_option', '') !~ '^[0-3]$'
+            or length(coalesce(v_question ->> 'book_title', '')) not between 1 and 300
+            or coalesce(v_question ->> 'page', '') !~ '^\d+-?\d*\s*бет$'
+            or length(coalesce(v_question ->> 'context', '')) not between 1 and 4000
+            or length(coalesce(v_question ->> 'explanation', '')) not between 1 and 4000;
+
+        insert into public.question_bank (question_key, subject, book_title, page, question, created_by)
+        values (
+            v_row ->> 'question_key',
+            p_subject,
+            v_question ->> 'book_title',
+            v_question ->> 'page',
+            jsonb_build_object(
+                'text', v_question -> 'text',
+                'options', v_question -> 'options',
+                'correct_option', (v_question ->> 'correct_option')::integer,
+                'book_title', v_question -> 'book_title',
+                'page', v_question -> 'page',
+                'context', v_question -> 'context',
+                'explanation', v_question -> 'explanation'
+            ),
+            v_user
+        )
+        on conflict (question_key) do nothing;
+        get diagnostics v_count = row_count;
+        v_inserted := v_inserted + v_count;
+    end loop;
+    return v_inserted;
+end;
+$$;
+
+revoke all on function public.add_bank_questions(text, jsonb) from public, anon;
+grant execute on function public.add_bank_questions(text, jsonb) to authenticated;
+
+-- Выборка без order by random(): окно по индексу (subject, random_key) от
+-- случайной точки, с переходом через начало. Функция volatile — random()
+-- даёт новую точку при каждом вызове.
+create or replace function public.sample_question_bank(
+    p_user_id uuid,
+    p_subject text,
+    p_exclude text[] default '{}',
+    p_limit integer default 40
+)
+returns table (question_key text, question jsonb)
+language plpgsql
+volatile
+as $$
+declare
+    v_start double precision := random();
+begin
+    return query
+    (
+        select b.question_key, b.question
+        from public.question_bank b
+        where b.subject = p_subject
+          and b.random_key >= v_start
+          and not (b.question_key = any (coalesce(p_exclude, '{}')))
+          and not exists (
+              select 1
+              from public.user_correct_answers u
+              where u.user_id = p_user_id
+                and u.subject = p_subject
+                and u.question_key = b.question_key
+          )
+        order by b.random_key
+        limit greatest(p_limit, 0)
+    )
+    union all
+    (
+        select b.question_key, b.question
+        from public.question_bank b
+        where b.subject = p_subject
+          and b.random_key < v_start
+          and not (b.question_key = any (coalesce(p_exclude, '{}')))
+          and not exists (
+              select 1
+              from public.user_correct_answers u
+              where u.user_id = p_user_id
+                and u.subject = p_subject
+                and u.question_key = b.question_key
+          )
+        order by b.random_key
+        limit greatest(p_limit, 0)
+    )
+    limit greatest(p_limit, 0);
+end;
+$$;
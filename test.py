@@ -3,19 +3,41 @@ from supabase import create_client, Client
 from typing import cast
 import json
 import re
-from openai import OpenAI, RateLimitError
+from openai import OpenAI, RateLimitError, BadRequestError
 import time
 import os
 from dotenv import load_dotenv
 import logging
-from datetime import datetime
+from log_setup import configure_logging, payload
+from datetime import datetime, timedelta
 import uuid
 from subjects import SUBJECTS
+from json_stream import JsonObjectStream
+from fingerprints import NearDuplicateIndex
+from kazakh_morph import stem_text
+from semantic_index import embed_texts, get_solved_index
+from exclusion_selector import select_exclusions, observe_generated, record_duplicate_rate
+from collections import Counter
+from generation_stats import acceptance, plan_batch_size
+from llm_metrics import track_call, bind_context
+from assistant_stream import StreamedRun, stream_run
+from chat_threads import append_turn, chat_thread_id, discard_chat_threads
+from answer_cache import answer_cache, is_first_turn
+from local_retrieval import LOCAL_RETRIEVAL_MODEL, answer_locally, uses_local_retrieval
+from file_catalog import file_names
+from citation_index import get_citation_index
+from openai_scheduler import call_openai, estimate_request_tokens
 from base64 import b64encode
 import hashlib
+import math
+import threading
+import numpy as np
+import queue
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Настройка логирования
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Загружаем .env
@@ -38,23 +60,83 @@ supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
 
 # SUBJECTS imported from subjects.py
 
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, str(default)))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid integer in env {name}, using default {default}")
+        return default
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, str(default)))
+    except (TypeError, ValueError):
+        logger.warning(f"Invalid number in env {name}, using default {default}")
+        return default
+
+# Параметры теста: число вопросов и размер одной партии
+TEST_SIZE = 20
+BATCH_SIZE = 10
+MAX_BATCH_ATTEMPTS = 5
+# Границы адаптивного размера партии (по ожидаемой доле принятых вопросов)
+MIN_BATCH_SIZE = max(1, _env_int("TEST_MIN_BATCH_SIZE", 5))
+MAX_BATCH_SIZE = max(MIN_BATCH_SIZE, _env_int("TEST_MAX_BATCH_SIZE", 25))
+# Параллельная генерация: сколько партий выполняется одновременно (1 = последовательно)
+GENERATION_WORKERS = max(1, _env_int("TEST_GENERATION_WORKERS", 3))
+# Потоковая генерация: вопросы показываются по мере разбора ответа модели
+GENERATION_STREAM = os.getenv("TEST_GENERATION_STREAM", "1").strip() not in ("0", "false", "False", "")
+# Предзагрузка следующего теста, пока ученик решает текущий
+PREFETCH_ENABLED = os.getenv("TEST_PREFETCH_ENABLED", "1").strip() not in ("0", "false", "False", "")
+PREFETCH_WORKERS = max(1, _env_int("TEST_PREFETCH_WORKERS", 2))
+PREFETCH_TTL_SECONDS = _env_int("TEST_PREFETCH_TTL_SECONDS", 3600)
+# Сколько ждать незавершённую предзагрузку, прежде чем строить тест потоково
+PREFETCH_WAIT_SECONDS = max(0.0, _env_float("TEST_PREFETCH_WAIT_SECONDS", 3))
+# Потоковые вопросы копятся перед проверкой на повторы: одно обращение за
+# эмбеддингами на группу вместо запроса на каждый вопрос
+MERGE_WINDOW_SECONDS = max(0.0, _env_float("TEST_MERGE_WINDOW_SECONDS", 1.5))
+MERGE_BUFFER_SIZE = max(1, _env_int("TEST_MERGE_BUFFER_SIZE", 8))
+# Порог сходства Жаккара (по MinHash) для отсева почти повторяющихся вопросов
+NEAR_DUPLICATE_THRESHOLD = _env_float("NEAR_DUPLICATE_THRESHOLD", 0.7)
+# Семантический фильтр: косинусное сходство эмбеддингов с решёнными вопросами
+SEMANTIC_FILTER_ENABLED = os.getenv("SEMANTIC_FILTER_ENABLED", "1").strip() not in ("0", "false", "False", "")
+SEMANTIC_DUPLICATE_THRESHOLD = _env_float("SEMANTIC_DUPLICATE_THRESHOLD", 0.9)
+# Генерация в режиме строгой JSON-схемы (Structured Outputs)
+STRUCTURED_OUTPUT_ENABLED = os.getenv("TEST_STRUCTURED_OUTPUT", "1").strip() not in ("0", "false", "False", "")
+# Бюджет токенов на список уже решённых вопросов в промпте generate_batch
+EXCLUSION_TOKEN_BUDGET = _env_int("EXCLUSION_TOKEN_BUDGET", 1500)
+# Синхронизация решённых ключей: размер страницы и запас водяного знака
+SOLVED_KEYS_PAGE_SIZE = max(1, _env_int("SOLVED_KEYS_PAGE_SIZE", 1000))
+SOLVED_KEYS_SYNC_OVERLAP_SECONDS = _env_int("SOLVED_KEYS_SYNC_OVERLAP_SECONDS", 300)
+# Общий банк проверенных вопросов: тест сначала заполняется из него, модель — только на недостачу
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK_ENABLED", "1").strip() not in ("0", "false", "False", "")
+
+def _report_error(message: str):
+    """
+    Показывает st.error только в потоке скрипта Streamlit: в фоновых потоках
+    нет ScriptRunContext, поэтому там ошибка только пишется в лог.
+    """
+    if get_script_run_ctx(suppress_warning=True) is not None:
+        st.error(message)
+    else:
+        logger.debug(f"UI error suppressed in background thread: {message}")
+
 def get_current_user_id():
     try:
         auth_user_resp = supabase.auth.get_user()
         if auth_user_resp and getattr(auth_user_resp, "user", None):
             user_id = auth_user_resp.user.id
-            logger.debug(f"Got user_id from Supabase auth: {user_id}")
+            logger.debug("Got user_id from Supabase auth: %s", user_id)
             return user_id
     except Exception as e:
-        logger.debug(f"Error getting user from Supabase auth: {e}")
+        logger.debug("Error getting user from Supabase auth: %s", e)
     session_user_id = st.session_state.get("user_id")
-    logger.debug(f"Got user_id from session state: {session_user_id}")
+    logger.debug("Got user_id from session state: %s", session_user_id)
     return session_user_id
 
 def canonical_subject(subject: str) -> str:
     try:
         canonical = " ".join((subject or "").strip().split())
-        logger.debug(f"Canonical subject: '{subject}' -> '{canonical}'")
+        logger.debug("Canonical subject: %r -> %r", subject, canonical)
         return canonical
     except Exception as e:
         logger.error(f"Error canonicalizing subject '{subject}': {e}")
@@ -66,19 +148,25 @@ def normalize_text(value: str) -> str:
     except Exception:
         return value or ""
 
+# HTML-теги и любые серии не-буквенных символов (включая "_", markdown и пробелы)
+# заменяются одним пробелом за один проход
+_QUESTION_NOISE_RE = re.compile(r"(?:<[^>]+>|[\W_])+")
+
 def normalize_question_text(text: str) -> str:
     try:
-        t = (text or "").lower()
-        t = re.sub(r"<[^>]+>", " ", t)          # remove HTML tags
-        t = re.sub(r"\*|_|`|#{1,6}", " ", t)    # strip markdown markers
-        t = re.sub(r"[^\w\sқғүұәіңһөҚҒҮҰӘІҢҺӨ]", " ", t)  # keep letters/digits/underscore/space (kk friendly)
-        t = re.sub(r"\s+", " ", t).strip()
-        logger.debug(f"Normalized text: '{text}' -> '{t}'")
-        return t
+        return _QUESTION_NOISE_RE.sub(" ", (text or "").lower()).strip()
     except Exception as e:
         logger.error(f"Error normalizing text '{text}': {e}")
         return normalize_text(text or "").lower()
 
+def fingerprint_text(text: str) -> str:
+    """
+    Текст для отпечатков почти повторов: normalize_question_text и основы
+    казахских слов, чтобы вопросы, отличающиеся только окончаниями, совпадали.
+    Ключ create_unique_question_key не меняется (по нему хранятся решённые вопросы).
+    """
+    return stem_text(normalize_question_text(text))
+
 def create_unique_question_key(question: dict) -> str:
     """
     Создает абсолютно уникальный ключ для вопроса на основе:
@@ -88,64 +176,204 @@ def create_unique_question_key(question: dict) -> str:
     4. Название книги
     5. Страница
     """
-    import hashlib
-    import json
-    
     try:
-        # Извлекаем все важные данные
-        text = question.get("text", "")
-        options = question.get("options", [])
-        correct_option = question.get("correct_option", 0)
-        book_title = question.get("book_title", "")
-        page = question.get("page", "")
-        
-        # Нормализуем текст вопроса
-        norm_text = normalize_question_text(text)
-        
-        # Нормализуем варианты ответов
-        norm_options = []
-        for opt in options:
-            norm_opt = normalize_question_text(opt)
-            norm_options.append(norm_opt)
-        
-        # Нормализуем название книги и страницу
-        norm_book = normalize_question_text(book_title)
-        norm_page = normalize_question_text(page)
-        
-        # Создаем уникальную строку из всех компонентов
-        unique_string = f"{norm_text}|{json.dumps(norm_options, ensure_ascii=False, sort_keys=True)}|{correct_option}|{norm_book}|{norm_page}"
-        
-        # Генерируем SHA256 хеш
-        key = hashlib.sha256(unique_string.encode("utf-8")).hexdigest()
-        
-        logger.debug(f"Generated UNIQUE question key:")
-        logger.debug(f"  Text: '{text[:50]}...'")
-        logger.debug(f"  Options: {len(options)} items")
-        logger.debug(f"  Correct: {correct_option}")
-        logger.debug(f"  Book: '{book_title}'")
-        logger.debug(f"  Page: '{page}'")
-        logger.debug(f"  Key: {key}")
-        
-        return key
-        
+        norm_options = [normalize_question_text(opt) for opt in question.get("options", [])]
+        unique_string = (
+            f"{normalize_question_text(question.get('text', ''))}"
+            f"|{json.dumps(norm_options, ensure_ascii=False, sort_keys=True)}"
+            f"|{question.get('correct_option', 0)}"
+            f"|{normalize_question_text(question.get('book_title', ''))}"
+            f"|{normalize_question_text(question.get('page', ''))}"
+        )
+        return hashlib.sha256(unique_string.encode("utf-8")).hexdigest()
     except Exception as e:
         logger.error(f"Error creating unique question key: {e}")
         # Fallback to simple text-based key
         return question_key_from_text(question.get("text", ""))
 
+_QUESTION_KEY_RE = re.compile(r"[0-9a-f]{64}")
+
+def get_question_key(question: dict) -> str:
+    """
+    Ключ вопроса: сохранённый в поле question_key (проставляется при генерации),
+    иначе вычисляется через create_unique_question_key (старые тесты).
+    """
+    stored = question.get("question_key")
+    if isinstance(stored, str) and _QUESTION_KEY_RE.fullmatch(stored):
+        return stored
+    return create_unique_question_key(question)
+
 def question_key_from_text(text: str) -> str:
     """
     Простой ключ только по тексту (для обратной совместимости)
     """
-    import hashlib
-    norm = normalize_question_text(text)
-    key = hashlib.sha256(norm.encode("utf-8")).hexdigest()
-    logger.debug(f"Generated simple question key: '{text}' -> '{key}'")
-    return key
+    return hashlib.sha256(normalize_question_text(text).encode("utf-8")).hexdigest()
 
 def compute_question_hash(question: dict) -> str:
-    # Use the new unique key generation
-    return create_unique_question_key(question)
+    return get_question_key(question)
+
+def build_near_duplicate_index(texts=None) -> NearDuplicateIndex:
+    """
+    Строит индекс отпечатков (MinHash по шинглам fingerprint_text)
+    по текстам уже решённых вопросов.
+    """
+    index = NearDuplicateIndex(threshold=NEAR_DUPLICATE_THRESHOLD)
+    for text in (texts or []):
+        if isinstance(text, str):
+            index.add(fingerprint_text(text))
+    return index
+
+# Отпечатки решённых вопросов на процесс: (user_id, subject) -> NearDuplicateIndex.
+# Подписи считаются только для текстов, которых ещё нет в индексе; save_results
+# дописывает новые решённые вопросы
+_solved_near_indexes: dict = {}
+_solved_near_lock = threading.Lock()
+
+def solved_near_duplicate_index(user_id, subject: str, texts=None) -> NearDuplicateIndex:
+    """
+    Копия индекса отпечатков решённых вопросов пользователя, дополненного
+    texts; в копию можно добавлять принятые в тест вопросы.
+    """
+    subj = canonical_subject(subject)
+    with _solved_near_lock:
+        index = _solved_near_indexes.get((user_id, subj))
+        if index is None:
+            index = _solved_near_indexes[(user_id, subj)] = NearDuplicateIndex(threshold=NEAR_DUPLICATE_THRESHOLD)
+        before = len(index)
+        for text in (texts or []):
+            if isinstance(text, str):
+                index.add(fingerprint_text(text))
+        if len(index) > before:
+            logger.debug("Near-duplicate index for subject '%s': +%d solved texts, %d total", subj, len(index) - before, len(index))
+        return index.copy()
+
+def remember_solved_texts(user_id, subject: str, texts):
+    """Добавляет тексты новых решённых вопросов в индекс процесса (если он уже построен)."""
+    with _solved_near_lock:
+        index = _solved_near_indexes.get((user_id, canonical_subject(subject)))
+        if index is None:
+            return
+        for text in texts:
+            if isinstance(text, str):
+                index.add(fingerprint_text(text))
+
+def embed_question_texts(texts):
+    """Эмбеддинги текстов вопросов; при ошибке API возвращает None (фильтр пропускается)."""
+    try:
+        return embed_texts(client, [t or "" for t in texts])
+    except Exception as e:
+        logger.error(f"Embedding request failed: {e}")
+        return None
+
+def load_semantic_index(user_id, subject, solved_texts=None):
+    """
+    Индекс эмбеддингов решённых вопросов пользователя. Если на этом сервере
+    индекса ещё нет, он заполняется текстами решённых вопросов одним запросом.
+    """
+    if not SEMANTIC_FILTER_ENABLED or not user_id:
+        return None
+    index = get_solved_index(user_id, canonical_subject(subject))
+    if len(index) == 0 and solved_texts:
+        texts = [t for t in solved_texts if isinstance(t, str) and t.strip()][:500]
+        vectors = embed_question_texts(texts)
+        if vectors is not None:
+            added = index.append([question_key_from_text(t) for t in texts], vectors)
+            logger.info(f"Backfilled semantic index with {added} solved questions for subject '{subject}'")
+    return index
+
+def get_session_near_duplicate_index(subject: str) -> NearDuplicateIndex:
+    cache_key = f"near_duplicate_index_{canonical_subject(subject)}"
+    index = st.session_state.get(cache_key)
+    if not isinstance(index, NearDuplicateIndex):
+        index = build_near_duplicate_index()
+        st.session_state[cache_key] = index
+    return index
+
+# Кеш решённых ключей на процесс: (user_id, subject) -> {"keys": set, "watermark": last_answered_at}
+_solved_keys_cache: dict = {}
+_solved_keys_lock = threading.Lock()
+
+def _watermark_with_overlap(watermark: str) -> str:
+    """Сдвигает водяной знак назад, чтобы не потерять строки, записанные с отстающими часами."""
+    try:
+        ts = datetime.fromisoformat(watermark.replace("Z", "+00:00"))
+        return (ts - timedelta(seconds=SOLVED_KEYS_SYNC_OVERLAP_SECONDS)).isoformat()
+    except (TypeError, ValueError):
+        return watermark
+
+def _page_solved_keys(user_id, subject: str, since=None):
+    """
+    Постранично читает (question_key, last_answered_at) из user_correct_answers,
+    начиная с since (включительно), чтобы не упираться в лимит строк PostgREST.
+    """
+    keys: set[str] = set()
+    watermark = None
+    offset = 0
+    while True:
+        query = (
+            supabase.table("user_correct_answers")
+            .select("question_key,last_answered_at")
+            .eq("user_id", user_id)
+            .eq("subject", subject)
+        )
+        if since:
+            query = query.gte("last_answered_at", since)
+        resp = (
+            query
+            .order("last_answered_at")
+            .order("question_key")
+            .range(offset, offset + SOLVED_KEYS_PAGE_SIZE - 1)
+            .execute()
+        )
+        rows = resp.data or []
+        for row in rows:
+            qk = row.get("question_key")
+            if isinstance(qk, str):
+                keys.add(qk)
+            answered_at = row.get("last_answered_at")
+            if answered_at and (watermark is None or answered_at > watermark):
+                watermark = answered_at
+        if len(rows) < SOLVED_KEYS_PAGE_SIZE:
+            return keys, watermark
+        offset += SOLVED_KEYS_PAGE_SIZE
+
+def fetch_solved_keys_from_db(user_id, subject: str) -> set:
+    """
+    Ключи правильно решённых вопросов из user_correct_answers. В первый раз
+    читаются все строки постранично, далее — только строки новее водяного
+    знака last_answered_at. Не обращается к st.session_state, поэтому
+    безопасна для фоновых потоков. Возвращает копию.
+    """
+    subj = canonical_subject(subject)
+    cache_key = (user_id, subj)
+    with _solved_keys_lock:
+        entry = _solved_keys_cache.get(cache_key)
+        since = _watermark_with_overlap(entry["watermark"]) if entry and entry["watermark"] else None
+    try:
+        if entry is None:
+            keys, watermark = _page_solved_keys(user_id, subj)
+            logger.info(f"Loaded {len(keys)} solved keys for subject '{subj}' (full sync)")
+        else:
+            keys, watermark = _page_solved_keys(user_id, subj, since=since)
+            logger.debug("Synced %d solved keys for subject %r since %s", len(keys), subj, since)
+    except Exception as e:
+        logger.error(f"Error fetching solved keys from database: {e}")
+        return set(entry["keys"]) if entry else set()
+    with _solved_keys_lock:
+        entry = _solved_keys_cache.setdefault(cache_key, {"keys": set(), "watermark": None})
+        entry["keys"] |= keys
+        if watermark and (entry["watermark"] is None or watermark > entry["watermark"]):
+            entry["watermark"] = watermark
+        return set(entry["keys"])
+
+def remember_solved_keys(user_id, subject: str, keys):
+    """Добавляет ключи, только что записанные save_results, в кеш без повторного чтения."""
+    if not keys:
+        return
+    with _solved_keys_lock:
+        entry = _solved_keys_cache.get((user_id, canonical_subject(subject)))
+        if entry is not None:
+            entry["keys"] |= set(keys)
 
 def get_solved_keys(subject: str) -> set:
     user_id = get_current_user_id()
@@ -153,31 +381,50 @@ def get_solved_keys(subject: str) -> set:
     if not user_id:
         logger.warning(f"No user_id found for getting solved keys for subject: {subject}")
         return keys
-    try:
-        subj = canonical_subject(subject)
-        logger.info(f"=== FETCHING SOLVED KEYS for user_id={user_id}, subject='{subj}' ===")
-        resp = supabase.table("user_correct_answers").select("question_key").eq("user_id", user_id).eq("subject", subj).execute()
-        db_keys = set()
-        for row in (resp.data or []):
-            qk = row.get("question_key")
-            if isinstance(qk, str):
-                db_keys.add(qk)
-        logger.info(f"Found {len(db_keys)} solved keys in database for subject '{subj}': {list(db_keys)[:5]}...")
-        keys.update(db_keys)
-    except Exception as e:
-        logger.error(f"Error fetching solved keys from database: {e}")
+    keys.update(fetch_solved_keys_from_db(user_id, subject))
     # merge with local session cache to be robust if network write/read lags
     try:
         cache_key = f"excluded_keys_cache_{subject}"
         cached = st.session_state.get(cache_key) or set()
         if isinstance(cached, set):
-            logger.info(f"Adding {len(cached)} keys from session cache for subject '{subject}'")
+            logger.debug("Adding %d keys from session cache for subject %r", len(cached), subject)
             keys |= cached
     except Exception as e:
         logger.error(f"Error accessing session cache: {e}")
-    logger.info(f"TOTAL solved keys for subject '{subject}': {len(keys)}")
+    logger.info("Total solved keys for subject %r: %d", subject, len(keys))
     return keys
 
+def store_solved_embeddings(user_id, subject, solved_questions):
+    """
+    Дописывает эмбеддинги решённых вопросов в индекс пользователя. Векторы,
+    посчитанные при генерации теста, берутся из сессии, остальные — одним запросом.
+    """
+    if not SEMANTIC_FILTER_ENABLED or not solved_questions:
+        return
+    try:
+        index = get_solved_index(user_id, canonical_subject(subject))
+        known = st.session_state.get(f"question_embeddings_{canonical_subject(subject)}") or {}
+        keys, vectors, missing = [], [], []
+        for q in solved_questions:
+            qkey = get_question_key(q)
+            if qkey in index:
+                continue
+            if qkey in known:
+                keys.append(qkey)
+                vectors.append(known[qkey])
+            else:
+                missing.append((qkey, q.get("text", "")))
+        if missing:
+            fresh = embed_question_texts([text for _, text in missing])
+            if fresh is not None:
+                keys.extend(k for k, _ in missing)
+                vectors.extend(fresh)
+        if keys:
+            added = index.append(keys, np.vstack(vectors))
+            logger.info(f"Stored {added} solved question embeddings for subject '{subject}'")
+    except Exception as e:
+        logger.error(f"Error storing solved question embeddings: {e}")
+
 from datetime import datetime as _dt
 
 def save_results(subject: str, questions: list, results: dict):
@@ -188,19 +435,21 @@ def save_results(subject: str, questions: list, results: dict):
     try:
         now_iso = _dt.utcnow().isoformat()
         subj = canonical_subject(subject)
-        logger.info(f"=== SAVING RESULTS for user_id={user_id}, subject='{subj}' ===")
+        logger.info("Saving results for user_id=%s, subject=%r", user_id, subj)
         attempts = []
         correct_rows = []
         newly_excluded = set()
+        solved_texts = []
+        near_index = get_session_near_duplicate_index(subj)
         for idx, q in enumerate(questions or []):
             q_text = q.get("text", "")
-            qkey = create_unique_question_key(q)  # Use unique key generation
+            qkey = get_question_key(q)
             try:
                 res = (results or {}).get("results", [])[idx]
             except Exception:
                 res = None
             is_correct = bool(res and res.get("is_correct"))
-            logger.info(f"Question {idx}: '{q_text[:50]}...' -> UNIQUE key: {qkey}, correct: {is_correct}")
+            logger.debug("Question %d: key=%s correct=%s text=%s", idx, qkey, is_correct, payload(q_text))
             attempts.append({
                 "user_id": user_id,
                 "subject": subj,
@@ -217,6 +466,8 @@ def save_results(subject: str, questions: list, results: dict):
                     "times_correct": 1,
                 })
                 newly_excluded.add(qkey)
+                solved_texts.append((qkey, q_text))
+                near_index.add(fingerprint_text(q_text))
         if attempts:
             try:
                 supabase.table("user_attempts").insert(attempts).execute()
@@ -234,9 +485,9 @@ def save_results(subject: str, questions: list, results: dict):
                 for row in correct_rows:
                     try:
                         supabase.table("user_correct_answers").insert(row).execute()
-                        logger.debug(f"Inserted correct answer: {row['question_key']}")
+                        logger.debug("Inserted correct answer: %s", row["question_key"])
                     except Exception as insert_err:
-                        logger.debug(f"Insert failed, trying update: {insert_err}")
+                        logger.debug("Insert failed, trying update: %s", insert_err)
                         try:
                             supabase.table("user_correct_answers").update({
                                 "last_answered_at": now_iso,
@@ -245,9 +496,11 @@ def save_results(subject: str, questions: list, results: dict):
                                 "subject": row["subject"],
                                 "question_key": row["question_key"],
                             }).execute()
-                            logger.debug(f"Updated existing correct answer: {row['question_key']}")
+                            logger.debug("Updated existing correct answer: %s", row["question_key"])
                         except Exception as update_err:
                             logger.error(f"Update also failed: {update_err}")
+            store_solved_question_texts(user_id, subj, solved_texts)
+            remember_solved_texts(user_id, subj, [text for _, text in solved_texts])
         # update local cache of excluded keys
         if newly_excluded:
             cache_key = f"excluded_keys_cache_{subj}"
@@ -257,29 +510,28 @@ def save_results(subject: str, questions: list, results: dict):
             cached |= newly_excluded
             st.session_state[cache_key] = cached
             logger.info(f"Updated session cache with {len(newly_excluded)} new excluded keys")
+            remember_solved_keys(user_id, subj, newly_excluded)
+            invalidate_prefetch(user_id, subj, newly_excluded)
+            store_solved_embeddings(user_id, subj, [q for q in (questions or []) if get_question_key(q) in newly_excluded])
     except Exception as e:
         logger.error(f"Error in save_results: {e}")
 
-def clean_response(text):
-    try:
-        text = re.sub(r'```json\s*|\s*```', '', text, flags=re.MULTILINE)
-        text = text.strip()
-        json_start = text.find('[')
-        json_end = text.rfind(']') + 1
-        if json_start == -1 or json_end <= json_start:
-            logger.error(f"JSON boundaries not found: {text[:500]}...")
-            st.error(f"JSON шекараларын табу мүмкін емес: {text[:500]}...")
-            return None
-        json_text = text[json_start:json_end]
-        json.loads(json_text)
-        logger.debug(f"Cleaned JSON response: {json_text[:100]}...")
-        return json_text
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {str(e)}")
-        st.error(f"JSON пішімі қате: {str(e)}")
-        return None
-
-def generate_batch(subject, batch_size=10, exclusion_texts=None):
+def parse_question_batch(text) -> list:
+    """
+    Терпимый разбор ответа модели: извлекает все корректные объекты-вопросы,
+    даже если массив обрезан или содержит повреждённый элемент.
+    """
+    parser = JsonObjectStream()
+    questions = parser.feed(text or "")
+    if parser.malformed or parser.pending:
+        logger.warning(f"Salvaged {len(questions)} questions from a damaged response "
+                       f"(malformed={parser.malformed}, truncated={parser.pending})")
+    if not questions:
+        logger.error(f"No JSON question objects found: {(text or '')[:500]}...")
+        _report_error(f"JSON шекараларын табу мүмкін емес: {(text or '')[:500]}...")
+    return questions
+
+def build_batch_prompt(subject, batch_size=10, exclusion_texts=None) -> str:
     content = f"""
 {subject} пәні бойынша {batch_size} сұрақты көп таңдаулы түрде қазақ тілінде генерациялаңыз, ЕНТ оқулықтарына сәйкес.
 
@@ -318,83 +570,574 @@ def generate_batch(subject, batch_size=10, exclusion_texts=None):
     # Append explicit exclusion list to the prompt to prevent repeats
     try:
         if exclusion_texts:
-            items = []
-            seen_items = set()
-            total_chars = 0
-            # Limit the total size of exclusion section
-            for t in exclusion_texts:
-                if not isinstance(t, str):
-                    continue
-                tx = " ".join((t or "").strip().split())
-                if not tx:
-                    continue
-                if tx in seen_items:
-                    continue
-                if total_chars + len(tx) > 6000:  # Reduced from 12000 to 6000
-                    break
-                items.append(tx)
-                seen_items.add(tx)
-                total_chars += len(tx)
+            # Самые вероятные для повтора вопросы, упакованные в бюджет токенов
+            items = select_exclusions(canonical_subject(subject), exclusion_texts, EXCLUSION_TOKEN_BUDGET)
             if items:
                 exclusion_section = (
                     "ЕСКЕРТУ: Төмендегі сұрақтарға оқушы БҰРЫН ДҰРЫС жауап берген. "
                     "Осы сұрақтарды ҚОСПАҢЫЗ. ТЕК ЖАҢА СҰРАҚТАР ҚҰРЫҢЫЗ.\n"
                     "ALREADY_ANSWERED_QUESTIONS:\n"
                 )
-                exclusion_section += "\n".join(items[:50]) + "\n\n"  # Limit to first 50 items
+                exclusion_section += "\n".join(items) + "\n\n"
                 exclusion_section += f"STRICT: Do NOT include these questions. Generate exactly {batch_size} NEW questions.\n\n"
                 content = exclusion_section + content
-                logger.debug(f"Included {len(items)} exclusion items into the prompt")
+                logger.debug("Included %d exclusion items into the prompt", len(items))
     except Exception as e:
         logger.debug(f"Failed to add exclusion list to prompt: {e}")
 
-    # Log final prompt content to terminal when creating the test
-    try:
-        logger.info("=== FINAL PROMPT CONTENT (generate_batch) ===\n" + content)
-    except Exception:
-        pass
-
+    # Промпт выводится только на DEBUG и по умолчанию обрезается (LOG_PAYLOADS)
+    logger.debug("Batch prompt (%d chars): %s", len(content), payload(content))
+    return content
+
+BATCH_SYSTEM_PROMPT = "Сен ЕНТ оқулықтарына негізделген сұрақтар генерациялайтын мұғалімсің."
+# Запас токенов на ответ одной партии для корзины планировщика
+BATCH_COMPLETION_TOKENS = 4000
+RATE_LIMIT_MESSAGE = "Қате: OpenAI лимиті асып кетті. 2-3 минут күтіңіз немесе OpenAI есептік жазбаңызды тексеріңіз: https://platform.openai.com/account/usage"
+
+# Строгая JSON-схема ответа (Structured Outputs). Верхний уровень обязан быть
+# объектом, поэтому вопросы лежат в поле "questions"; парсер понимает оба вида.
+QUESTION_BATCH_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "questions": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "text": {"type": "string"},
+                    "options": {"type": "array", "items": {"type": "string"}},
+                    "correct_option": {"type": "integer", "enum": [0, 1, 2, 3]},
+                    "book_title": {"type": "string"},
+                    "page": {"type": "string"},
+                    "context": {"type": "string"},
+                    "explanation": {"type": "string"},
+                },
+                "required": ["text", "options", "correct_option", "book_title", "page", "context", "explanation"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["questions"],
+    "additionalProperties": False,
+}
+_structured_output_active = STRUCTURED_OUTPUT_ENABLED
+
+def _batch_response_format() -> dict:
+    if not _structured_output_active:
+        return {}
+    return {"response_format": {
+        "type": "json_schema",
+        "json_schema": {"name": "ubt_question_batch", "strict": True, "schema": QUESTION_BATCH_SCHEMA},
+    }}
+
+def _disable_structured_output(error) -> bool:
+    """Если модель не принимает response_format, переходим на обычный JSON-ответ."""
+    global _structured_output_active
+    if _structured_output_active and "response_format" in str(error):
+        _structured_output_active = False
+        logger.warning(f"Structured output rejected by the API, falling back to plain JSON: {error}")
+        return True
+    return False
 
-
-    max_retries = 3
-    retry_delay = 5
-    for attempt in range(max_retries):
-        try:
-            response = client.chat.completions.create(
-                model="gpt-5",
-                messages=[
-                    {"role": "system", "content": "Сен ЕНТ оқулықтарына негізделген сұрақтар генерациялайтын мұғалімсің."},
-                    {"role": "user", "content": content}
-                ],
-            )
-            response_content = response.choices[0].message.content
-            if response_content is None:
-                logger.error("OpenAI жауап бос (None)")
-                return []
-            cleaned_response = clean_response(response_content)
-            if not cleaned_response:
+def generate_batch(subject, batch_size=10, exclusion_texts=None):
+    content = build_batch_prompt(subject, batch_size, exclusion_texts)
+    est_tokens = estimate_request_tokens(BATCH_SYSTEM_PROMPT, content, completion=BATCH_COMPLETION_TOKENS)
+    with track_call("generate_batch", model="gpt-5", subject=canonical_subject(subject)) as m:
+        # Повтор нужен только для перехода с JSON-схемы на обычный JSON;
+        # 429 повторяет планировщик запросов
+        for _ in range(2):
+            try:
+                response = call_openai(
+                    client.chat.completions,
+                    metrics=m,
+                    est_tokens=est_tokens,
+                    model="gpt-5",
+                    messages=[
+                        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                        {"role": "user", "content": content}
+                    ],
+                    **_batch_response_format(),
+                )
+                m.add_usage(response.usage)
+                response_content = response.choices[0].message.content
+                if response_content is None:
+                    logger.error("OpenAI жауап бос (None)")
+                    m.outcome = "empty"
+                    return []
+                questions = parse_question_batch(response_content)
+                logger.debug("Generated batch: %d questions", len(questions))
+                return questions
+            except BadRequestError as e:
+                if _disable_structured_output(e):
+                    m.retry()
+                    continue
+                logger.error(f"Ошибка генерации партии: {str(e)}")
+                _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+                m.outcome = "bad_request"
                 return []
-            questions = json.loads(cleaned_response)
-            logger.debug(f"Generated batch: {len(questions)} questions")
-            return questions
-        except RateLimitError:
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-                retry_delay *= 2
-            else:
+            except RateLimitError:
                 logger.error("OpenAI rate limit exceeded")
-                st.error("Қате: OpenAI лимиті асып кетті. 2-3 минут күтіңіз немесе OpenAI есептік жазбаңызды тексеріңіз: https://platform.openai.com/account/usage")
+                _report_error(RATE_LIMIT_MESSAGE)
+                m.outcome = "rate_limited"
+                return []
+            except Exception as e:
+                logger.error(f"Ошибка генерации партии: {str(e)}")
+                _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+                m.outcome = "error"
                 return []
+        m.outcome = "exhausted"
+        return []
+
+def stream_batch(subject, batch_size=10, exclusion_texts=None, stop_event=None):
+    """
+    Потоковый вариант generate_batch: вопросы разбираются по одному по мере
+    поступления токенов и сразу отдаются вызывающему (генератор).
+    Если stop_event установлен, поток ответа закрывается досрочно.
+    """
+    content = build_batch_prompt(subject, batch_size, exclusion_texts)
+    est_tokens = estimate_request_tokens(BATCH_SYSTEM_PROMPT, content, completion=BATCH_COMPLETION_TOKENS)
+    stream = None
+    with track_call("stream_batch", model="gpt-5", subject=canonical_subject(subject)) as m:
+        for _ in range(2):
+            try:
+                stream = call_openai(
+                    client.chat.completions,
+                    metrics=m,
+                    est_tokens=est_tokens,
+                    model="gpt-5",
+                    messages=[
+                        {"role": "system", "content": BATCH_SYSTEM_PROMPT},
+                        {"role": "user", "content": content}
+                    ],
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **_batch_response_format(),
+                )
+                break
+            except BadRequestError as e:
+                if _disable_structured_output(e):
+                    m.retry()
+                    continue
+                logger.error(f"Ошибка генерации партии: {str(e)}")
+                _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+                m.outcome = "bad_request"
+                return
+            except RateLimitError:
+                logger.error("OpenAI rate limit exceeded")
+                _report_error(RATE_LIMIT_MESSAGE)
+                m.outcome = "rate_limited"
+                return
+            except Exception as e:
+                logger.error(f"Ошибка генерации партии: {str(e)}")
+                _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+                m.outcome = "error"
+                return
+        if stream is None:
+            m.outcome = "exhausted"
+            return
+        parser = JsonObjectStream()
+        try:
+            for chunk in stream:
+                if stop_event is not None and stop_event.is_set():
+                    logger.debug("Streamed batch stopped early")
+                    m.outcome = "stopped"
+                    break
+                # Последний чанк (include_usage) содержит usage и пустой choices
+                if getattr(chunk, "usage", None):
+                    m.add_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                for q in parser.feed(delta):
+                    yield q
+        except Exception as e:
+            logger.error(f"Ошибка потоковой генерации партии: {str(e)}")
+            _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+            m.outcome = "error"
+        finally:
+            try:
+                stream.close()
+            except Exception:
+                pass
+        logger.debug("Streamed batch: %d questions, %d malformed, truncated=%s", parser.emitted, parser.malformed, parser.pending)
+
+def validate_generated_question(q) -> tuple[str, str] | None:
+    """
+    Проверяет сгенерированный вопрос. Возвращает None, если вопрос валиден,
+    иначе пару (правило, текст ошибки для пользователя); правило используется
+    для подсчёта причин отбраковки.
+    """
+    required_fields = ["text", "options", "correct_option", "book_title", "page", "context", "explanation"]
+    if not isinstance(q, dict) or not all(key in q for key in required_fields):
+        logger.error(f"Missing required fields: {q}")
+        return "missing_fields", f"Міндетті өрістер жоқ: {q}"
+    if not isinstance(q["options"], list) or len(q["options"]) != 4:
+        logger.error(f"Invalid options count: {q['options']}")
+        return "options_count", f"Жауап нұсқаларының саны қате: {q['options']}"
+    if not isinstance(q["correct_option"], int) or q["correct_option"] not in range(4):
+        logger.error(f"Invalid correct_option: {q['correct_option']}")
+        return "correct_option", f"Қате correct_option: {q['correct_option']}"
+    if not isinstance(q.get("page"), str) or not re.match(r'^\d+[-]?\d*\s*бет$', q.get("page", "")):
+        logger.error(f"Invalid page format: {q.get('page')}")
+        return "page_format", f"Бет пішімі қате: {q.get('page')}"
+    if not q.get("context"):
+        logger.error(f"Missing context: {q}")
+        return "context", f"Контекст жоқ: {q}"
+    if not q.get("explanation"):
+        logger.error(f"Missing explanation: {q}")
+        return "explanation", f"Түсініктеме жоқ: {q}"
+    return None
+
+def _merge_batch(batch_questions, questions, solved_text_keys, seen_text_keys, cache, on_invalid=None,
+                 near_index=None, semantic_index=None, embeddings=None, stats=None, citations=None):
+    """
+    Проверяет вопросы партии и добавляет в questions те, что не повторяются
+    по create_unique_question_key, а при заданном near_index — и почти
+    повторяющиеся (перефразированные) вопросы. При заданном semantic_index
+    оставшиеся кандидаты одним запросом получают эмбеддинги и отсеиваются
+    векторной проверкой top-1 косинуса; векторы принятых вопросов
+    сохраняются в embeddings. При заданном citations (CitationIndex)
+    book_title, page и context сверяются с учебниками: неверная ссылка
+    исправляется по найденному контексту или вопрос отбраковывается.
+    Счётчики исходов пишутся в stats (Counter).
+    Не трогает Streamlit, если on_invalid не задан.
+    """
+    stats = stats if stats is not None else Counter()
+    candidates = []
+    for q in batch_questions:
+        rejection = validate_generated_question(q)
+        if rejection:
+            rule, error_msg = rejection
+            stats["invalid"] += 1
+            stats[f"invalid_{rule}"] += 1
+            if on_invalid:
+                on_invalid(error_msg)
+            continue
+        if citations is not None:
+            verdict = citations.verify(q)
+            if verdict == "corrected":
+                stats["citation_corrected"] += 1
+                logger.debug("Corrected citation to %s, %s", q.get("book_title"), q.get("page"), extra={"sample": "merge_citation"})
+            elif verdict:
+                rule, error_msg = verdict
+                stats["invalid"] += 1
+                stats[f"invalid_{rule}"] += 1
+                logger.debug("Rejected citation (%s): %s", rule, payload(error_msg), extra={"sample": "merge_citation"})
+                continue
+        stats["candidates"] += 1
+
+        q_text = q.get("text", "")
+        q_key = create_unique_question_key(q)
+        q["question_key"] = q_key  # сохраняется вместе с тестом в saved_tests
+        logger.debug("Checking question %s: %s", q_key, payload(q_text), extra={"sample": "merge_check"})
+
+        if q_key in solved_text_keys:
+            stats["duplicate_solved"] += 1
+            logger.debug("Skipping already solved question: %s", q_key, extra={"sample": "merge_skip"})
+            continue
+        if q_key in seen_text_keys:
+            stats["duplicate_in_test"] += 1
+            logger.debug("Skipping question already in current batch: %s", q_key, extra={"sample": "merge_skip"})
+            continue
+        fingerprint = None
+        if near_index is not None:
+            fingerprint = near_index.signature(fingerprint_text(q_text))
+            match = near_index.find("", sig=fingerprint) if fingerprint else None
+            if match:
+                stats["duplicate_near"] += 1
+                logger.debug("Skipping near-duplicate of a known question (similarity=%.2f): %s", match[1], q_key, extra={"sample": "merge_skip"})
+                continue
+        candidates.append((q, q_key, fingerprint))
+
+    vectors = None
+    if semantic_index is not None and candidates:
+        vectors = embed_question_texts([q.get("text", "") for q, _, _ in candidates])
+        if vectors is not None:
+            similarities, nearest = semantic_index.top1(vectors)
+
+    for i, (q, q_key, fingerprint) in enumerate(candidates):
+        if len(questions) >= TEST_SIZE:
+            stats["overflow"] += len(candidates) - i
+            break
+        if vectors is not None and similarities[i] >= SEMANTIC_DUPLICATE_THRESHOLD:
+            stats["duplicate_semantic"] += 1
+            logger.debug("Skipping semantic repeat of solved question %s (cosine=%.3f): %s", nearest[i], similarities[i], q_key, extra={"sample": "merge_skip"})
+            continue
+        if q in questions or q in cache or q_key in seen_text_keys:
+            stats["duplicate_in_test"] += 1
+            logger.debug("Skipping question already in test or cache: %s", q_key, extra={"sample": "merge_skip"})
+            continue
+        questions.append(q)
+        seen_text_keys.add(q_key)
+        cache.append(q)
+        stats["accepted"] += 1
+        if fingerprint:
+            near_index.add("", key=q_key, sig=fingerprint)
+        if vectors is not None and embeddings is not None:
+            embeddings[q_key] = vectors[i]
+        logger.debug("Added question: %s", q_key, extra={"sample": "merge_added"})
+
+def _duplicate_count(stats) -> int:
+    return sum(n for reason, n in stats.items() if reason.startswith("duplicate_"))
+
+def record_acceptance(subject, user_id, stats):
+    """
+    Обновляет оценку доли годных вопросов: принятые плюс годные, но лишние
+    (тест уже набран), от всех разобранных.
+    """
+    parsed = stats["candidates"] + stats["invalid"]
+    acceptance.record(subject, user_id, stats["accepted"] + stats["overflow"], parsed)
+
+def log_rejection_counts(subject, stats):
+    rejected = {reason: n for reason, n in sorted(stats.items()) if reason.startswith(("invalid_", "duplicate_")) and n}
+    logger.info(f"Question rejections for subject '{subject}': {rejected or 'none'} "
+                f"(accepted from {stats['candidates']} valid of {stats['candidates'] + stats['invalid']} parsed)")
+
+def _produce_batch(subject, exclusion_texts, emit, stop_event, batch_size=BATCH_SIZE):
+    """
+    Генерирует одну партию и передаёт каждый вопрос в emit: в потоковом
+    режиме — сразу после разбора, иначе — после получения всего ответа.
+    Профиль генерации обновляется один раз на партию в обоих режимах
+    (каждое обновление — шаг затухания).
+    """
+    subj = canonical_subject(subject)
+    if GENERATION_STREAM:
+        streamed = []
+        try:
+            for q in stream_batch(subject, batch_size, exclusion_texts, stop_event=stop_event):
+                if isinstance(q, dict):
+                    streamed.append(q.get("text"))
+                emit(q)
+        finally:
+            observe_generated(subj, streamed)
+    else:
+        batch_questions = generate_batch(subject, batch_size=batch_size, exclusion_texts=exclusion_texts) or []
+        observe_generated(subj, [q.get("text") for q in batch_questions if isinstance(q, dict)])
+        for q in batch_questions:
+            emit(q)
+
+def _plan_batches(missing: int, expected_yield: float, max_batches: int) -> list[int]:
+    """
+    Делит запрос на партии: всего нужно missing / expected_yield вопросов,
+    партий не больше max_batches, размер каждой — в пределах [MIN_BATCH_SIZE, MAX_BATCH_SIZE].
+    """
+    total = plan_batch_size(missing, expected_yield, MIN_BATCH_SIZE, MAX_BATCH_SIZE * max_batches)
+    if total <= 0:
+        return []
+    count = max(1, min(max_batches, -(-total // BATCH_SIZE)))
+    size = plan_batch_size(-(-missing // count), expected_yield, MIN_BATCH_SIZE, MAX_BATCH_SIZE)
+    return [size] * count
+
+class _MergeBuffer:
+    """
+    Копит потоковые вопросы и передаёт их в merge группой: когда набрано
+    MERGE_BUFFER_SIZE (или столько, сколько не хватает до теста), либо когда
+    первый вопрос группы ждёт дольше MERGE_WINDOW_SECONDS. Так эмбеддинги
+    для семантической проверки запрашиваются одним вызовом на группу.
+    """
+
+    def __init__(self, merge, questions):
+        self.merge = merge
+        self.questions = questions
+        self.items = []  # (партия, вопрос)
+        self.started = None
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def time_left(self):
+        """Секунд до принудительного сброса; None, если буфер пуст."""
+        if not self.items:
+            return None
+        return max(0.0, MERGE_WINDOW_SECONDS - (time.monotonic() - self.started))
+
+    def add(self, batch_id, q):
+        """Добавляет вопрос; возвращает результат flush() или None, если сброса не было."""
+        if not self.items:
+            self.started = time.monotonic()
+        self.items.append((batch_id, q))
+        if len(self.items) >= min(MERGE_BUFFER_SIZE, max(1, TEST_SIZE - len(self.questions))) or not self.time_left():
+            return self.flush()
+        return None
+
+    def flush(self) -> Counter:
+        """Передаёт накопленное в merge; возвращает число принятых вопросов по партиям."""
+        items, self.items = self.items, []
+        accepted = Counter()
+        if not items:
+            return accepted
+        before = len(self.questions)
+        self.merge([q for _, q in items])
+        added = {id(q) for q in self.questions[before:]}
+        for batch_id, q in items:
+            if id(q) in added:
+                accepted[batch_id] += 1
+        return accepted
+
+def _generate_sequential(subject, exclusion_texts, questions, merge, on_progress=None, expected_yield=1.0):
+    attempts = 0
+    buffer = _MergeBuffer(merge, questions)
+    while len(questions) < TEST_SIZE and attempts < MAX_BATCH_ATTEMPTS:
+        try:
+            if on_progress:
+                on_progress()
+            stop_event = threading.Event()
+
+            def emit(q):
+                if buffer.add(None, q) is None:
+                    return
+                if on_progress:
+                    on_progress()
+                if len(questions) >= TEST_SIZE:
+                    stop_event.set()
+
+            batch_size = plan_batch_size(TEST_SIZE - len(questions), expected_yield, MIN_BATCH_SIZE, MAX_BATCH_SIZE)
+            _produce_batch(subject, exclusion_texts, emit, stop_event, batch_size)
+            buffer.flush()
+            attempts += 1
         except Exception as e:
             logger.error(f"Ошибка генерации партии: {str(e)}")
-            st.error(f"Партияны генерациялау кезінде қате: {str(e)}")
-            return []
-        time.sleep(1)
+            _report_error(f"Партияны генерациялау кезінде қате: {str(e)}")
+            buffer.flush()
+            attempts += 1
+
+_BATCH_DONE = object()
+
+def _generate_concurrent(subject, exclusion_texts, questions, merge, on_progress, expected_yield=1.0):
+    """
+    Генерирует нужные партии параллельно в ограниченном пуле потоков.
+    Вопросы из потоков передаются через очередь и объединяются в потоке
+    скрипта группами (_MergeBuffer); как только набрано TEST_SIZE вопросов, не начатые партии
+    отменяются, а идущие останавливаются через stop_event. Новая партия
+    запускается, только если ожидаемого выхода уже идущих партий не хватает.
+    """
+    executor = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="test-batch")
+    results: queue.Queue = queue.Queue()
+    stop_event = threading.Event()
+    outstanding: dict[int, float] = {}  # партия -> ожидаемое число ещё не полученных годных вопросов
+    submitted = 0
+
+    def worker(batch_id, batch_size):
+        try:
+            _produce_batch(subject, exclusion_texts, lambda q: results.put((batch_id, q)), stop_event, batch_size)
+        except Exception as e:
+            logger.error(f"Ошибка генерации партии: {str(e)}")
+        finally:
+            results.put((batch_id, _BATCH_DONE))
+
+    bound_worker = bind_context(worker)
+    buffer = _MergeBuffer(merge, questions)
+
+    def account(accepted):
+        for batch_id, count in accepted.items():
+            if batch_id in outstanding:
+                outstanding[batch_id] = max(0.0, outstanding[batch_id] - count)
+
+    try:
+        while len(questions) < TEST_SIZE:
+            uncovered = TEST_SIZE - len(questions) - math.ceil(sum(outstanding.values()))
+            free_slots = min(GENERATION_WORKERS - len(outstanding), MAX_BATCH_ATTEMPTS - submitted)
+            if uncovered > 0 and free_slots > 0:
+                for batch_size in _plan_batches(uncovered, expected_yield, free_slots):
+                    executor.submit(bound_worker, submitted, batch_size)
+                    outstanding[submitted] = batch_size * expected_yield
+                    submitted += 1
+            if not outstanding:
+                if not buffer:
+                    break
+                account(buffer.flush())
+                continue
+            on_progress()
+            try:
+                batch_id, item = results.get(timeout=buffer.time_left())
+            except queue.Empty:
+                account(buffer.flush())
+                continue
+            if item is _BATCH_DONE:
+                outstanding.pop(batch_id, None)
+                continue
+            account(buffer.add(batch_id, item) or {})
+        logger.debug(f"Concurrent generation finished: {submitted} batches submitted, {len(outstanding)} leftover stopped")
+    finally:
+        stop_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
 
-def generate_test(subject):
+# Поля вопроса, которые хранятся в общем банке
+_BANK_QUESTION_FIELDS = ("text", "options", "correct_option", "book_title", "page", "context", "explanation")
+
+def fetch_bank_questions(user_id, subject: str, exclude_keys, limit: int) -> list:
+    """
+    Случайные вопросы предмета из общего банка question_bank, которые
+    пользователь ещё не решил (проверяется на стороне БД в sample_question_bank)
+    и которых нет в exclude_keys.
+    """
+    if not QUESTION_BANK_ENABLED or limit <= 0:
+        return []
+    try:
+        resp = supabase.rpc("sample_question_bank", {
+            "p_user_id": user_id,
+            "p_subject": canonical_subject(subject),
+            "p_exclude": sorted(exclude_keys or []),
+            "p_limit": limit,
+        }).execute()
+    except Exception as e:
+        logger.error(f"Error sampling question bank: {e}")
+        return []
+    questions = []
+    for row in (resp.data or []):
+        q = row.get("question")
+        if isinstance(q, str):
+            try:
+                q = json.loads(q)
+            except json.JSONDecodeError:
+                continue
+        if isinstance(q, dict):
+            q = {field: q.get(field) for field in _BANK_QUESTION_FIELDS}
+            questions.append(q)
+    logger.info(f"Sampled {len(questions)} bank questions for subject '{subject}'")
+    return questions
+
+def store_bank_questions(subject: str, questions: list):
+    """
+    Добавляет проверенные сгенерированные вопросы в общий банк через RPC
+    add_bank_questions: прямая вставка в question_bank с клиента запрещена,
+    функция повторно проверяет строки на стороне БД (повторы игнорируются).
+    """
+    if not QUESTION_BANK_ENABLED or not questions:
+        return
+    subj = canonical_subject(subject)
+    rows = []
+    for q in questions:
+        rows.append({
+            "question_key": get_question_key(q),
+            "question": {field: q.get(field) for field in _BANK_QUESTION_FIELDS},
+        })
+    try:
+        resp = supabase.rpc("add_bank_questions", {"p_subject": subj, "p_rows": rows}).execute()
+        logger.info(f"Stored {resp.data} of {len(rows)} generated questions in the question bank for subject '{subj}'")
+    except Exception as e:
+        logger.error(f"Error storing questions in the question bank: {e}")
+
+def _fill_from_bank(user_id, subject, exclude_keys, questions, merge_bank):
+    """
+    Заполняет тест вопросами из банка через merge_bank (те же проверки на
+    повторы, что и для сгенерированных). Возвращает ключи вопросов из банка.
+    """
+    before_cnt = len(questions)
+    bank_questions = fetch_bank_questions(user_id, subject, exclude_keys, 2 * (TEST_SIZE - before_cnt))
+    if bank_questions:
+        merge_bank(bank_questions)
+    return {q["question_key"] for q in questions[before_cnt:]}
+
+def generate_test(subject, on_question=None):
+    """
+    Генерирует тест из TEST_SIZE вопросов. on_question(question, number)
+    вызывается для каждого принятого вопроса сразу после проверки, чтобы
+    интерфейс мог показывать вопросы до окончания генерации.
+    """
     questions = []
-    attempts = 0
-    max_attempts = 5
 
     if f"cached_test_{subject}" not in st.session_state:
         st.session_state[f"cached_test_{subject}"] = []
@@ -408,7 +1151,7 @@ def generate_test(subject):
     exclusion_texts = []
     try:
         exclusion_texts = fetch_exclusion_texts(subj, solved_text_keys, max_items=500)  # Reduced from 2000 to 500
-        logger.debug(f"Fetched {len(exclusion_texts)} exclusion texts from saved_tests")
+        logger.debug(f"Fetched {len(exclusion_texts)} exclusion texts")
     except Exception as e:
         logger.debug(f"Exclusion texts fetch failed: {e}")
     seen_text_keys = set()
@@ -416,101 +1159,219 @@ def generate_test(subject):
     if isinstance(excluded_session, set):
         solved_text_keys |= excluded_session
     logger.debug(f"Total solved keys to exclude: {len(solved_text_keys)}")
-    logger.debug(f"Sample solved keys: {list(solved_text_keys)[:3]}")
+    # Отпечатки решённых вопросов; принятые в тест вопросы добавляются в копию
+    user_id = get_current_user_id()
+    near_index = solved_near_duplicate_index(user_id, subj, exclusion_texts)
+    near_index.update(get_session_near_duplicate_index(subj))
+    semantic_index = load_semantic_index(user_id, subj, exclusion_texts)
+    embeddings = st.session_state.setdefault(f"question_embeddings_{subj}", {})
+    citations = get_citation_index(subj)
+    stats = Counter()
 
     # Create progress bar
     progress_bar = st.progress(0)
     status_text = st.empty()
-    
-    while len(questions) < 20 and attempts < max_attempts:
-        try:
-            # Update progress
-            progress = min(len(questions) / 20, 1.0)
-            progress_bar.progress(progress)
-            status_text.text(f"Сұрақтар генерациялануда... {len(questions)}/20")
-            
-            batch_questions = generate_batch(subject, batch_size=10, exclusion_texts=exclusion_texts)
-            if not batch_questions:
-                attempts += 1
-                continue
-            before_cnt = len(batch_questions)
-            logger.debug(f"Generated batch of {before_cnt} questions")
-            
-            for q in batch_questions:
-                required_fields = ["text", "options", "correct_option", "book_title", "page", "context", "explanation"]
-                if not all(key in q for key in required_fields):
-                    logger.error(f"Missing required fields: {q}")
-                    st.error(f"Міндетті өрістер жоқ: {q}")
-                    continue
-                if len(q["options"]) != 4:
-                    logger.error(f"Invalid options count: {q['options']}")
-                    st.error(f"Жауап нұсқаларының саны қате: {q['options']}")
-                    continue
-                if not isinstance(q["correct_option"], int) or q["correct_option"] not in range(4):
-                    logger.error(f"Invalid correct_option: {q['correct_option']}")
-                    st.error(f"Қате correct_option: {q['correct_option']}")
-                    continue
-                if not re.match(r'^\d+[-]?\d*\s*бет$', q.get("page", "")):
-                    logger.error(f"Invalid page format: {q.get('page')}")
-                    st.error(f"Бет пішімі қате: {q.get('page')}")
-                    continue
-                if not q.get("context"):
-                    logger.error(f"Missing context: {q}")
-                    st.error(f"Контекст жоқ: {q}")
-                    continue
-                if not q.get("explanation"):
-                    logger.error(f"Missing explanation: {q}")
-                    st.error(f"Түсініктеме жоқ: {q}")
-                    continue
-                
-                q_text = q.get("text", "")
-                q_key = create_unique_question_key(q)  # Use unique key generation
-                logger.debug(f"Checking question: '{q_text[:50]}...' -> UNIQUE key: {q_key}")
-                
-                if q_key in solved_text_keys:
-                    logger.debug(f"SKIPPING - Question already solved: {q_key}")
-                    continue
-                if q_key in seen_text_keys:
-                    logger.debug(f"SKIPPING - Question already in current batch: {q_key}")
-                    continue
-                if q not in questions and q not in st.session_state[f"cached_test_{subject}"]:
-                    questions.append(q)
-                    seen_text_keys.add(q_key)
-                    st.session_state[f"cached_test_{subject}"].append(q)
-                    logger.debug(f"ADDED question: {q_key}")
-                else:
-                    logger.debug(f"SKIPPING - Question already in test or cache")
-                    
-            after_cnt = len(questions)
-            logger.debug(f"Batch processing: {before_cnt} candidates -> {after_cnt} total questions so far")
-            attempts += 1
-       
-        except Exception as e:
-            logger.error(f"Ошибка генерации партии: {str(e)}")
-            st.error(f"Партияны генерациялау кезінде қате: {str(e)}")
-            attempts += 1
 
+    def on_progress():
+        progress_bar.progress(min(len(questions) / TEST_SIZE, 1.0))
+        status_text.text(f"Сұрақтар генерациялануда... {len(questions)}/{TEST_SIZE}")
+
+    def merge(batch_questions, on_invalid=st.error, batch_stats=stats):
+        before_cnt = len(questions)
+        _merge_batch(batch_questions, questions, solved_text_keys, seen_text_keys,
+                     cache=st.session_state[f"cached_test_{subject}"], on_invalid=on_invalid,
+                     near_index=near_index, semantic_index=semantic_index, embeddings=embeddings, stats=batch_stats,
+                     citations=citations)
+        logger.debug("Batch processing: %d candidates -> %d total questions so far (+%d)", len(batch_questions), len(questions), len(questions) - before_cnt)
+        if on_question:
+            for number in range(before_cnt, len(questions)):
+                on_question(questions[number], number + 1)
+
+    # Сначала — вопросы из общего банка; их статистика не влияет на оценку выхода модели
+    bank_stats = Counter()
+    bank_keys = _fill_from_bank(user_id, subj, excluded_session if isinstance(excluded_session, set) else set(),
+                                questions, lambda batch: merge(batch, on_invalid=None, batch_stats=bank_stats))
+    on_progress()
+    logger.info(f"Question bank supplied {len(bank_keys)}/{TEST_SIZE} questions for subject '{subj}'")
+
+    expected_yield = acceptance.expected_yield(subj, user_id)
+    logger.debug(f"Expected yield for subject '{subj}': {expected_yield:.2f}")
+    if GENERATION_WORKERS > 1:
+        _generate_concurrent(subject, exclusion_texts, questions, merge, on_progress, expected_yield)
+    else:
+        _generate_sequential(subject, exclusion_texts, questions, merge, on_progress, expected_yield)
 
     # Clear progress bar
     progress_bar.empty()
     status_text.empty()
+    if stats["candidates"] or stats["invalid"]:
+        record_duplicate_rate(subj, stats["candidates"], _duplicate_count(stats))
+        log_rejection_counts(subj, stats)
+        record_acceptance(subj, user_id, stats)
+    store_bank_questions(subj, [q for q in questions if q["question_key"] not in bank_keys])
     
-    if len(questions) < 20:
-        logger.error(f"Generated only {len(questions)} questions instead of 20 (subject={subj})")
+    if len(questions) < TEST_SIZE:
+        logger.error(f"Generated only {len(questions)} questions instead of {TEST_SIZE} (subject={subj})")
         if len(questions) == 0:
             st.info("Бұл пән бойынша жаңа сұрақтар қалған жоқ. Қателеріңізді қайталап шығыңыз.")
         else:
-            st.error(f"20 сұрақтың орнына тек {len(questions)} сұрақ құрылды.")
+            st.error(f"{TEST_SIZE} сұрақтың орнына тек {len(questions)} сұрақ құрылды.")
         return questions
 
     logger.debug(f"=== FINAL TEST GENERATED: {len(questions)} questions ===")
-    return questions[:20]
+    return questions[:TEST_SIZE]
+
+# --- Фоновая предзагрузка следующего теста ---
+# Слоты хранятся на уровне процесса по ключу (user_id, subject): фоновые потоки
+# не имеют доступа к st.session_state.
+_prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="test-prefetch")
+_prefetch_slots: dict = {}
+_prefetch_lock = threading.Lock()
+
+def _prefetch_worker(user_id, subject, exclude_keys, exclude_texts, session_index):
+    subj = canonical_subject(subject)
+    solved_keys = fetch_solved_keys_from_db(user_id, subj) | set(exclude_keys)
+    exclusion_texts = []
+    try:
+        exclusion_texts = fetch_exclusion_texts(subj, solved_keys, max_items=500, user_id=user_id)
+    except Exception as e:
+        logger.debug(f"Prefetch exclusion texts fetch failed: {e}")
+    near_index = solved_near_duplicate_index(user_id, subj, exclusion_texts)
+    for text in exclude_texts:
+        if isinstance(text, str):
+            near_index.add(fingerprint_text(text))
+    near_index.update(session_index)
+    semantic_index = load_semantic_index(user_id, subj, exclusion_texts)
+    citations = get_citation_index(subj)
+    questions = []
+    seen_keys = set()
+    embeddings = {}
+    stats = Counter()
+
+    def merge(batch_questions, batch_stats=stats):
+        _merge_batch(batch_questions, questions, solved_keys, seen_keys, cache=[], near_index=near_index,
+                     semantic_index=semantic_index, embeddings=embeddings, stats=batch_stats, citations=citations)
+
+    bank_keys = _fill_from_bank(user_id, subj, exclude_keys, questions,
+                                lambda batch: merge(batch, batch_stats=Counter()))
+    _generate_sequential(subject, exclusion_texts, questions, merge,
+                         expected_yield=acceptance.expected_yield(subj, user_id))
+    if stats["candidates"] or stats["invalid"]:
+        record_duplicate_rate(subj, stats["candidates"], _duplicate_count(stats))
+        log_rejection_counts(subj, stats)
+        record_acceptance(subj, user_id, stats)
+    store_bank_questions(subj, [q for q in questions if q["question_key"] not in bank_keys])
+    logger.info(f"Prefetched {len(questions)} questions for user_id={user_id}, subject='{subj}'")
+    return questions, seen_keys, embeddings
+
+def start_prefetch(subject, current_questions):
+    """
+    Запускает в фоне генерацию следующего теста по тому же предмету, пока
+    открыт текущий. Исключаются решённые вопросы и вопросы текущего теста.
+    """
+    if not PREFETCH_ENABLED:
+        return
+    user_id = get_current_user_id()
+    if not user_id:
+        return
+    subj = canonical_subject(subject)
+    slot_key = (user_id, subj)
+    now = time.time()
+    with _prefetch_lock:
+        for key, slot in list(_prefetch_slots.items()):
+            if now - slot["created_at"] > PREFETCH_TTL_SECONDS:
+                slot["future"].cancel()
+                del _prefetch_slots[key]
+        existing = _prefetch_slots.get(slot_key)
+        if existing:
+            # Предзагрузка ещё идёт (тест построен без неё): вопросы показанного
+            # теста не должны попасть в следующий
+            existing["shown_after"] |= {get_question_key(q) for q in (current_questions or []) if isinstance(q, dict)}
+            return
+        exclude_keys = set(st.session_state.get(f"excluded_keys_cache_{subj}") or set())
+        exclude_texts = []
+        for q in (current_questions or []):
+            try:
+                exclude_keys.add(get_question_key(q))
+                exclude_texts.append(q.get("text", ""))
+            except Exception:
+                continue
+        session_index = get_session_near_duplicate_index(subj).copy()
+        future = _prefetch_executor.submit(bind_context(_prefetch_worker), user_id, subject, exclude_keys, exclude_texts, session_index)
+        _prefetch_slots[slot_key] = {"future": future, "created_at": now, "solved_after": set(), "shown_after": set()}
+    logger.debug(f"Started test prefetch for user_id={user_id}, subject='{subj}'")
+
+def invalidate_prefetch(user_id, subject, solved_keys):
+    """
+    Вызывается после save_results: сбрасывает предзагруженный тест, если хотя бы
+    один его вопрос стал решённым (дубликатом).
+    """
+    if not solved_keys:
+        return
+    slot_key = (user_id, canonical_subject(subject))
+    with _prefetch_lock:
+        slot = _prefetch_slots.get(slot_key)
+        if not slot:
+            return
+        future = slot["future"]
+        if not future.done():
+            # Проверим при выдаче, когда генерация завершится
+            slot["solved_after"] |= set(solved_keys)
+            return
+        try:
+            _, keys, _ = future.result()
+        except Exception:
+            keys = set()
+        if keys & set(solved_keys):
+            del _prefetch_slots[slot_key]
+            logger.info(f"Invalidated prefetched test for subject '{slot_key[1]}': contains newly solved questions")
+
+def take_prefetched_test(subject):
+    """
+    Забирает предзагруженный тест из слота пользователя. Если генерация ещё
+    идёт, ждёт не дольше PREFETCH_WAIT_SECONDS и возвращает None: тест
+    строится потоково, а слот остаётся для следующего теста. Возвращает None,
+    если готового полного теста нет.
+    """
+    user_id = get_current_user_id()
+    if not user_id:
+        return None
+    subj = canonical_subject(subject)
+    with _prefetch_lock:
+        slot = _prefetch_slots.get((user_id, subj))
+    if not slot:
+        return None
+    try:
+        questions, keys, embeddings = slot["future"].result(timeout=PREFETCH_WAIT_SECONDS)
+    except FutureTimeoutError:
+        logger.info(f"Prefetched test for subject '{subj}' not ready after {PREFETCH_WAIT_SECONDS}s, generating with streaming")
+        return None
+    except Exception as e:
+        logger.debug(f"Prefetched test unavailable: {e}")
+        with _prefetch_lock:
+            _prefetch_slots.pop((user_id, subj), None)
+        return None
+    with _prefetch_lock:
+        if _prefetch_slots.get((user_id, subj)) is not slot:
+            return None
+        del _prefetch_slots[(user_id, subj)]
+    excluded_session = st.session_state.get(f"excluded_keys_cache_{subj}") or set()
+    if keys & (slot["solved_after"] | slot["shown_after"] | set(excluded_session)):
+        logger.info(f"Discarding prefetched test for subject '{subj}': contains solved or already shown questions")
+        return None
+    if len(questions) < TEST_SIZE:
+        return None
+    cache = st.session_state.setdefault(f"cached_test_{subject}", [])
+    cache.extend(questions)
+    st.session_state.setdefault(f"question_embeddings_{subj}", {}).update(embeddings)
+    logger.info(f"Using prefetched test for subject '{subj}'")
+    return questions[:TEST_SIZE]
 
 def load_test_chat_titles(user_id):
     try:
         response = supabase.table("test_chats").select("id, title, created_at").eq("user_id", user_id).execute()
         chats = sorted(response.data, key=lambda x: x["created_at"], reverse=True)
-        logger.debug(f"Loaded test chats for user {user_id}: {chats}")
+        logger.debug("Loaded %d test chats for user %s", len(chats), user_id)
         return chats
     except Exception as e:
         logger.error(f"Ошибка загрузки чатов: {str(e)}")
@@ -521,7 +1382,7 @@ def load_test_chat(chat_id):
     try:
         response = supabase.table("test_chats").select("messages").eq("id", chat_id).execute()
         if response.data:
-            logger.debug(f"Loaded test chat {chat_id}: {response.data[0]}")
+            logger.debug("Loaded test chat %s: %s", chat_id, payload(response.data[0]))
             return response.data[0]["messages"]
         return []
     except Exception as e:
@@ -555,7 +1416,8 @@ def save_test_chat(chat_id, user_id, messages, title):
 def delete_test_chat(chat_id):
     try:
         response = supabase.table("test_chats").delete().eq("id", chat_id).execute()
-        logger.debug(f"Deleted test chat {chat_id}: {response.data}")
+        discard_chat_threads(client, response.data)
+        logger.debug("Deleted test chat %s", chat_id)
         return response.data is not None
     except Exception as e:
         logger.error(f"Ошибка удаления чата {chat_id}: {str(e)}")
@@ -573,7 +1435,8 @@ def cleanup_empty_test_chats(user_id):
             msgs = row.get("messages") or []
             if not msgs:
                 try:
-                    supabase.table("test_chats").delete().eq("id", row.get("id")).execute()
+                    deleted = supabase.table("test_chats").delete().eq("id", row.get("id")).execute()
+                    discard_chat_threads(client, deleted.data)
                 except Exception:
                     continue
     except Exception as e:
@@ -593,75 +1456,139 @@ def save_or_update_saved_test(chat_id, user_id, subject, test_json):
     try:
         existing = supabase.table("saved_tests").select("id").eq("id", chat_id).execute()
         now_iso = datetime.utcnow().isoformat()
-        payload = {
+        row = {
             "subject": subject,
             "test_json": test_json,
             "updated_at": now_iso
         }
         if existing.data:
-            supabase.table("saved_tests").update(payload).eq("id", chat_id).execute()
+            supabase.table("saved_tests").update(row).eq("id", chat_id).execute()
         else:
-            payload.update({
+            row.update({
                 "id": chat_id,
                 "user_id": user_id,
                 "created_at": now_iso
             })
-            supabase.table("saved_tests").insert(payload).execute()
+            supabase.table("saved_tests").insert(row).execute()
         logger.debug(f"Saved full test payload for chat {chat_id}")
     except Exception as e:
         logger.error(f"Ошибка сохранения полного теста: {str(e)}")
         
-def fetch_exclusion_texts(subject: str, solved_keys: set, max_items: int = 100) -> list[str]:
+def store_solved_question_texts(user_id, subject, rows):
     """
-    Возвращает список текстов вопросов, которые пользователь уже решил правильно
-    (по их ключам), извлекая их из сохранённых тестов в таблице saved_tests.
-    Эти тексты добавляются в промпт как список исключений для GPT.
+    Записывает тексты решённых вопросов в узкую таблицу solved_questions
+    (user_id, subject, question_key, text), из которой строится список исключений.
+    rows — пары (question_key, text).
     """
-    texts: list[str] = []
-    if not solved_keys:
-        return texts
-    user_id = get_current_user_id()
-    if not user_id:
-        return texts
-    subj = canonical_subject(subject)
+    records = [
+        {"user_id": user_id, "subject": subject, "question_key": qkey, "text": text}
+        for qkey, text in rows
+        if isinstance(text, str) and text.strip()
+    ]
+    if not records:
+        return
+    try:
+        supabase.table("solved_questions").upsert(records, on_conflict="user_id,subject,question_key").execute()
+        logger.debug(f"Stored {len(records)} solved question texts for subject '{subject}'")
+    except Exception as e:
+        logger.error(f"Error storing solved question texts: {e}")
+
+def _fetch_solved_question_texts(user_id, subject, limit):
+    """Пары (question_key, text) из solved_questions, новые первыми; None при ошибке."""
     try:
-        # Читаем недавние сохранённые тесты для пользователя и предмета
         resp = (
             supabase
-            .table("saved_tests")
-            .select("test_json")
+            .table("solved_questions")
+            .select("question_key,text")
             .eq("user_id", user_id)
-            .eq("subject", subj)
-            .order("updated_at", desc=True)
-            .limit(min(max_items, 1000))
+            .eq("subject", subject)
+            .order("solved_at", desc=True)
+            .limit(limit)
             .execute()
         )
-        seen_keys = set()
-        for row in (resp.data or []):
-            payload = row.get("test_json")
+        return [(row.get("question_key"), row.get("text")) for row in (resp.data or [])]
+    except Exception as e:
+        logger.debug(f"solved_questions query failed: {e}")
+        return None
+
+def _scan_saved_tests_for_texts(user_id, subject, solved_keys, skip_keys, max_items):
+    """
+    Старый путь: ищет тексты решённых вопросов в полных тестах saved_tests.
+    Нужен для тестов, сохранённых до появления solved_questions.
+    """
+    found = []
+    resp = (
+        supabase
+        .table("saved_tests")
+        .select("test_json")
+        .eq("user_id", user_id)
+        .eq("subject", subject)
+        .order("updated_at", desc=True)
+        .limit(min(max_items, 1000))
+        .execute()
+    )
+    seen_keys = set(skip_keys)
+    for row in (resp.data or []):
+        test_json = row.get("test_json")
+        try:
+            # В некоторых драйверах это может быть строка
+            if isinstance(test_json, str):
+                test_json = json.loads(test_json)
+        except Exception:
+            continue
+        if not isinstance(test_json, dict):
+            continue
+        questions = test_json.get("questions") or []
+        if not isinstance(questions, list):
+            continue
+        for q in questions:
             try:
-                # В некоторых драйверах это может быть строка
-                if isinstance(payload, str):
-                    payload = json.loads(payload)
+                qkey = get_question_key(q)
             except Exception:
                 continue
-            if not isinstance(payload, dict):
-                continue
-            questions = payload.get("questions") or []
-            if not isinstance(questions, list):
-                continue
-            for q in questions:
-                try:
-                    qkey = create_unique_question_key(q)
-                except Exception:
-                    continue
-                if qkey in solved_keys and qkey not in seen_keys:
-                    qtext = q.get("text")
-                    if isinstance(qtext, str) and qtext.strip():
-                        texts.append(qtext)
-                        seen_keys.add(qkey)
-                        if len(texts) >= max_items:
-                            return texts
+            if qkey in solved_keys and qkey not in seen_keys:
+                qtext = q.get("text")
+                if isinstance(qtext, str) and qtext.strip():
+                    found.append((qkey, qtext))
+                    seen_keys.add(qkey)
+                    if len(found) >= max_items:
+                        return found
+    return found
+
+# (user_id, subject), для которых solved_questions уже дополнена из saved_tests в этом процессе
+_solved_texts_backfilled: set = set()
+
+def fetch_exclusion_texts(subject: str, solved_keys: set, max_items: int = 100, user_id=None) -> list[str]:
+    """
+    Возвращает список текстов вопросов, которые пользователь уже решил правильно.
+    Тексты читаются одним запросом из solved_questions; если там их меньше,
+    чем решённых ключей, недостающие один раз на процесс ищутся в saved_tests
+    и дописываются в solved_questions.
+    Эти тексты добавляются в промпт как список исключений для GPT.
+    Если user_id передан явно, st не используется (для фоновых потоков).
+    """
+    texts: list[str] = []
+    if not solved_keys:
+        return texts
+    user_id = user_id or get_current_user_id()
+    if not user_id:
+        return texts
+    subj = canonical_subject(subject)
+    rows = _fetch_solved_question_texts(user_id, subj, max_items)
+    found_keys = set()
+    for qkey, qtext in rows or []:
+        if isinstance(qtext, str) and qtext.strip() and qkey not in found_keys:
+            texts.append(qtext)
+            found_keys.add(qkey)
+    if len(texts) >= min(len(solved_keys), max_items) or (user_id, subj) in _solved_texts_backfilled:
+        return texts
+    try:
+        missing = _scan_saved_tests_for_texts(user_id, subj, solved_keys, found_keys, max_items - len(texts))
+        texts.extend(qtext for _, qtext in missing)
+        if rows is not None:
+            store_solved_question_texts(user_id, subj, missing)
+            _solved_texts_backfilled.add((user_id, subj))
+        logger.debug(f"Backfilled {len(missing)} exclusion texts from saved_tests for subject '{subj}'")
     except Exception as e:
         logger.debug(f"fetch_exclusion_texts failed: {e}")
     return texts
@@ -716,13 +1643,18 @@ def create_new_test_chat(user_id):
 
 def generate_chat_title(prompt, subject):
     try:
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {"role": "system", "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: '[Пән] - [Тақырып]'"},
-                {"role": "user", "content": f"Пән: {subject}\nСұрақ: {prompt}"}
-            ],
-        )
+        with track_call("test.generate_chat_title", model="gpt-5", subject=subject) as m:
+            response = call_openai(
+                client.chat.completions,
+                metrics=m,
+                est_tokens=estimate_request_tokens(prompt),
+                model="gpt-5",
+                messages=[
+                    {"role": "system", "content": "Сұрақ негізінде қазақ тілінде қысқа тақырыпты анықта (максимум 5 сөз). Формат: '[Пән] - [Тақырып]'"},
+                    {"role": "user", "content": f"Пән: {subject}\nСұрақ: {prompt}"}
+                ],
+            )
+            m.add_usage(response.usage)
         content = response.choices[0].message.content
         if content is None:
             logger.warning("OpenAI тақырып контенті бос (None)")
@@ -737,23 +1669,70 @@ def generate_chat_title(prompt, subject):
 def extract_kazakh_text_from_image(image_bytes: bytes, mime_type: str = "image/png") -> str:
     try:
         data_url = f"data:{mime_type};base64,{b64encode(image_bytes).decode('utf-8')}"
-        resp = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": "Суреттен қазақша мәтінді дәл шығарып бер. Тек мәтіннің өзін қайтар."},
-                        {"type": "image_url", "image_url": {"url": data_url}}
-                    ]
-                }
-            ],
-        )
+        with track_call("test.extract_kazakh_text_from_image", model="gpt-5") as m:
+            resp = call_openai(
+                client.chat.completions,
+                metrics=m,
+                # Изображение оценивается как обычный запрос: размер data URL не отражает токены
+                est_tokens=estimate_request_tokens(),
+                model="gpt-5",
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": "Суреттен қазақша мәтінді дәл шығарып бер. Тек мәтіннің өзін қайтар."},
+                            {"type": "image_url", "image_url": {"url": data_url}}
+                        ]
+                    }
+                ],
+            )
+            m.add_usage(resp.usage)
         content = resp.choices[0].message.content
         return content.strip() if isinstance(content, str) else (content or "").strip()
     except Exception:
         return ""
 
+def ask_subject_assistant(subject, question, call_site, placeholder=None, use_cache=False):
+    """
+    Задаёт вопрос ассистенту предмета в треде текущего тест-чата (тред создаётся
+    при первом вопросе и переиспользуется). Ответ выводится в placeholder по
+    мере генерации. С use_cache (только для первого вопроса чата, см.
+    is_first_turn) повторные вопросы берутся из кеша ответов;
+    для предметов с локальным поиском ответ строится по индексу учебников.
+    Возвращает (StreamedRun, имена файлов-источников).
+    """
+    chat_id = st.session_state.test_chat_id
+    cache_lookup = answer_cache.lookup(client, subject, question) if use_cache else None
+    if cache_lookup is not None and cache_lookup.entry is not None:
+        entry = cache_lookup.entry
+        append_turn(client, lambda: chat_thread_id(client, supabase, "test_chats", chat_id), question, entry.answer)
+        return StreamedRun.finished(entry.answer), entry.sources
+    on_text = (lambda text: placeholder.markdown(text + "▌")) if placeholder is not None else None
+    if uses_local_retrieval(subject):
+        with track_call(f"{call_site}.local", model=LOCAL_RETRIEVAL_MODEL, subject=subject) as m:
+            local = answer_locally(client, subject, question, on_text=on_text, metrics=m)
+        if local is not None and local[0]:
+            answer, sources = local
+            answer_cache.store(cache_lookup, answer, sources)
+            append_turn(client, lambda: chat_thread_id(client, supabase, "test_chats", chat_id), question, answer)
+            return StreamedRun.finished(answer), sources
+    with track_call(call_site, subject=subject) as m:
+        thread_id = chat_thread_id(client, supabase, "test_chats", chat_id, metrics=m)
+        call_openai(
+            client.beta.threads.messages, "create", metrics=m,
+            thread_id=thread_id,
+            role="user",
+            content=question
+        )
+        streamed = stream_run(
+            client, thread_id, SUBJECTS[subject]["assistant_id"],
+            on_text=on_text, metrics=m, tools=[{"type": "file_search"}],
+        )
+    filenames = file_names.names(streamed.file_ids, client) if streamed.status == "completed" else []
+    if streamed.status == "completed":
+        answer_cache.store(cache_lookup, streamed.text, filenames)
+    return streamed, filenames
+
 def test_page():
     if "user_id" not in st.session_state or not st.session_state.user_id:
         st.error("Сіз авторизациядан өтуіңіз керек!")
@@ -950,7 +1929,21 @@ def test_page():
                 logger.error(f"Unsupported subject: {subject}")
                 return
             with st.spinner("Тест құрылуда..."):
-                test_questions = generate_test(subject)
+                test_questions = take_prefetched_test(subject)
+                if not test_questions:
+                    # Сұрақтарды генерация барысында көрсетеміз; жіберу тест толық құрылғанша құлыпталған
+                    preview = st.container()
+                    locked_submit = st.empty()
+                    locked_submit.button("Жауаптарды жіберу", disabled=True, key="test_submit_locked",
+                                         help="Тест толық құрылғанша жауаптарды жіберу мүмкін емес")
+
+                    def show_question(question, number):
+                        with preview:
+                            st.write(f"**{number}. {question['text']}**")
+                            st.markdown("\n".join(f"- {opt}" for opt in question["options"]))
+
+                    test_questions = generate_test(subject, on_question=show_question)
+                    locked_submit.empty()
             if test_questions and len(test_questions) == 20:
                 st.session_state.current_test = test_questions
                 st.session_state.user_answers = {}
@@ -1077,79 +2070,22 @@ def test_page():
                         assistant_id = None
                     if assistant_id:
                         with st.spinner("Жауап дайындалуда..."):
+                            with st.chat_message("assistant"):
+                                answer_placeholder = st.empty()
                             try:
-                                thread = client.beta.threads.create()
-                                client.beta.threads.messages.create(
-                                    thread_id=thread.id,
-                                    role="user",
-                                    content=extracted_text
-                                )
-                                run = client.beta.threads.runs.create(
-                                    thread_id=thread.id,
-                                    assistant_id=assistant_id,
-                                    tools=[{"type": "file_search"}]
+                                streamed, filenames = ask_subject_assistant(
+                                    subject, extracted_text, "test.assistant_run_image", placeholder=answer_placeholder
                                 )
-                                while run.status in ["queued", "in_progress"]:
-                                    run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-                                    time.sleep(2)
-                                if run.status == "completed":
-                                    messages = client.beta.threads.messages.list(thread_id=thread.id, limit=1)
-                                    response_content = messages.data[0].content
-                                    answer_text = ""
-                                    sources = set()
-                                    for block in response_content:
-                                        try:
-                                            if hasattr(block, 'text') and getattr(block, 'text', None):
-                                                text_part = getattr(block, 'text', None)
-                                                if text_part and hasattr(text_part, 'value'):
-                                                    value = getattr(text_part, 'value', None)
-                                                    if isinstance(value, str):
-                                                        answer_text += value
-                                                annotations = getattr(text_part, 'annotations', None)
-                                                if annotations:
-                                                    for ann in annotations:
-                                                        file_citation = getattr(ann, 'file_citation', None)
-                                                        if file_citation:
-                                                            fid = getattr(file_citation, 'file_id', None)
-                                                            if isinstance(fid, str):
-                                                                sources.add(fid)
-                                                        else:
-                                                            file_path = getattr(ann, 'file_path', None)
-                                                            if file_path:
-                                                                fid = getattr(file_path, 'file_id', None)
-                                                                if isinstance(fid, str):
-                                                                    sources.add(fid)
-                                                            else:
-                                                                fid = getattr(ann, 'file_id', None)
-                                                                if isinstance(fid, str):
-                                                                    sources.add(fid)
-                                            file_citation_block = getattr(block, 'file_citation', None)
-                                            if file_citation_block:
-                                                fid = getattr(file_citation_block, 'file_id', None)
-                                                if isinstance(fid, str):
-                                                    sources.add(fid)
-                                        except Exception:
-                                            continue
-                                    try:
-                                        answer_text = re.sub(r"【[^】]*】", "", answer_text)
-                                        answer_text = re.sub(r"†source", "", answer_text, flags=re.IGNORECASE)
-                                    except Exception:
-                                        pass
-                                    if sources:
-                                        filenames = []
-                                        for fid in sorted(sources):
-                                            try:
-                                                fobj = client.files.retrieve(fid)
-                                                fname = getattr(fobj, 'filename', None) or fid
-                                                filenames.append(fname)
-                                            except Exception:
-                                                filenames.append(fid)
-                                        answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(dict.fromkeys(filenames))}"
+                                if streamed.status == "completed":
+                                    answer_text = streamed.text
+                                    if filenames:
+                                        answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(filenames)}"
                                     st.session_state.test_messages.append({"role": "assistant", "content": answer_text})
-                                    with st.chat_message("assistant"):
-                                        st.markdown(answer_text)
-                                client.beta.threads.delete(thread.id)
+                                    answer_placeholder.markdown(answer_text)
+                                else:
+                                    answer_placeholder.empty()
                             except Exception as e:
+                                answer_placeholder.empty()
                                 st.error(f"Жауап алу кезінде қате: {str(e)}")
 
     # Test chat input - moved outside of image processing block
@@ -1160,113 +2096,35 @@ def test_page():
             st.markdown(user_input)
 
         with st.spinner("Жауап дайындалуда..."):
+            with st.chat_message("assistant"):
+                answer_placeholder = st.empty()
             try:
-                # Use the subject-specific assistant with file search
-                assistant_id = SUBJECTS[subject]["assistant_id"]
-                
-                # Create a new thread for this conversation
-                thread = client.beta.threads.create()
-                
-                # Add user message to thread
-                client.beta.threads.messages.create(
-                    thread_id=thread.id,
-                    role="user",
-                    content=user_input
-                )
-                
-                # Run the assistant with file search
-                run = client.beta.threads.runs.create(
-                    thread_id=thread.id,
-                    assistant_id=assistant_id,
-                    tools=[{"type": "file_search"}]
+                # Ask the subject-specific assistant in this chat's thread
+                streamed, filenames = ask_subject_assistant(
+                    subject, user_input, "test.assistant_run", placeholder=answer_placeholder,
+                    use_cache=is_first_turn(st.session_state.test_messages)
                 )
-                
-                # Wait for completion
-                while run.status in ["queued", "in_progress"]:
-                    run = client.beta.threads.runs.retrieve(thread_id=thread.id, run_id=run.id)
-                    time.sleep(2)
-                
-                if run.status == "completed":
-                    # Get the response
-                    messages = client.beta.threads.messages.list(thread_id=thread.id, limit=1)
-                    response_content = messages.data[0].content
-                    
-                    # Extract text and sources
-                    answer_text = ""
-                    sources = set()
-                    
-                    for block in response_content:
-                        try:
-                            if hasattr(block, 'text') and getattr(block, 'text', None):
-                                text_part = getattr(block, 'text', None)
-                                if text_part and hasattr(text_part, 'value'):
-                                    value = getattr(text_part, 'value', None)
-                                    if isinstance(value, str):
-                                        answer_text += value
-                                # Collect file IDs from text annotations if present
-                                annotations = getattr(text_part, 'annotations', None)
-                                if annotations:
-                                    for ann in annotations:
-                                        file_citation = getattr(ann, 'file_citation', None)
-                                        if file_citation:
-                                            fid = getattr(file_citation, 'file_id', None)
-                                            if isinstance(fid, str):
-                                                sources.add(fid)
-                                        else:
-                                            file_path = getattr(ann, 'file_path', None)
-                                            if file_path:
-                                                fid = getattr(file_path, 'file_id', None)
-                                                if isinstance(fid, str):
-                                                    sources.add(fid)
-                                            else:
-                                                fid = getattr(ann, 'file_id', None)
-                                                if isinstance(fid, str):
-                                                    sources.add(fid)
-                            # Fallback: citations at block level
-                            file_citation_block = getattr(block, 'file_citation', None)
-                            if file_citation_block:
-                                fid = getattr(file_citation_block, 'file_id', None)
-                                if isinstance(fid, str):
-                                    sources.add(fid)
-                        except Exception:
-                            # Skip blocks that can't be processed
-                            continue
-                    
-                    # Strip inline citation markers like 【4:6†source】 and †source
-                    try:
-                        answer_text = re.sub(r"【[^】]*】", "", answer_text)
-                        answer_text = re.sub(r"†source", "", answer_text, flags=re.IGNORECASE)
-                    except Exception:
-                        pass
-                    
-                    # Resolve file IDs to filenames and append
-                    if sources:
-                        filenames = []
-                        for fid in sorted(sources):
-                            try:
-                                fobj = client.files.retrieve(fid)
-                                fname = getattr(fobj, 'filename', None) or fid
-                                filenames.append(fname)
-                            except Exception:
-                                filenames.append(fid)
-                        answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(dict.fromkeys(filenames))}"
+
+                if streamed.status == "completed":
+                    answer_text = streamed.text
+                    if filenames:
+                        answer_text += f"\n\n**📚 Дереккөздер:** {', '.join(filenames)}"
                     else:
                         answer_text += f"\n\n**📚 Дереккөз:** {subject} оқулығы"
-                    
+
                     st.session_state.test_messages.append({"role": "assistant", "content": answer_text})
-                    with st.chat_message("assistant"):
-                        st.markdown(answer_text)
+                    answer_placeholder.markdown(answer_text)
                 else:
-                    error_msg = f"Ассистент жауап бере алмады: {run.status}"
-                    if hasattr(run, 'last_error') and run.last_error:
-                        error_msg += f" ({run.last_error.message})"
+                    answer_placeholder.empty()
+                    error_msg = f"Ассистент жауап бере алмады: {streamed.status}"
+                    last_error = getattr(streamed.run, "last_error", None)
+                    if last_error:
+                        error_msg += f" ({last_error.message})"
                     st.error(error_msg)
                     st.session_state.test_messages.append({"role": "assistant", "content": error_msg})
-                
-                # Clean up thread
-                client.beta.threads.delete(thread.id)
-                
+
             except Exception as e:
+                answer_placeholder.empty()
                 error_msg = f"Жауап алу кезінде қате: {str(e)}"
                 st.error(error_msg)
                 st.session_state.test_messages.append({"role": "assistant", "content": error_msg})
@@ -1303,6 +2161,11 @@ def test_page():
 
         # Only show questions if test is not submitted
         if not st.session_state.get("test_submitted"):
+            # Пока ученик решает тест, готовим следующий в фоне
+            try:
+                start_prefetch(subject, current_test)
+            except Exception as e:
+                logger.debug(f"Test prefetch not started: {e}")
             # Use form to prevent automatic page refreshes
             with st.form("test_form", clear_on_submit=False):
                 for i, question in enumerate(current_test):
@@ -1362,14 +2225,6 @@ def test_page():
                             logger.debug(f"Calling save_results for subject='{subject}' with {len(current_test)} questions")
                             save_results(subject, current_test, st.session_state.test_results)
                             logger.debug("save_results completed successfully")
-                            
-                            # Force refresh the solved keys cache after saving
-                            subj = canonical_subject(subject)
-                            cache_key = f"excluded_keys_cache_{subj}"
-                            # Clear the cache to force fresh fetch on next test
-                            if cache_key in st.session_state:
-                                del st.session_state[cache_key]
-                            logger.debug(f"Cleared cache for subject '{subj}' to force fresh fetch")
                         except Exception as e:
                             logger.error(f"Error in save_results: {e}")
                             st.error(f"Ошибка сохранения результатов: {e}")
@@ -0,0 +1,218 @@
+import json
+import logging
+import math
+import os
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    VECTOR_STORE_NPROBE = max(1, int(os.getenv("VECTOR_STORE_NPROBE", "8")))
+except ValueError:
+    VECTOR_STORE_NPROBE = 8
+# k-means обучается на подвыборке не больше стольких строк
+KMEANS_SAMPLE = 50000
+KMEANS_ITERATIONS = 10
+# Строки назначаются кластерам и квантуются порциями, чтобы не держать N×C в памяти
+ASSIGN_BATCH = 16384
+
+
+def quantize_rows(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """int8-коды и масштаб каждой строки (max|x| / 127): x ≈ codes * scale."""
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _nearest(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    out = np.empty(vectors.shape[0], dtype=np.int32)
+    for start in range(0, vectors.shape[0], ASSIGN_BATCH):
+        out[start:start + ASSIGN_BATCH] = (vectors[start:start + ASSIGN_BATCH] @ centroids.T).argmax(axis=1)
+    return out
+
+
+def train_centroids(vectors: np.ndarray, nlist: int, iterations: int = KMEANS_ITERATIONS, seed: int = 0) -> np.ndarray:
+    """Сферический k-means (косинусное сходство) на подвыборке строк."""
+    rng = np.random.default_rng(seed)
+    sample = vectors
+    if vectors.shape[0] > KMEANS_SAMPLE:
+        sample = vectors[rng.choice(vectors.shape[0], KMEANS_SAMPLE, replace=False)]
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(sample.shape[0], nlist, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, sample)
+        counts = np.bincount(assign, minlength=nlist)
+        empty = counts == 0
+        if empty.any():
+            # Пустые кластеры получают случайные строки подвыборки
+            sums[empty] = sample[rng.choice(sample.shape[0], int(empty.sum()), replace=False)]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids = sums / norms
+    return centroids.astype(np.float32)
+
+
+def default_nlist(n: int) -> int:
+    return max(1, min(4096, int(4 * math.sqrt(n)), n))
+
+
+class QuantizedIVFStore:
+    """
+    Хранилище эмбеддингов на диске: int8-коды с масштабом на строку,
+    упорядоченные по кластерам грубого IVF-разбиения. Файлы открываются через
+    numpy.memmap только на чтение, поэтому страницы общие для всех процессов
+    Streamlit (через page cache ОС), а поиск читает лишь nprobe ближайших кластеров.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.n = meta["n"]
+        self.dim = meta["dim"]
+        self.nlist = meta["nlist"]
+        self.codes = self._map("codes.i8", np.int8, (self.n, self.dim))
+        self.scales = self._map("scales.f32", np.float32, (self.n,))
+        self.ids = self._map("ids.i32", np.int32, (self.n,))
+        self.offsets = np.fromfile(os.path.join(directory, "offsets.i64"), dtype=np.int64)
+        self.centroids = np.fromfile(os.path.join(directory, "centroids.f32"), dtype=np.float32).reshape(self.nlist, self.dim)
+
+    def _map(self, name: str, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.directory, name), dtype=dtype, mode="r", shape=shape)
+
+    def __len__(self) -> int:
+        return self.n
+
+    @staticmethod
+    def build(directory: str, vectors: np.ndarray, nlist: int = None, seed: int = 0) -> "QuantizedIVFStore":
+        """Разбивает L2-нормированные vectors на кластеры, квантует и записывает на диск."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n, dim = vectors.shape
+        os.makedirs(directory, exist_ok=True)
+        nlist = min(nlist or default_nlist(n), max(n, 1))
+        if n:
+            centroids = train_centroids(vectors, nlist, seed=seed)
+            assign = _nearest(vectors, centroids)
+        else:
+            centroids = np.zeros((nlist, dim), dtype=np.float32)
+            assign = np.zeros(0, dtype=np.int32)
+        order = np.argsort(assign, kind="stable").astype(np.int32)
+        offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=offsets[1:])
+        # Порциями: коды пишутся сразу в файл, без полной float32-копии в новом порядке
+        with open(os.path.join(directory, "codes.i8"), "wb") as codes_file, \
+                open(os.path.join(directory, "scales.f32"), "wb") as scales_file:
+            for start in range(0, n, ASSIGN_BATCH):
+                codes, scales = quantize_rows(vectors[order[start:start + ASSIGN_BATCH]])
+                codes_file.write(codes.tobytes())
+                scales_file.write(scales.tobytes())
+        order.tofile(os.path.join(directory, "ids.i32"))
+        offsets.tofile(os.path.join(directory, "offsets.i64"))
+        centroids.tofile(os.path.join(directory, "centroids.f32"))
+        with open(os.path.join(directory, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"n": n, "dim": dim, "nlist": nlist}, f)
+        logger.info(f"Built quantized IVF store {directory}: {n} vectors, {nlist} lists")
+        return QuantizedIVFStore(directory)
+
+    def reconstruct(self, rows) -> np.ndarray:
+        """Приближённые float32-векторы по исходным номерам строк."""
+        position = np.empty(self.n, dtype=np.int64)
+        position[np.asarray(self.ids)] = np.arange(self.n)
+        at = position[np.asarray(rows, dtype=np.int64)]
+        return np.asarray(self.codes[at], dtype=np.float32) * np.asarray(self.scales[at])[:, None]
+
+    def search(self, query: np.ndarray, k: int = 10, nprobe: int = VECTOR_STORE_NPROBE) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Приближённые top-k по скалярному произведению: (исходные номера строк,
+        оценки) по убыванию. Сканируются только nprobe ближайших к запросу кластеров.
+        """
+        if not self.n:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        query = np.asarray(query, dtype=np.float32).reshape(-1)
+        nprobe = min(nprobe, self.nlist)
+        probe = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in np.sort(probe)])
+        if not rows.size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        scores = (self.codes[rows].astype(np.float32) @ query) * self.scales[rows]
+        k = min(k, rows.size)
+        best = np.argpartition(-scores, k - 1)[:k]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return np.asarray(self.ids[rows[best]], dtype=np.int64), scores[best]
+
+
+def _clustered_vectors(n: int, dim: int, seed: int) -> np.ndarray:
+    # Синтетика, похожая на эмбеддинги текстов: много тем, строки вокруг центров тем
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((max(1, n // 500), dim)).astype(np.float32)
+    vectors = topics[rng.integers(0, topics.shape[0], n)] + 0.6 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def benchmark(directory: str, vectors: np.ndarray, queries: np.ndarray, k: int = 10, nprobes=(1, 4, 8, 16, 32)):
+    """Время загрузки, recall@k и задержка запроса против точного float32-поиска."""
+    flat_path = os.path.join(directory, "flat.f32")
+    vectors.astype(np.float32).tofile(flat_path)
+    QuantizedIVFStore.build(directory, vectors)
+
+    started = time.perf_counter()
+    flat = np.fromfile(flat_path, dtype=np.float32).reshape(-1, vectors.shape[1])
+    flat_load = time.perf_counter() - started
+    started = time.perf_counter()
+    store = QuantizedIVFStore(directory)
+    store_load = time.perf_counter() - started
+    print(f"load: float32 {flat_load * 1000:.1f}ms ({flat.nbytes / 2**20:.0f} MiB resident), "
+          f"int8 memmap {store_load * 1000:.1f}ms ({(store.n * (store.dim + 8)) / 2**20:.0f} MiB on disk, paged on demand)")
+
+    exact, latencies = [], []
+    for q in queries:
+        started = time.perf_counter()
+        scores = flat @ q
+        top = np.argpartition(-scores, k - 1)[:k]
+        latencies.append(time.perf_counter() - started)
+        exact.append(set(top.tolist()))
+    print(f"exact float32   p50={np.percentile(latencies, 50) * 1000:7.2f}ms p95={np.percentile(latencies, 95) * 1000:7.2f}ms")
+    for nprobe in nprobes:
+        if nprobe > store.nlist:
+            continue
+        hits, latencies = 0, []
+        for q, truth in zip(queries, exact):
+            started = time.perf_counter()
+            ids, _ = store.search(q, k, nprobe=nprobe)
+            latencies.append(time.perf_counter() - started)
+            hits += len(truth & set(ids.tolist()))
+        print(f"ivf nprobe={nprobe:<4} p50={np.percentile(latencies, 50) * 1000:7.2f}ms "
+              f"p95={np.percentile(latencies, 95) * 1000:7.2f}ms recall@{k}={hits / (k * len(queries)):.3f}")
+    os.remove(flat_path)
+
+
+if __name__ == "__main__":
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Бенчмарк int8 IVF-хранилища против точного float32-поиска")
+    parser.add_argument("--n", type=int, default=200000, help="Число синтетических векторов")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--vectors", help="Файл float32-векторов (строки по --dim) вместо синтетики")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.vectors:
+        data = np.fromfile(args.vectors, dtype=np.float32).reshape(-1, args.dim)
+    else:
+        data = _clustered_vectors(args.n, args.dim, seed=1)
+    # Запросы — зашумлённые строки данных (как перефразированные вопросы)
+    rng = np.random.default_rng(2)
+    query_rows = data[rng.integers(0, data.shape[0], args.queries)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32) / math.sqrt(args.dim)
+    query_rows /= np.linalg.norm(query_rows, axis=1, keepdims=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        benchmark(tmp, data, query_rows, k=args.k)